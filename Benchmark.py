@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Benchmarks de la VPN
+Mide en local, sin red externa, los caminos críticos del túnel por separado
+(tramas y JSON, cifrado, compresión) y el recorrido completo con un servidor
+y un cliente VPN en loopback y un origen HTTP de prueba.
+Los resultados se guardan en JSON para comparar ejecuciones.
+Requiere: pip install cryptography
+Uso: python Benchmark.py [--duration 1] [--output benchmark_results.json]
+"""
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import Servidor
+import Cliente
+
+# Tamaños de respuesta probados
+SIZES = {'small': 1024, 'medium': 64 * 1024, 'large': 1024 * 1024}
+CONCURRENCY_LEVELS = (1, 8, 32)
+ENGINES = {'threads': 'start_server', 'asyncio': 'start_async_server'}
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Origen HTTP de prueba: GET /<bytes>?pattern=text|random devuelve ese tamaño"""
+    
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Que la cabecera y el cuerpo no esperen al ACK retardado
+    
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        size = int(path.strip('/') or 0)
+        pattern = 'random' if 'pattern=random' in query else 'text'
+        body = Servidor.benchmark_payload(size, pattern)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain' if pattern == 'text' else 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Aguantar ráfagas de conexiones de las pruebas concurrentes
+
+def log(message):
+    """Mensajes de progreso por stderr para no mezclarlos con el JSON"""
+    print(message, file=sys.stderr, flush=True)
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=5):
+    """Esperar a que un servidor recién arrancado acepte conexiones"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"El puerto {port} no responde")
+
+def time_operation(operation, duration):
+    """Repetir operation durante duration segundos y devolver operaciones por segundo"""
+    count = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while True:
+        operation()
+        count += 1
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - start)
+
+def run_load(operation, concurrency, duration, warmup):
+    """Repetir operation desde concurrency hilos y medir solo tras el calentamiento
+    
+    operation devuelve los bytes transferidos o lanza una excepción si falla.
+    """
+    start = time.monotonic()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+    latencies = []
+    totals = {'bytes': 0, 'errors': 0}
+    lock = threading.Lock()
+    
+    def worker():
+        while True:
+            began = time.monotonic()
+            if began >= deadline:
+                return
+            try:
+                transferred = operation()
+            except Exception:
+                transferred = None
+            elapsed = time.monotonic() - began
+            if began < measure_from:
+                continue
+            with lock:
+                if transferred is None:
+                    totals['errors'] += 1
+                else:
+                    latencies.append(elapsed)
+                    totals['bytes'] += transferred
+    
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    
+    measured = max(time.monotonic() - measure_from, 1e-9)
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': totals['errors'],
+        'requests_per_s': len(latencies) / measured,
+        'bytes_per_s': totals['bytes'] / measured,
+        'p50_ms': Cliente.percentile(latencies, 0.50) * 1000,
+        'p95_ms': Cliente.percentile(latencies, 0.95) * 1000,
+        'p99_ms': Cliente.percentile(latencies, 0.99) * 1000,
+    }
+
+def micro_benchmarks(args, key):
+    """Coste de cada paso del camino crítico por separado, sin sockets"""
+    results = []
+    secret = base64.urlsafe_b64decode(key)
+    
+    def record(path, variant, size_name, rate, **extra):
+        size = SIZES[size_name]
+        results.append(dict(path=path, variant=variant, size=size_name, bytes=size,
+                            ops_per_s=rate, bytes_per_s=rate * size, **extra))
+    
+    for size_name in args.sizes:
+        body = Servidor.benchmark_payload(SIZES[size_name], 'text')
+        metadata = {'status': 'chunk', 'stream_id': 1}
+        message = Servidor.encode_message(metadata, body)
+        log(f"Micro: {size_name}")
+        
+        # Empaquetado de mensajes (metadatos JSON + cuerpo binario) ida y vuelta
+        rate = time_operation(lambda: Servidor.decode_message(Servidor.encode_message(metadata, body)),
+                              args.duration)
+        record('framing', 'json', size_name, rate)
+        
+        # Cifrado en un extremo y descifrado en el otro
+        for cipher in args.ciphers:
+            salt = os.urandom(2 * Servidor.SESSION_RANDOM_SIZE)
+            sender = Cliente.derive_session_cipher(key, cipher, secret, salt, is_server=False)
+            receiver = Servidor.derive_session_cipher(key, cipher, secret, salt, is_server=True)
+            rate = time_operation(lambda: receiver.decrypt(sender.encrypt(message)), args.duration)
+            record('cipher', cipher, size_name, rate, overhead=len(sender.encrypt(message)) - len(message))
+        
+        # Compresión y descompresión con datos comprimibles e incompresibles
+        for compression in args.compressions:
+            if compression == 'none':
+                continue
+            for pattern in ('text', 'random'):
+                data = Servidor.benchmark_payload(SIZES[size_name], pattern)
+                rate = time_operation(
+                    lambda: Servidor.decompress_body(compression, Servidor.compress_body(compression, data)),
+                    args.duration)
+                ratio = len(Servidor.compress_body(compression, data)) / len(data)
+                record('compression', f"{compression}/{pattern}", size_name, rate, ratio=ratio)
+    
+    return results
+
+def end_to_end_benchmarks(args, key_file, origin_url):
+    """Solicitudes web completas: cliente -> servidor VPN -> origen y vuelta"""
+    results = []
+    for engine in args.engines:
+        port = free_port()
+        server = Servidor.VPNServer(port, key_file=key_file)
+        threading.Thread(target=getattr(server, ENGINES[engine]), daemon=True).start()
+        wait_for_port(port)
+        
+        for cipher in args.ciphers:
+            for compression in args.compressions:
+                client = Cliente.VPNClient('127.0.0.1', port, server.key, [cipher],
+                                           [] if compression == 'none' else [compression])
+                if not client.connect_to_server():
+                    raise RuntimeError(f"No se pudo conectar al servidor ({engine})")
+                
+                for size_name in args.sizes:
+                    url = f"{origin_url}/{SIZES[size_name]}"
+                    
+                    def operation():
+                        response = client.web_request(url)
+                        if response['status'] != 'success':
+                            raise RuntimeError(response.get('message'))
+                        return len(response['content'])
+                    
+                    for concurrency in args.concurrency:
+                        log(f"Túnel: {engine}, {cipher}, {compression}, {size_name}, {concurrency} a la vez")
+                        stats = run_load(operation, concurrency, args.duration, args.warmup)
+                        results.append(dict(engine=engine, cipher=cipher, compression=compression,
+                                            size=size_name, concurrency=concurrency, **stats))
+                client.disconnect()
+        server.stop_server()
+    return results
+
+def proxy_benchmarks(args, key_file, origin_url):
+    """Recorrido completo desde un navegador simulado a través del proxy local del cliente"""
+    results = []
+    port = free_port()
+    server = Servidor.VPNServer(port, key_file=key_file)
+    threading.Thread(target=getattr(server, ENGINES[args.engines[0]]), daemon=True).start()
+    wait_for_port(port)
+    
+    client = Cliente.VPNClient('127.0.0.1', port, server.key, args.ciphers[:1])
+    if not client.connect_to_server():
+        raise RuntimeError("No se pudo conectar al servidor")
+    client.proxy_port = free_port()
+    threading.Thread(target=client.start_proxy_server, daemon=True).start()
+    wait_for_port(client.proxy_port)
+    opener = urllib.request.build_opener(
+        urllib.request.ProxyHandler({'http': f"http://127.0.0.1:{client.proxy_port}"}))
+    
+    for size_name in args.sizes:
+        url = f"{origin_url}/{SIZES[size_name]}"
+        
+        def operation():
+            with opener.open(url, timeout=30) as response:
+                return len(response.read())
+        
+        for concurrency in args.concurrency:
+            log(f"Proxy: {size_name}, {concurrency} a la vez")
+            stats = run_load(operation, concurrency, args.duration, args.warmup)
+            results.append(dict(engine=args.engines[0], cipher=args.ciphers[0],
+                                size=size_name, concurrency=concurrency, **stats))
+    client.disconnect()
+    server.stop_server()
+    return results
+
+def print_summary(results):
+    log("\n=== Túnel ===")
+    log(f"{'motor':8} {'cifrado':18} {'compresión':10} {'tamaño':7} {'conc':>4} "
+        f"{'req/s':>9} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for row in results['end_to_end'] + [dict(row, compression='proxy') for row in results['proxy']]:
+        log(f"{row['engine']:8} {row['cipher']:18} {row['compression']:10} {row['size']:7} "
+            f"{row['concurrency']:>4} {row['requests_per_s']:>9.1f} "
+            f"{row['bytes_per_s'] / 1024 / 1024:>8.2f} {row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f}")
+
+def main():
+    compressions = ['none'] + Servidor.available_compressions()
+    parser = argparse.ArgumentParser(description="Benchmarks de la VPN en local")
+    parser.add_argument('--duration', type=float, default=1.0, help="Segundos medidos por prueba")
+    parser.add_argument('--warmup', type=float, default=0.2, help="Segundos de calentamiento por prueba")
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument('--ciphers', nargs='+', choices=Cliente.available_ciphers(),
+                        default=Cliente.available_ciphers())
+    parser.add_argument('--compressions', nargs='+', choices=compressions, default=compressions)
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=list(CONCURRENCY_LEVELS))
+    parser.add_argument('--skip-micro', action='store_true', help="No medir los pasos por separado")
+    parser.add_argument('--skip-proxy', action='store_true', help="No medir el proxy local")
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help="Archivo de resultados ('-' para la salida estándar)")
+    args = parser.parse_args()
+    
+    origin = OriginServer(('127.0.0.1', 0), OriginHandler)
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+    origin_url = f"http://127.0.0.1:{origin.server_port}"
+    key_file = os.path.join(tempfile.mkdtemp(), 'vpn_key.txt')
+    
+    results = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'micro': [],
+        'end_to_end': [],
+        'proxy': [],
+    }
+    
+    # Los mensajes del servidor y del cliente no interesan aquí: se descartan
+    # mientras corren las pruebas, que detienen sus servidores al terminar
+    with contextlib.redirect_stdout(io.StringIO()):
+        Servidor.VPNServer(free_port(), key_file=key_file)  # Crear la clave de la prueba
+        with open(key_file, 'rb') as f:
+            key = f.read()
+        if not args.skip_micro:
+            results['micro'] = micro_benchmarks(args, key)
+        results['end_to_end'] = end_to_end_benchmarks(args, key_file, origin_url)
+        if not args.skip_proxy:
+            results['proxy'] = proxy_benchmarks(args, key_file, origin_url)
+    
+    print_summary(results)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        log(f"\nResultados guardados en {args.output}")
+
+if __name__ == "__main__":
+    main()
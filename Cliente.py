@@ -3,6 +3,7 @@
 Cliente VPN Simple
 Ejecutar en el dispositivo que quiere conectarse remotamente
 Requiere: pip install cryptography requests
+Opcional: pip install zstandard lz4 (compresión más rápida)
 """
 
 import socket
@@ -11,52 +12,1122 @@ import sys
 import os
 import time
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import base64
 import urllib.request
 import urllib.parse
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
 import threading
+import struct
+import zlib
+import queue
+import itertools
+import random
+import selectors
+import contextlib
+from collections import deque
+
+# Compresión opcional más rápida si está instalada (pip install zstandard lz4)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Protocolo: cada mensaje cifrado va precedido de su longitud (4 bytes, big-endian)
+FRAME_HEADER_SIZE = 4
+AEAD_TAG_SIZE = 16  # Lo que crece cada mensaje al cifrarlo con AEAD
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # 64MB
+COMPRESSION_THRESHOLD = 1024  # No comprimir cuerpos más pequeños
+# Tipos de contenido que ya vienen comprimidos
+INCOMPRESSIBLE_TYPES = ('image/', 'video/', 'audio/', 'font/woff', 'application/zip',
+                        'application/gzip', 'application/x-gzip', 'application/x-7z-compressed',
+                        'application/x-rar-compressed', 'application/x-bzip2', 'application/zstd')
+
+def recv_exact(sock, size, buffer=None):
+    """Leer exactamente size bytes del socket (None si la conexión se cierra antes)
+    
+    Los datos se leen con recv_into directamente en buffer si cabe (si no, en
+    uno nuevo) y se devuelve una vista de ellos, sin copias intermedias.
+    """
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+    view = memoryview(buffer)[:size]
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return view
+
+def recv_frame(sock, buffer=None):
+    """Recibir un mensaje completo (None si el otro extremo cerró la conexión)
+    
+    Con buffer el resultado es una vista de él: solo vale hasta la siguiente llamada.
+    """
+    header = recv_exact(sock, FRAME_HEADER_SIZE, buffer)
+    if header is None:
+        return None
+    length = struct.unpack('!I', header)[0]
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Mensaje demasiado grande: {length} bytes")
+    payload = recv_exact(sock, length, buffer)
+    if payload is None:
+        raise ConnectionError("Conexión cerrada a mitad de mensaje")
+    return payload
+
+def send_frame(sock, payload):
+    """Enviar un mensaje precedido de su longitud
+    
+    Con sendmsg la cabecera y el mensaje salen juntos sin copiarlos a un
+    objeto nuevo para unirlos.
+    """
+    header = struct.pack('!I', len(payload))
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(header + payload)
+        return
+    sent = sock.sendmsg([header, payload])
+    if sent < FRAME_HEADER_SIZE:
+        sock.sendall(header[sent:])
+        sent = FRAME_HEADER_SIZE
+    if sent < FRAME_HEADER_SIZE + len(payload):
+        sock.sendall(memoryview(payload)[sent - FRAME_HEADER_SIZE:])
+
+def send_encrypted_frame(sock, cipher, plaintext, buffer):
+    """Cifrar un mensaje y enviarlo como trama
+    
+    Con AEAD la trama completa (longitud y mensaje cifrado) se escribe en
+    buffer, un memoryview reutilizable, y sale con un solo sendall sin crear
+    objetos por mensaje.
+    """
+    size = len(plaintext) + AEAD_TAG_SIZE
+    if isinstance(cipher, AEADCipher) and FRAME_HEADER_SIZE + size <= len(buffer):
+        frame = buffer[:FRAME_HEADER_SIZE + size]
+        struct.pack_into('!I', frame, 0, size)
+        cipher.encrypt_into(plaintext, frame[FRAME_HEADER_SIZE:])
+        sock.sendall(frame)
+    elif isinstance(cipher, AEADCipher):
+        send_frame(sock, cipher.encrypt(plaintext))
+    else:
+        send_frame(sock, cipher.encrypt(bytes(plaintext)))  # Fernet solo acepta bytes
+
+def encode_message(metadata, body=b'', compression=None):
+    """Empaquetar metadatos (JSON compacto) y cuerpo binario en un solo mensaje
+    
+    Formato: longitud de los metadatos (4 bytes) + metadatos + cuerpo en bruto.
+    El cuerpo nunca pasa por JSON, así que viaja byte a byte sin recodificar.
+    Con compression el cuerpo se comprime si es grande y sale más pequeño;
+    los metadatos indican el algoritmo en 'compressed'.
+    """
+    if compression and len(body) >= COMPRESSION_THRESHOLD:
+        compressed = compress_body(compression, body)
+        if len(compressed) < len(body):
+            metadata = dict(metadata, compressed=compression)
+            body = compressed
+    return pack_metadata(metadata) + body
+
+def pack_metadata(metadata):
+    """Principio de un mensaje sin comprimir: todo menos el cuerpo
+    
+    Un flujo de mensajes con los mismos metadatos (los datos de un túnel)
+    puede calcularlo una vez y poner cada cuerpo detrás.
+    """
+    meta = json.dumps(metadata, separators=(',', ':')).encode()
+    return struct.pack('!I', len(meta)) + meta
+
+def decode_message(data):
+    """Separar un mensaje en (metadatos, cuerpo), descomprimiendo el cuerpo si hace falta
+    
+    Sin compresión el cuerpo es una vista de data, no una copia.
+    """
+    meta_length = struct.unpack_from('!I', data)[0]
+    metadata = json.loads(data[4:4 + meta_length])
+    body = memoryview(data)[4 + meta_length:]
+    if 'compressed' in metadata:
+        body = decompress_body(metadata.pop('compressed'), body)
+    return metadata, body
+
+def available_compressions():
+    """Algoritmos de compresión disponibles, del preferido al menos preferido"""
+    algorithms = []
+    if zstandard is not None:
+        algorithms.append('zstd')
+    if lz4_frame is not None:
+        algorithms.append('lz4')
+    algorithms.append('zlib')
+    return algorithms
+
+def compress_body(algorithm, data):
+    if algorithm == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if algorithm == 'lz4':
+        return lz4_frame.compress(data)
+    return zlib.compress(data, 6)
+
+def decompress_body(algorithm, data):
+    if algorithm == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if algorithm == 'lz4':
+        return lz4_frame.decompress(data)
+    if algorithm == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError(f"Compresión no soportada: {algorithm}")
+
+def is_compressible(headers):
+    """Saltar cuerpos que ya vienen comprimidos (Content-Encoding o tipos multimedia)"""
+    content_type = ''
+    content_encoding = 'identity'
+    for header, value in headers.items():
+        if header.lower() == 'content-type':
+            content_type = value.lower()
+        elif header.lower() == 'content-encoding':
+            content_encoding = value.lower()
+    return content_encoding == 'identity' and not content_type.startswith(INCOMPRESSIBLE_TYPES)
+
+class AEADCipher:
+    """Cifrado AEAD (AES-GCM o ChaCha20-Poly1305) con un contador como nonce en cada dirección
+    
+    Cada dirección tiene su propia clave, así que el contador puede empezar en
+    cero en los dos sentidos sin repetir nunca un par (clave, nonce). El nonce
+    no viaja: TCP entrega en orden y el receptor espera siempre el siguiente
+    contador, con lo que un mensaje repetido o reordenado no se autentica.
+    Frente a Fernet no hay base64 ni HMAC aparte: cada mensaje solo crece 16 bytes.
+    """
+    
+    ALGORITHMS = {'aes-256-gcm': AESGCM, 'chacha20-poly1305': ChaCha20Poly1305}
+    
+    def __init__(self, algorithm, send_key, recv_key):
+        self.algorithm = algorithm
+        self.send_aead = self.ALGORITHMS[algorithm](send_key)
+        self.recv_aead = self.ALGORITHMS[algorithm](recv_key)
+        self.send_counter = 0
+        self.recv_counter = 0
+    
+    def encrypt(self, data):
+        """Cifrar el siguiente mensaje saliente (llamar siempre en el orden de envío)"""
+        nonce = self.send_counter.to_bytes(12, 'big')
+        self.send_counter += 1
+        return self.send_aead.encrypt(nonce, data, None)
+    
+    def encrypt_into(self, data, buffer):
+        """Como encrypt, pero escribiendo en buffer (len(data) + AEAD_TAG_SIZE bytes)"""
+        nonce = self.send_counter.to_bytes(12, 'big')
+        self.send_counter += 1
+        if hasattr(self.send_aead, 'encrypt_into'):
+            self.send_aead.encrypt_into(nonce, data, None, buffer)
+        else:
+            # Versiones de cryptography sin encrypt_into
+            buffer[:] = self.send_aead.encrypt(nonce, data, None)
+    
+    def decrypt(self, data):
+        """Descifrar el siguiente mensaje entrante (InvalidTag si no es auténtico)"""
+        nonce = self.recv_counter.to_bytes(12, 'big')
+        self.recv_counter += 1
+        return self.recv_aead.decrypt(nonce, data, None)
+    
+    def rekey_recv(self, recv_key):
+        """Cambiar la clave de recepción (al reanudar, cuando llega el valor aleatorio del servidor)"""
+        self.recv_aead = self.ALGORITHMS[self.algorithm](recv_key)
+        self.recv_counter = 0
+
+def resumption_secret(secret, salt):
+    """Secreto que guarda un ticket para reanudar la sesión sin repetir el saludo"""
+    return derive_key(secret, salt, b'vpn reanudacion')
+
+def available_ciphers():
+    """Cifrados de sesión disponibles, del preferido al menos preferido"""
+    return list(AEADCipher.ALGORITHMS) + ['fernet']
+
+def derive_key(secret, salt, label):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=label).derive(secret)
+
+def derive_server_key(secret, salt):
+    return derive_key(secret, salt, b'vpn servidor->cliente')
+
+def derive_session_cipher(key, algorithm, secret, salt, is_server, server_random=b''):
+    """Crear el cifrado de una conexión
+    
+    secret es la clave de vpn_key.txt en un saludo completo o el secreto de
+    reanudación de un ticket; salt lleva los valores aleatorios de la
+    conexión, así que cada conexión tiene claves distintas aunque el secreto
+    no cambie. Con 'fernet' se usa directamente la clave compartida.
+    Al reanudar, salt es solo el valor del cliente (sus solicitudes 0-RTT no
+    pueden esperar al servidor) y server_random entra únicamente en la clave
+    servidor->cliente: si alguien repite la reanudación, el servidor no
+    vuelve a cifrar con los mismos pares (clave, nonce).
+    """
+    if algorithm == 'fernet':
+        return Fernet(key)
+    client_key = derive_key(secret, salt, b'vpn cliente->servidor')
+    server_key = derive_server_key(secret, salt + server_random)
+    if is_server:
+        return AEADCipher(algorithm, server_key, client_key)
+    return AEADCipher(algorithm, client_key, server_key)
+
+SESSION_RANDOM_SIZE = 16  # Bytes aleatorios que aporta cada extremo al derivar las claves de sesión
+# Métodos que se pueden repetir tras una reconexión sin efectos secundarios
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'}
+LATENCY_WINDOW = 120  # Muestras de RTT que se conservan (10 minutos con un ping cada 5 s)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+TUNNEL_BUFFER_SIZE = 64 * 1024  # Buffer reutilizado al reenviar túneles CONNECT
+# Buffers reutilizados para recibir y enviar tramas: caben los fragmentos de
+# 64KB del servidor y los del túnel con sus metadatos; las tramas mayores
+# usan memoria nueva solo para ellas
+FRAME_BUFFER_SIZE = TUNNEL_BUFFER_SIZE + 1024
+UNMEASURED_RTT = 0.1  # RTT supuesto para un servidor del pool que aún no tiene pings
+# Cuerpos de solicitudes: hasta UPLOAD_INLINE_LIMIT bytes van en la propia
+# solicitud (y se puede repetir tras una reconexión); los mayores o en
+# chunked se suben por partes sin tener más de UPLOAD_WINDOW bytes enviados
+# que el servidor no haya entregado aún al origen
+UPLOAD_INLINE_LIMIT = 64 * 1024
+UPLOAD_WINDOW = 1024 * 1024
+# Respuestas por fragmentos y túneles: bytes que el servidor puede tener
+# enviados sin que quien los pidió los haya leído (lo que se acumula por stream)
+DOWNLOAD_WINDOW = 1024 * 1024
+MAX_LINE_SIZE = 64 * 1024  # Líneas de tamaño y trailers de un cuerpo chunked
+
+# Cabeceras propias de cada salto (navegador-proxy) que no se reenvían
+HOP_BY_HOP_HEADERS = {'connection', 'proxy-connection', 'keep-alive', 'transfer-encoding',
+                      'te', 'trailer', 'upgrade', 'proxy-authorization'}
+
+def percentile(sorted_values, fraction):
+    """Percentil por rango más cercano de una lista ya ordenada (0 si está vacía)"""
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+class RequestBody:
+    """Cuerpo de una solicitud del navegador leído por partes de rfile
+    
+    Con content_length se leen exactamente esos bytes; sin él el cuerpo viene
+    en chunked y se decodifica (extensiones y trailers se descartan).
+    readinto() deja cada parte en el buffer de quien lee, sin copias.
+    finished indica si se leyó entero: si no, lo que quede en la conexión
+    keep-alive del navegador no es una solicitud y hay que cerrarla.
+    """
+    
+    def __init__(self, rfile, content_length=None):
+        self.rfile = rfile
+        self.chunked = content_length is None
+        self.remaining = content_length or 0  # Bytes pendientes (del chunk actual si es chunked)
+        self.chunks = 0
+        self.finished = False
+    
+    def readinto(self, buffer):
+        """Leer la siguiente parte en buffer; 0 al terminar el cuerpo"""
+        if self.remaining == 0 and self.chunked and not self.finished:
+            self.next_chunk()
+        if self.remaining == 0:
+            self.finished = True
+            return 0
+        received = self.rfile.readinto1(buffer[:min(len(buffer), self.remaining)])
+        if not received:
+            raise ConnectionError('El navegador cerró la conexión a mitad del cuerpo')
+        self.remaining -= received
+        return received
+    
+    def next_chunk(self):
+        """Leer la cabecera del siguiente chunk (y los trailers si es el último)"""
+        if self.chunks:
+            self.rfile.readline(MAX_LINE_SIZE)  # Fin de línea tras los datos del anterior
+        line = self.rfile.readline(MAX_LINE_SIZE)
+        try:
+            size = int(line.split(b';', 1)[0], 16)
+        except ValueError:
+            size = -1
+        if size < 0:
+            raise ValueError('Cuerpo chunked mal formado')
+        self.chunks += 1
+        if size == 0:
+            while self.rfile.readline(MAX_LINE_SIZE) not in (b'\r\n', b'\n', b''):
+                pass
+        self.remaining = size
+
+class UploadWindow:
+    """Crédito para subir el cuerpo de una solicitud por partes
+    
+    El servidor lo devuelve con mensajes 'window' a medida que entrega el
+    cuerpo al origen y quien sube espera en take() a tener suficiente.
+    Si la solicitud termina antes (error, respuesta o desconexión) close()
+    lo despierta para que deje de enviar.
+    """
+    
+    def __init__(self, size=UPLOAD_WINDOW):
+        self.available = size
+        self.closed = False
+        self.cond = threading.Condition()
+    
+    def grant(self, size):
+        with self.cond:
+            self.available += size
+            self.cond.notify_all()
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+    
+    def take(self, size):
+        """Esperar a poder enviar size bytes (False si la solicitud ya terminó)"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.available >= size)
+            if self.closed:
+                return False
+            self.available -= size
+            return True
+
+class DownloadCredit:
+    """Crédito de bajada que se devuelve al servidor según se lee lo recibido
+    
+    Es la otra mitad de la ventana que el servidor respeta al enviar una
+    respuesta por fragmentos o los datos de un túnel: quien lee los mensajes
+    llama a consumed() con cada uno y cada cuarto de DOWNLOAD_WINDOW leído se
+    devuelve en un mensaje 'window' (send es el send_message del cliente).
+    """
+    
+    def __init__(self, send, stream_id):
+        self.send = send
+        self.stream_id = stream_id
+        self.pending = 0
+    
+    def consumed(self, size):
+        self.pending += size
+        if self.pending >= DOWNLOAD_WINDOW // 4:
+            self.send({'type': 'window', 'stream_id': self.stream_id, 'size': self.pending}, False)
+            self.pending = 0
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer que atiende las solicitudes del navegador en un pool de hilos acotado
+    
+    Un hilo del pool solo se ocupa mientras dura una solicitud: las conexiones
+    nuevas y las keep-alive entre una solicitud y otra esperan en un selector
+    común y pasan al pool cuando el navegador envía algo (o se cierran tras
+    idle_timeout segundos), y los túneles CONNECT pasan a hilos propios, como
+    mucho max_tunnels a la vez. Aparte de las que se están atendiendo, solo
+    max_pending conexiones pueden esperar hilo: las demás se rechazan con 503.
+    
+    El handler atiende una única solicitud cada vez (handle_one_request), deja
+    la conexión abierta salvo que pida close_connection y marca detached
+    cuando la conexión pasa a un túnel (ver ProxyHandler).
+    """
+    
+    def __init__(self, server_address, handler_class, max_workers=32, max_pending=256, max_tunnels=256,
+                 idle_timeout=30):
+        super().__init__(server_address, handler_class)
+        self.idle_timeout = idle_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='proxy')
+        self.queued = threading.BoundedSemaphore(max_workers + max_pending)  # En el pool o esperándolo
+        self.tunnel_slots = threading.BoundedSemaphore(max_tunnels)
+        self.idle = selectors.DefaultSelector()  # Conexiones esperando su siguiente solicitud
+        self.idle_lock = threading.Lock()
+        self.closed = False
+        # Para despertar al selector cuando se añade una conexión
+        self.wakeup, self.wakeup_writer = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.idle.register(self.wakeup, selectors.EVENT_READ)
+        watcher = threading.Thread(target=self.watch_idle, name='proxy-idle')
+        watcher.daemon = True
+        watcher.start()
+    
+    def process_request(self, request, client_address):
+        # Hasta que el navegador envíe la solicitud no hace falta ningún hilo
+        self.park(request, client_address, None)
+    
+    def dispatch(self, request, client_address, handler=None):
+        """Pasar una conexión al pool para su siguiente solicitud (False si hay demasiadas esperando)"""
+        if not self.queued.acquire(blocking=False):
+            return False
+        try:
+            self.executor.submit(self.serve, request, client_address, handler)
+        except RuntimeError:
+            self.queued.release()  # El pool ya se cerró
+            return False
+        return True
+    
+    def serve(self, request, client_address, handler):
+        """Atender una solicitud y decidir si la conexión se cierra o espera la siguiente"""
+        try:
+            if handler is None:
+                handler = self.RequestHandlerClass(request, client_address, self)
+            else:
+                handler.handle_one_request()
+        except Exception:
+            self.handle_error(request, client_address)
+            self.drop(request, handler)
+            return
+        finally:
+            self.queued.release()
+        
+        if handler.detached:
+            return
+        if handler.close_connection:
+            handler.close()
+        else:
+            self.park(request, client_address, handler)
+    
+    def park(self, request, client_address, handler):
+        """Dejar una conexión esperando su siguiente solicitud fuera del pool (handler es None si es nueva)"""
+        if handler is not None and self.buffered(request, handler):
+            # Ya está leída (pipelining): el selector no avisaría
+            if not self.dispatch(request, client_address, handler):
+                self.reject(request, handler)
+            return
+        with self.idle_lock:
+            parked = not self.closed
+            if parked:
+                self.idle.register(request, selectors.EVENT_READ, (client_address, handler, time.monotonic()))
+        if not parked:
+            self.drop(request, handler)
+            return
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass  # Ya hay un aviso pendiente
+    
+    def buffered(self, request, handler):
+        """El buffer de rfile ya tiene el principio de la siguiente solicitud"""
+        request.setblocking(False)
+        try:
+            return bool(handler.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            request.settimeout(handler.timeout)
+    
+    def reject(self, request, handler):
+        """Responder 503 y cerrar una conexión que no cabe en el pool"""
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        except OSError:
+            pass
+        self.drop(request, handler)
+    
+    def drop(self, request, handler):
+        """Cerrar una conexión, tenga ya handler o no"""
+        if handler is None:
+            self.shutdown_request(request)
+        else:
+            handler.close()
+    
+    def watch_idle(self):
+        """Hilo que pasa al pool las conexiones en las que llega una solicitud"""
+        while True:
+            events = self.idle.select(timeout=1)
+            now = time.monotonic()
+            ready = []
+            expired = []
+            with self.idle_lock:
+                if self.closed:
+                    self.idle.close()
+                    return
+                for key, _ in events:
+                    if key.fileobj is self.wakeup:
+                        try:
+                            while self.wakeup.recv(4096):
+                                pass
+                        except OSError:
+                            pass
+                        continue
+                    self.idle.unregister(key.fileobj)
+                    ready.append(key)
+                for key in list(self.idle.get_map().values()):
+                    if key.data is not None and now - key.data[2] > self.idle_timeout:
+                        self.idle.unregister(key.fileobj)
+                        expired.append(key)
+            
+            for key in ready:
+                client_address, handler, _ = key.data
+                if not self.dispatch(key.fileobj, client_address, handler):
+                    self.reject(key.fileobj, handler)
+            for key in expired:
+                self.drop(key.fileobj, key.data[1])
+    
+    def server_close(self):
+        super().server_close()
+        with self.idle_lock:
+            self.closed = True
+            parked = [key for key in self.idle.get_map().values() if key.data is not None]
+        for key in parked:
+            self.drop(key.fileobj, key.data[1])
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+        self.executor.shutdown(wait=False)
 
 class VPNClient:
-    def __init__(self, server_host, server_port, key):
+    def __init__(self, server_host, server_port, key, ciphers=None, compressions=None):
         self.server_host = server_host
         self.server_port = server_port
-        self.cipher = Fernet(key)
+        self.key = key
+        self.secret = base64.urlsafe_b64decode(key)
+        self.cipher = Fernet(key)  # Solo para el saludo; luego el cifrado de sesión acordado
+        self.ciphers = ciphers or available_ciphers()  # Cifrados ofrecidos, del preferido al último
+        # Compresiones ofrecidas ([] para no comprimir)
+        self.compressions = available_compressions() if compressions is None else compressions
+        self.session_random = None
+        self.session_ticket = None  # Último ticket recibido para reanudar sin saludo
+        self.resumed_ticket = None
+        self.resuming = False
         self.connected = False
         self.socket = None
+        self.reader_thread = None
         self.proxy_port = 8888
+        self.proxy_workers = 32  # Solicitudes del navegador atendidas a la vez
+        
+        # Multiplexación: cada solicitud lleva un stream_id y espera sus
+        # respuestas en su propia cola mientras un hilo lector las reparte
+        self.send_lock = threading.Lock()
+        self.send_buffer = memoryview(bytearray(FRAME_BUFFER_SIZE))  # Protegido por send_lock
+        self.pending = {}  # stream_id -> queue.Queue
+        self.uploads = {}  # stream_id -> UploadWindow de las solicitudes que suben su cuerpo por partes
+        self.stream_ids = itertools.count(1)
+        self.compression = None  # Algoritmo acordado con el servidor
+        
+        # Reconexión automática: si se cae la conexión las solicitudes esperan
+        # a que vuelva (como mucho max_waiting a la vez) y las idempotentes
+        # que se quedaron sin respuesta se repiten por la conexión nueva
+        self.auto_reconnect = True
+        self.reconnect_delay = 0.5  # Espera tras el primer intento fallido; se duplica en cada fallo
+        self.max_reconnect_delay = 30
+        self.reconnect_timeout = 60  # Tiempo máximo que una solicitud espera a la reconexión
+        self.max_waiting = 256
+        self.max_replays = 3
+        self.ready = threading.Event()  # Conectado y con el saludo hecho
+        self.waiting_slots = threading.BoundedSemaphore(self.max_waiting)
+        self.reconnect_lock = threading.Lock()
+        self.reconnecting = False
+        self.closing = False  # disconnect() llamado: no reconectar
+        
+        # Latido: pings periódicos para medir la latencia y detectar antes que
+        # TCP una conexión muerta (sin pong ni ningún otro mensaje en heartbeat_timeout)
+        self.heartbeat_interval = 5
+        self.heartbeat_timeout = 15
+        self.latency_samples = deque(maxlen=LATENCY_WINDOW)  # (rtt, desfase de reloj)
+        self.latency_lock = threading.Lock()
+        self.srtt = None  # RTT suavizado
+        self.jitter = 0.0
+        self.pings_lost = 0
+        self.last_received = time.monotonic()
     
     def connect_to_server(self):
         """Conectar al servidor VPN"""
         try:
+            self.closing = False
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.socket.connect((self.server_host, self.server_port))
             self.connected = True
+            self.cipher = Fernet(self.key)
+            
+            self.last_received = time.monotonic()
+            self.reader_thread = threading.Thread(target=self.reader_loop)
+            self.reader_thread.daemon = True
+            self.reader_thread.start()
+            
+            ticket = self.session_ticket
+            if ticket is not None and ticket['expires'] > time.time():
+                self.resume(ticket)
+                print("Sesión reanudada sin saludo (0-RTT)")
+            else:
+                self.negotiate()
+            # Con 0-RTT nada garantiza que el servidor siga ahí: si el lector
+            # ya vio el cierre (p. ej. un servidor deteniéndose), no dar la
+            # conexión por lista o nadie volvería a reconectar
+            with self.reconnect_lock:
+                if not self.connected:
+                    raise ConnectionError('El servidor cerró la conexión')
+                self.ready.set()
+                self.reconnecting = False
+            if self.heartbeat_interval:
+                heartbeat_thread = threading.Thread(target=self.heartbeat_loop, args=(self.socket,))
+                heartbeat_thread.daemon = True
+                heartbeat_thread.start()
             print(f"Conectado al servidor VPN {self.server_host}:{self.server_port}")
+            if self.compression:
+                print(f"Compresión acordada: {self.compression}")
+            print(f"Cifrado de sesión: {getattr(self.cipher, 'algorithm', 'fernet')}")
             return True
         except Exception as e:
             print(f"Error conectando al servidor: {e}")
+            self.connected = False
+            if self.socket:
+                self.socket.close()
             return False
     
     def send_request(self, request):
-        """Enviar solicitud al servidor VPN"""
-        if not self.connected:
-            return {'status': 'error', 'message': 'No conectado al servidor'}
+        """Enviar solicitud al servidor VPN
         
+        Si la conexión se cae, la solicitud espera a la reconexión y, si es
+        idempotente y se quedó sin respuesta, se repite por la conexión nueva.
+        """
+        for attempt in range(self.max_replays + 1):
+            try:
+                self.wait_until_connected()
+            except ConnectionError as e:
+                return {'status': 'error', 'message': str(e)}
+            response = self.request_once(request)
+            if not (response.get('disconnected') and self.is_replayable(request)):
+                break
+        return response
+    
+    def request_once(self, request):
+        """Enviar una solicitud por la conexión actual y esperar su respuesta"""
+        stream_id = None
+        sock, reader = self.socket, self.reader_thread
         try:
+            stream_id, responses = self.open_stream()
+            
             # Cifrar y enviar solicitud
-            encrypted_request = self.cipher.encrypt(json.dumps(request).encode())
-            self.socket.send(encrypted_request)
+            self.send_message(dict(request, stream_id=stream_id))
+            
+            # Esperar la respuesta de este stream
+            return responses.get()
+        
+        except Exception as e:
+            print(f"Error enviando solicitud: {e}")
+            if isinstance(e, OSError):
+                self.wait_reader_exit(sock, reader)
+            return {'status': 'error', 'message': str(e), 'disconnected': True}
+        
+        finally:
+            if stream_id is not None:
+                self.pending.pop(stream_id, None)
+    
+    def wait_reader_exit(self, sock, reader):
+        """Tras un fallo al enviar por sock, esperar a que su lector la dé por caída
+        
+        Hasta entonces ready sigue activo y un reintento inmediato volvería a
+        usar la conexión muerta; al salir, el lector ya lanzó la reconexión.
+        """
+        if reader is None or reader is threading.current_thread():
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        reader.join(5)
+    
+    def is_replayable(self, request):
+        """Solicitudes que se pueden repetir sin riesgo si no llegó la respuesta"""
+        if request.get('type') in ('ping', 'speed_test'):
+            return True
+        # Un cuerpo subido por partes ya se consumió al leerlo del navegador
+        return (request.get('type') == 'web_request' and not request.get('upload')
+                and request.get('method', 'GET').upper() in IDEMPOTENT_METHODS)
+    
+    def wait_until_connected(self):
+        """Esperar a que termine la reconexión en curso (ConnectionError si no llega)
+        
+        Como mucho max_waiting solicitudes esperan a la vez; el resto falla
+        enseguida para no acumular trabajo sin límite mientras no hay conexión.
+        """
+        if self.ready.is_set():
+            return
+        if self.closing or not self.reconnecting:
+            raise ConnectionError('No conectado al servidor')
+        if not self.waiting_slots.acquire(blocking=False):
+            raise ConnectionError('Demasiadas solicitudes esperando la reconexión')
+        try:
+            deadline = time.monotonic() + self.reconnect_timeout
+            while not self.closing and time.monotonic() < deadline:
+                if self.ready.wait(min(0.5, deadline - time.monotonic())):
+                    return
+            raise ConnectionError('No se pudo reconectar con el servidor')
+        finally:
+            self.waiting_slots.release()
+    
+    def reconnect_loop(self):
+        """Reintentar la conexión con espera exponencial (con algo de azar) hasta lograrlo
+        
+        El primer intento es inmediato, que es lo habitual tras un corte breve
+        de la WiFi; con un ticket de sesión ni siquiera hace falta el saludo.
+        """
+        delay = self.reconnect_delay
+        connected = False
+        try:
+            while not self.closing:
+                print("Reconectando con el servidor VPN...")
+                if self.connect_to_server():
+                    # connect_to_server ya quitó reconnecting; si la conexión
+                    # nueva cae enseguida su lector lanza otra reconexión
+                    connected = True
+                    return
+                wait = random.uniform(delay / 2, delay)
+                print(f"Nuevo intento en {wait:.1f}s")
+                time.sleep(wait)
+                delay = min(delay * 2, self.max_reconnect_delay)
+        finally:
+            if not connected:
+                self.reconnecting = False
+    
+    def negotiate(self):
+        """Saludo inicial: ofrecer los algoritmos de compresión y los cifrados que conocemos
+        
+        El saludo y su respuesta van con Fernet; el hilo lector cambia al
+        cifrado acordado en cuanto llega la respuesta (ver start_session).
+        Hasta entonces no se envía nada más por la conexión.
+        """
+        self.session_random = os.urandom(SESSION_RANDOM_SIZE)
+        response = self.request_once({
+            'type': 'hello',
+            'compression': self.compressions,
+            'ciphers': self.ciphers,
+            'random': base64.b64encode(self.session_random).decode(),
+        })
+        if response.get('disconnected'):
+            raise ConnectionError(response['message'])
+        # Un servidor antiguo no entiende el saludo: seguir sin compresión
+        self.compression = response.get('compression') if response['status'] == 'success' else None
+    
+    def start_session(self, message):
+        """Cambiar al cifrado que eligió el servidor en su respuesta al saludo"""
+        if 'random' not in message:
+            return  # Servidor antiguo: seguir con Fernet
+        algorithm = message['cipher']
+        salt = self.session_random + base64.b64decode(message['random'])
+        self.store_ticket(message, resumption_secret(self.secret, salt), algorithm, message.get('compression'))
+        with self.send_lock:
+            self.cipher = derive_session_cipher(self.key, algorithm, self.secret, salt, is_server=False)
+    
+    def store_ticket(self, message, secret, cipher, compression):
+        """Guardar el ticket de la respuesta junto con lo necesario para usarlo"""
+        self.session_ticket = {
+            'ticket': message['ticket'],
+            'secret': secret,
+            'cipher': cipher,
+            'compression': compression,
+            'expires': time.time() + message['ticket_lifetime'],
+        }
+    
+    def resume(self, ticket):
+        """Reanudar la sesión con un ticket sin esperar respuesta (0-RTT)
+        
+        El mensaje 'resume' va con Fernet y todo lo que le sigue ya va con las
+        claves derivadas del secreto del ticket y de un valor aleatorio nuevo,
+        así que las solicitudes salen sin esperar ningún viaje de ida y vuelta.
+        La respuesta llega con Fernet y trae el valor aleatorio del servidor,
+        del que depende la clave de lo que el servidor envíe después.
+        El ticket solo vale una vez: el servidor envía otro en su respuesta.
+        Si lo rechaza, cierra la conexión y el próximo intento hará el saludo.
+        """
+        self.session_ticket = None
+        self.session_random = os.urandom(SESSION_RANDOM_SIZE)
+        self.compression = ticket['compression']
+        self.resumed_ticket = ticket
+        self.resuming = True
+        request = {
+            'type': 'resume',
+            'ticket': ticket['ticket'],
+            'random': base64.b64encode(self.session_random).decode(),
+        }
+        with self.send_lock:
+            send_frame(self.socket, self.cipher.encrypt(encode_message(request)))
+            self.cipher = derive_session_cipher(self.key, ticket['cipher'], ticket['secret'],
+                                                self.session_random, is_server=False)
+    
+    def heartbeat_loop(self, sock):
+        """Enviar pings periódicos mientras dure la conexión de sock
+        
+        Si un ping no obtiene respuesta y además no llega nada del servidor en
+        heartbeat_timeout, se da la conexión por muerta y se corta: el lector
+        lo nota y empieza la reconexión sin esperar a los timeouts de TCP.
+        """
+        while True:
+            time.sleep(self.heartbeat_interval)
+            if self.closing or not self.connected or self.socket is not sock:
+                return
+            if self.ping():
+                continue
+            idle = time.monotonic() - self.last_received
+            if idle >= self.heartbeat_timeout and self.socket is sock:
+                print(f"Sin noticias del servidor en {idle:.0f}s: conexión perdida")
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+    
+    def ping(self):
+        """Enviar un ping y registrar RTT, jitter y desfase de reloj (False si no hay pong)"""
+        stream_id = None
+        try:
+            stream_id, responses = self.open_stream()
+            sent_at = time.time()
+            start = time.monotonic()
+            self.send_message({'type': 'ping', 'stream_id': stream_id})
+            response = responses.get(timeout=self.heartbeat_timeout)
+            rtt = time.monotonic() - start
+        except (queue.Empty, OSError):
+            response = {'status': 'error'}
+        finally:
+            if stream_id is not None:
+                self.pending.pop(stream_id, None)
+        
+        if response['status'] != 'pong':
+            with self.latency_lock:
+                self.pings_lost += 1
+            return False
+        
+        # Como en NTP: el servidor respondió, de media, a mitad del viaje
+        offset = response['server_time'] - (sent_at + rtt / 2)
+        with self.latency_lock:
+            if self.latency_samples:
+                # Jitter como en RTP (RFC 3550): media móvil de la variación del RTT
+                self.jitter += (abs(rtt - self.latency_samples[-1][0]) - self.jitter) / 16
+            self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+            self.latency_samples.append((rtt, offset))
+        return True
+    
+    def latency_stats(self):
+        """Resumen de la latencia medida por el latido (tiempos en milisegundos)
+        
+        El desfase de reloj (servidor menos cliente) se toma de la muestra con
+        menor RTT, que es la que menos error puede tener. El histograma cuenta
+        las muestras de la ventana por límite superior del intervalo.
+        """
+        with self.latency_lock:
+            samples = list(self.latency_samples)
+            srtt, jitter, lost = self.srtt, self.jitter, self.pings_lost
+        
+        rtts = sorted(rtt * 1000 for rtt, _ in samples)
+        histogram = {str(bound): 0 for bound in LATENCY_BUCKETS_MS}
+        histogram['inf'] = 0
+        for rtt in rtts:
+            bucket = next((str(bound) for bound in LATENCY_BUCKETS_MS if rtt <= bound), 'inf')
+            histogram[bucket] += 1
+        
+        return {
+            'samples': len(samples),
+            'lost': lost,
+            'rtt_ms': samples[-1][0] * 1000 if samples else None,
+            'srtt_ms': srtt * 1000 if srtt is not None else None,
+            'min_ms': rtts[0] if rtts else None,
+            'p50_ms': percentile(rtts, 0.50),
+            'p95_ms': percentile(rtts, 0.95),
+            'p99_ms': percentile(rtts, 0.99),
+            'jitter_ms': jitter * 1000,
+            'clock_offset_ms': min(samples)[1] * 1000 if samples else None,
+            'histogram': histogram,
+        }
+    
+    def open_stream(self):
+        """Reservar un stream_id y la cola en la que llegarán sus respuestas"""
+        stream_id = next(self.stream_ids)
+        responses = queue.Queue()
+        self.pending[stream_id] = responses
+        
+        # El lector marca la desconexión antes de avisar a las colas pendientes,
+        # así que si aquí seguimos conectados la cola recibirá el aviso
+        if not self.connected:
+            self.pending.pop(stream_id, None)
+            raise ConnectionError('No conectado al servidor')
+        return stream_id, responses
+    
+    def reader_loop(self):
+        """Recibir mensajes del servidor y repartirlos según su stream_id"""
+        error = 'Desconectado del servidor'
+        buffer = bytearray(FRAME_BUFFER_SIZE)
+        try:
+            while self.connected:
+                message = self.receive_message(buffer)
+                self.last_received = time.monotonic()
+                if message.get('type') == 'hello' and message['status'] == 'success':
+                    self.start_session(message)
+                elif message.get('type') == 'resume':
+                    ticket = self.resumed_ticket
+                    salt = self.session_random + base64.b64decode(message['random'])
+                    if isinstance(self.cipher, AEADCipher):
+                        self.cipher.rekey_recv(derive_server_key(ticket['secret'], salt))
+                    self.resuming = False
+                    self.store_ticket(message, resumption_secret(ticket['secret'], salt),
+                                      ticket['cipher'], ticket['compression'])
+                stream_id = message.get('stream_id')
+                window = self.uploads.get(stream_id)
+                if window is not None:
+                    if message['status'] == 'window':
+                        window.grant(message['size'])
+                        continue
+                    if message['status'] in ('end', 'error'):
+                        window.close()
+                responses = self.pending.get(stream_id)
+                if responses is not None:
+                    responses.put(message)
+        except Exception as e:
+            error = str(e)
+            if self.resuming:
+                error = 'El servidor rechazó el ticket de sesión'
+                print(error)
+            elif self.connected:
+                print(f"Error recibiendo del servidor: {e}")
+        
+        self.resuming = False
+        self.connected = False
+        # Solo se reconecta si la conexión llegó a estar lista: un fallo
+        # durante el saludo lo gestiona quien llamó a connect_to_server
+        # (reconnecting se marca antes de limpiar ready para que ninguna
+        # solicitud vea la conexión caída sin reconexión en marcha)
+        reconnect = False
+        with self.reconnect_lock:
+            if self.ready.is_set() and self.auto_reconnect and not self.closing:
+                reconnect = not self.reconnecting
+                self.reconnecting = True
+            self.ready.clear()
+        if reconnect:
+            reconnect_thread = threading.Thread(target=self.reconnect_loop)
+            reconnect_thread.daemon = True
+            reconnect_thread.start()
+        for window in list(self.uploads.values()):
+            window.close()
+        for responses in list(self.pending.values()):
+            responses.put({'status': 'error', 'message': error, 'disconnected': True})
+    
+    def send_message(self, request, compressible=True):
+        """Cifrar y enviar una solicitud (el campo 'data' va como cuerpo binario)"""
+        metadata = {key: value for key, value in request.items() if key != 'data'}
+        body = request.get('data') or b''
+        if isinstance(body, str):
+            body = body.encode()
+        compression = None
+        if compressible and is_compressible(request.get('headers', {})):
+            compression = self.compression
+        self.send_plaintext(encode_message(metadata, body, compression))
+    
+    def send_plaintext(self, plaintext, stream_id=None):
+        """Cifrar y enviar un mensaje ya empaquetado (stream_id solo lo usa ServerPool)"""
+        # Cifrar dentro del cerrojo: los cifrados AEAD numeran los mensajes en orden de envío
+        with self.send_lock:
+            send_encrypted_frame(self.socket, self.cipher, plaintext, self.send_buffer)
+    
+    def receive_message(self, buffer=None):
+        """Recibir y descifrar un mensaje del servidor (el cuerpo queda en 'content')
+        
+        buffer es donde se lee la trama cifrada y se puede reutilizar en cada
+        llamada: lo descifrado es siempre un objeto nuevo. El cuerpo de los
+        mensajes 'data' de los túneles es una vista de él; el resto, bytes.
+        """
+        encrypted_message = recv_frame(self.socket, buffer)
+        if encrypted_message is None:
+            raise ConnectionError("El servidor cerró la conexión")
+        cipher = self.cipher
+        if self.resuming:
+            cipher = Fernet(self.key)  # La respuesta a 'resume' aún va con la clave compartida
+        if not isinstance(cipher, AEADCipher):
+            encrypted_message = bytes(encrypted_message)  # Fernet solo acepta bytes
+        message, body = decode_message(cipher.decrypt(encrypted_message))
+        message['content'] = body if message.get('status') == 'data' else bytes(body)
+        return message
+    
+    def stream_request(self, request):
+        """Enviar solicitud y generar los mensajes de la respuesta según llegan
+        
+        El primer mensaje es la cabecera de la respuesta; los mensajes 'chunk'
+        traen el fragmento del cuerpo en bytes en 'content'. Si la conexión
+        se cae antes de la cabecera, las solicitudes idempotentes se repiten
+        tras la reconexión; a mitad del cuerpo ya no se puede.
+        """
+        for attempt in range(self.max_replays + 1):
+            try:
+                self.wait_until_connected()
+            except ConnectionError as e:
+                yield {'status': 'error', 'message': str(e)}
+                return
             
-            # Recibir respuesta
-            encrypted_response = self.socket.recv(65536)  # 64KB max
-            decrypted_response = self.cipher.decrypt(encrypted_response)
+            started = False
+            stream = self.stream_once(request)
+            for message in stream:
+                if (message.get('disconnected') and not started
+                        and attempt < self.max_replays and self.is_replayable(request)):
+                    stream.close()
+                    break
+                started = True
+                yield message
+            else:
+                return
+    
+    def stream_once(self, request):
+        """Enviar una solicitud por la conexión actual y generar sus mensajes
+        
+        Con 'upload' el cuerpo es un RequestBody y se envía por partes detrás
+        de la solicitud, antes de esperar la respuesta.
+        """
+        finished = False
+        stream_id = None
+        sock, reader = self.socket, self.reader_thread
+        try:
+            stream_id, responses = self.open_stream()
+            if request.get('upload'):
+                window = self.uploads[stream_id] = UploadWindow()
+                self.send_message(dict(request, stream_id=stream_id, data=None))
+                error = self.send_upload(stream_id, request['data'], window)
+                if error is not None:
+                    yield {'status': 'error', 'message': error}
+                    return
+            else:
+                self.send_message(dict(request, stream_id=stream_id))
             
-            return json.loads(decrypted_response.decode())
+            credit = DownloadCredit(self.send_message, stream_id) if request.get('window') else None
+            while not finished:
+                message = responses.get()
+                finished = message['status'] in ('end', 'error')
+                yield message
+                if message['status'] == 'chunk' and credit is not None and not finished:
+                    credit.consumed(len(message['content']))
         
         except Exception as e:
             print(f"Error enviando solicitud: {e}")
-            self.connected = False
-            return {'status': 'error', 'message': str(e)}
+            finished = True
+            if isinstance(e, OSError):
+                self.wait_reader_exit(sock, reader)
+            yield {'status': 'error', 'message': str(e), 'disconnected': True}
+        
+        finally:
+            if stream_id is not None:
+                self.pending.pop(stream_id, None)
+                self.uploads.pop(stream_id, None)
+                # Si se abandona la respuesta a medias, avisar al servidor
+                # para que deje de enviarla
+                if not finished and self.connected:
+                    try:
+                        self.send_message({'type': 'cancel', 'stream_id': stream_id})
+                    except Exception:
+                        pass
+    
+    def send_upload(self, stream_id, body, window):
+        """Enviar un cuerpo por partes en mensajes 'data' terminados con 'close'
+        
+        Como en los túneles, los metadatos van al principio de un único buffer
+        y cada parte se lee justo detrás. Devuelve el error si no se pudo leer
+        el cuerpo del navegador; si es el servidor el que da la solicitud por
+        terminada se deja de enviar y su respuesta llega como siempre.
+        """
+        prefix = pack_metadata({'type': 'data', 'stream_id': stream_id})
+        buffer = bytearray(len(prefix) + TUNNEL_BUFFER_SIZE)
+        buffer[:len(prefix)] = prefix
+        view = memoryview(buffer)
+        chunk = view[len(prefix):]
+        while True:
+            try:
+                received = body.readinto(chunk)
+            except (OSError, ValueError) as e:
+                return f"Error leyendo el cuerpo de la solicitud: {e}"
+            if not received:
+                break
+            if not window.take(received):
+                return None
+            self.send_plaintext(view[:len(prefix) + received])
+        self.send_message({'type': 'close', 'stream_id': stream_id})
+        return None
     
     def test_connection(self):
         """Probar conexión con el servidor"""
@@ -80,61 +1151,364 @@ class VPNClient:
         
         return self.send_request(request)
     
+    def web_request_stream(self, url, method='GET', headers=None, data=None):
+        """Hacer solicitud web recibiendo el cuerpo por fragmentos
+        
+        data puede ser un RequestBody: entonces el cuerpo se sube por partes
+        según se lee, en vez de ir entero dentro de la solicitud. El servidor
+        no envía más de DOWNLOAD_WINDOW bytes por delante de lo ya leído.
+        """
+        request = {
+            'type': 'web_request',
+            'url': url,
+            'method': method,
+            'headers': headers or {},
+            'data': data,
+            'stream': True,
+            'window': DOWNLOAD_WINDOW
+        }
+        if isinstance(data, RequestBody):
+            request['upload'] = True
+        
+        return self.stream_request(request)
+    
+    def benchmark(self, size=1024 * 1024, direction='download', streams=4, duration=10,
+                  warmup=2, pattern='random'):
+        """Medir el rendimiento real del túnel con solicitudes speed_test
+        
+        streams hilos repiten solicitudes de size bytes (bajada, subida o
+        ambas) durante warmup segundos sin medir y después durante duration
+        segundos. Cada solicitud recorre el camino completo: compresión,
+        cifrado, trama y vuelta. pattern 'random' manda datos incompresibles
+        y 'text' datos muy comprimibles.
+        
+        Devuelve solicitudes, errores, bytes, MB/s sostenidos y latencias
+        p50/p95/p99 en milisegundos.
+        """
+        request = {'type': 'speed_test', 'pattern': pattern, 'size': 0}
+        if direction in ('download', 'both'):
+            request['size'] = size
+        if direction in ('upload', 'both'):
+            request['data'] = os.urandom(size) if pattern == 'random' else b'x' * size
+        
+        start = time.monotonic()
+        measure_from = start + warmup
+        deadline = measure_from + duration
+        latencies = []
+        totals = {'bytes': 0, 'errors': 0}
+        lock = threading.Lock()
+        
+        def worker():
+            while True:
+                began = time.monotonic()
+                if began >= deadline:
+                    return
+                response = self.send_request(request)
+                elapsed = time.monotonic() - began
+                if began < measure_from:
+                    continue  # Calentamiento: conexiones, pool y cachés
+                with lock:
+                    if response['status'] != 'success':
+                        totals['errors'] += 1
+                        continue
+                    latencies.append(elapsed)
+                    totals['bytes'] += len(response['content']) + response.get('received', 0)
+        
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(streams)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        
+        measured = max(time.monotonic() - measure_from, 1e-9)
+        latencies.sort()
+        return {
+            'size': size,
+            'direction': direction,
+            'streams': streams,
+            'pattern': pattern,
+            'duration': measured,
+            'requests': len(latencies),
+            'errors': totals['errors'],
+            'bytes': totals['bytes'],
+            'requests_per_s': len(latencies) / measured,
+            'mb_per_s': totals['bytes'] / measured / 1024 / 1024,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+    
+    def open_tunnel(self, host, port):
+        """Abrir un túnel TCP hacia host:port a través del servidor VPN (para CONNECT)
+        
+        Devuelve el stream_id del túnel y la cola donde llegarán los mensajes
+        'data' del destino, terminando con 'end' o 'error'. Quien los lee
+        devuelve el crédito de bajada con un DownloadCredit y quien sube espera
+        el de subida con take_upload_credit.
+        """
+        self.wait_until_connected()
+        stream_id, responses = self.open_stream()
+        self.uploads[stream_id] = UploadWindow()
+        try:
+            self.send_message({'type': 'connect', 'host': host, 'port': port, 'stream_id': stream_id,
+                               'upload': True, 'window': DOWNLOAD_WINDOW})
+            response = responses.get()
+            if response['status'] != 'success':
+                raise ConnectionError(response.get('message', 'No se pudo abrir el túnel'))
+            return stream_id, responses
+        except Exception:
+            self.pending.pop(stream_id, None)
+            self.uploads.pop(stream_id, None)
+            raise
+    
+    def take_upload_credit(self, stream_id, size):
+        """Esperar crédito para subir size bytes por un túnel (False si ya terminó)"""
+        window = self.uploads.get(stream_id)
+        return window is not None and window.take(size)
+    
+    def close_tunnel(self, stream_id, finished=True):
+        """Liberar un túnel; si el destino no lo cerró aún, pedir al servidor que lo cierre"""
+        self.pending.pop(stream_id, None)
+        window = self.uploads.pop(stream_id, None)
+        if window is not None:
+            window.close()
+        if not finished and self.connected:
+            try:
+                self.send_message({'type': 'cancel', 'stream_id': stream_id})
+            except Exception:
+                pass
+    
     def start_proxy_server(self):
         """Iniciar servidor proxy local"""
         class ProxyHandler(BaseHTTPRequestHandler):
+            # HTTP/1.1 para mantener viva la conexión con el navegador entre solicitudes
+            protocol_version = 'HTTP/1.1'
+            timeout = 30  # Cerrar conexiones keep-alive inactivas
+            # Sin Nagle: la cabecera y el cuerpo salen en escrituras separadas y
+            # el segundo esperaría al ACK retardado del navegador (~40 ms)
+            disable_nagle_algorithm = True
+            detached = False  # La conexión pasó a los hilos de un túnel
+            
             def __init__(self, *args, vpn_client=None, **kwargs):
                 self.vpn_client = vpn_client
                 super().__init__(*args, **kwargs)
             
+            def handle(self):
+                """Atender una sola solicitud: entre una y otra la conexión espera fuera del pool"""
+                self.handle_one_request()
+            
+            def finish(self):
+                pass  # PooledHTTPServer decide si la conexión se cierra, espera otra solicitud o es un túnel
+            
+            def close(self):
+                """Cerrar la conexión con el navegador
+                
+                Primero se corta el socket: cerrar rfile esperaría a que termine
+                una lectura en curso en otro hilo (la del túnel).
+                """
+                try:
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                super().finish()
+                self.server.close_request(self.connection)
+            
             def do_GET(self):
                 self.handle_request('GET')
             
             def do_POST(self):
                 self.handle_request('POST')
             
+            def do_PUT(self):
+                self.handle_request('PUT')
+            
+            def do_DELETE(self):
+                self.handle_request('DELETE')
+            
+            def do_HEAD(self):
+                self.handle_request('HEAD')
+            
+            def do_PATCH(self):
+                self.handle_request('PATCH')
+            
+            def do_OPTIONS(self):
+                self.handle_request('OPTIONS')
+            
+            def __getattr__(self, name):
+                # BaseHTTPRequestHandler busca do_<MÉTODO>: el resto de métodos
+                # (TRACE, los de WebDAV como PROPFIND o MKCOL...) se reenvían igual
+                method = name[3:]
+                if name.startswith('do_') and method.isupper() and method.replace('-', '').isalpha():
+                    return lambda: self.handle_request(method)
+                raise AttributeError(name)
+            
+            def do_CONNECT(self):
+                """Túnel HTTPS: reenviar bytes en bruto entre el navegador y host:port"""
+                self.close_connection = True
+                host, _, port = self.path.rpartition(':')
+                
+                if not self.server.tunnel_slots.acquire(blocking=False):
+                    self.send_error_text("Demasiados túneles abiertos", 503)
+                    return
+                try:
+                    stream_id, responses = self.vpn_client.open_tunnel(host.strip('[]'), int(port))
+                except Exception as e:
+                    self.server.tunnel_slots.release()
+                    self.send_error_text(f"Error VPN: {e}", 502)
+                    return
+                
+                self.send_response(200, 'Connection Established')
+                self.end_headers()
+                
+                # El túnel sigue en sus propios hilos y el del pool queda libre.
+                # Puede estar inactivo mucho tiempo (websockets, long polling)
+                self.detached = True
+                self.connection.settimeout(None)
+                upload_thread = threading.Thread(target=self.relay_to_tunnel, args=(stream_id,))
+                download_thread = threading.Thread(target=self.relay_from_tunnel, args=(stream_id, responses))
+                for relay_thread in (upload_thread, download_thread):
+                    relay_thread.daemon = True
+                    relay_thread.start()
+            
+            def relay_from_tunnel(self, stream_id, responses):
+                """Escribir al navegador lo que llega del destino y cerrar todo al terminar"""
+                finished = False
+                credit = DownloadCredit(self.vpn_client.send_message, stream_id)
+                try:
+                    while not finished:
+                        message = responses.get()
+                        if message['status'] == 'data':
+                            self.connection.sendall(message['content'])
+                            credit.consumed(len(message['content']))
+                        else:
+                            finished = True
+                except OSError:
+                    pass
+                finally:
+                    self.vpn_client.close_tunnel(stream_id, finished)
+                    self.close()
+                    self.server.tunnel_slots.release()
+            
+            def relay_to_tunnel(self, stream_id):
+                """Enviar por el túnel lo que escribe el navegador, reutilizando un único buffer
+                
+                Los metadatos de los mensajes 'data' van al principio del buffer
+                y cada lectura se escribe justo detrás: el mensaje se cifra tal
+                cual, sin copiarlo ni recodificarlo.
+                """
+                prefix = pack_metadata({'type': 'data', 'stream_id': stream_id})
+                buffer = bytearray(len(prefix) + TUNNEL_BUFFER_SIZE)
+                buffer[:len(prefix)] = prefix
+                view = memoryview(buffer)
+                body = view[len(prefix):]
+                try:
+                    while True:
+                        # rfile puede tener ya datos en su buffer: leer siempre a través de él
+                        received = self.rfile.readinto1(body)
+                        if not received:
+                            break
+                        if not self.vpn_client.take_upload_credit(stream_id, received):
+                            return
+                        self.vpn_client.send_plaintext(view[:len(prefix) + received], stream_id)
+                    self.vpn_client.send_message({'type': 'close', 'stream_id': stream_id})
+                except (OSError, ValueError):
+                    pass
+            
+            def send_error_text(self, text, code=500):
+                """Enviar un error (500 si no se indica otro) en texto plano con longitud conocida"""
+                body = text.encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
             def handle_request(self, method):
+                response_stream = None
+                data = None
+                headers_sent = False
                 try:
                     # Obtener URL completa
                     url = self.path if self.path.startswith('http') else f"http://{self.headers.get('Host', '')}{self.path}"
                     
                     # Obtener headers
-                    headers = dict(self.headers)
+                    headers = {header: value for header, value in self.headers.items()
+                               if header.lower() not in HOP_BY_HOP_HEADERS}
                     
-                    # Obtener datos POST si es necesario
-                    data = None
-                    if method == 'POST':
+                    # Leer siempre el cuerpo para no desincronizar la conexión keep-alive:
+                    # los pequeños enteros; los grandes o en chunked, por partes
+                    # mientras se suben, sin tenerlos enteros en memoria
+                    if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+                        data = RequestBody(self.rfile)
+                    else:
                         content_length = int(self.headers.get('Content-Length', 0))
-                        if content_length > 0:
+                        if content_length > UPLOAD_INLINE_LIMIT:
+                            data = RequestBody(self.rfile, content_length)
+                        elif content_length > 0:
                             data = self.rfile.read(content_length)
                     
                     # Hacer solicitud a través de VPN
-                    response = self.vpn_client.web_request(url, method, headers, data)
+                    response_stream = self.vpn_client.web_request_stream(url, method, headers, data)
+                    response = next(response_stream)
                     
                     if response['status'] == 'success':
                         # Enviar respuesta exitosa
-                        self.send_response(response['status_code'])
+                        status_code = response['status_code']
+                        self.send_response(status_code)
                         
                         # Enviar headers
+                        response_headers = {header.lower() for header in response['headers']}
                         for header, value in response['headers'].items():
-                            if header.lower() not in ['transfer-encoding', 'content-encoding']:
-                                self.send_header(header, value)
+                            if header.lower() not in HOP_BY_HOP_HEADERS:
+                                # Set-Cookie repetido llega como lista: una cabecera por valor
+                                for item in value if isinstance(value, list) else [value]:
+                                    self.send_header(header, item)
+                        
+                        # Sin Content-Length se usa chunked para que el navegador
+                        # sepa dónde acaba la respuesta sin cerrar la conexión
+                        has_body = method != 'HEAD' and status_code not in (204, 304) and status_code >= 200
+                        chunked = has_body and 'content-length' not in response_headers
+                        if chunked:
+                            self.send_header('Transfer-Encoding', 'chunked')
                         
                         self.end_headers()
-                        self.wfile.write(response['content'].encode('utf-8'))
+                        headers_sent = True
+                        
+                        # Escribir cada fragmento en cuanto llega
+                        for message in response_stream:
+                            if message['status'] == 'chunk':
+                                if chunked:
+                                    self.wfile.write(f"{len(message['content']):X}\r\n".encode())
+                                    self.wfile.write(message['content'])
+                                    self.wfile.write(b"\r\n")
+                                else:
+                                    self.wfile.write(message['content'])
+                                self.wfile.flush()
+                            elif message['status'] == 'error':
+                                # Las cabeceras ya se enviaron: solo queda cortar la conexión
+                                print(f"Error VPN a mitad de respuesta: {message.get('message')}")
+                                self.close_connection = True
+                                break
+                        else:
+                            if chunked:
+                                self.wfile.write(b"0\r\n\r\n")
                     
                     else:
                         # Enviar error
-                        self.send_response(500)
-                        self.send_header('Content-Type', 'text/plain')
-                        self.end_headers()
-                        self.wfile.write(f"Error VPN: {response.get('message', 'Unknown error')}".encode())
+                        self.send_error_text(f"Error VPN: {response.get('message', 'Unknown error')}")
                 
                 except Exception as e:
-                    self.send_response(500)
-                    self.send_header('Content-Type', 'text/plain')
-                    self.end_headers()
-                    self.wfile.write(f"Error: {str(e)}".encode())
+                    if headers_sent:
+                        self.close_connection = True
+                    else:
+                        self.send_error_text(f"Error: {str(e)}")
+                
+                finally:
+                    if response_stream is not None:
+                        response_stream.close()
+                    if isinstance(data, RequestBody) and not data.finished:
+                        # Lo que queda del cuerpo no es la siguiente solicitud
+                        self.close_connection = True
             
             def log_message(self, format, *args):
                 print(f"Proxy: {format % args}")
@@ -144,7 +1518,9 @@ class VPNClient:
             return ProxyHandler(*args, vpn_client=self, **kwargs)
         
         try:
-            server = HTTPServer(('127.0.0.1', self.proxy_port), handler_factory)
+            server = PooledHTTPServer(('127.0.0.1', self.proxy_port), handler_factory,
+                                      max_workers=self.proxy_workers,
+                                      idle_timeout=ProxyHandler.timeout)
             print(f"Servidor proxy iniciado en http://127.0.0.1:{self.proxy_port}")
             print("Configura tu navegador para usar este proxy HTTP")
             print("Presiona Ctrl+C para detener")
@@ -156,11 +1532,205 @@ class VPNClient:
     
     def disconnect(self):
         """Desconectar del servidor VPN"""
+        self.closing = True
+        self.ready.clear()
+        self.connected = False
         if self.socket:
+            try:
+                # Despertar al hilo lector bloqueado en recv
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.socket.close()
-        self.connected = False
+        # Esperar al lector para que no lea del socket de una conexión posterior
+        if self.reader_thread is not None and self.reader_thread is not threading.current_thread():
+            self.reader_thread.join(timeout=5)
         print("Desconectado del servidor VPN")
 
+class ServerPool:
+    """Varios servidores VPN usados a la vez como si fueran uno
+    
+    Mantiene una conexión (un VPNClient) con cada servidor. Cada solicitud va
+    al servidor sano con menor latencia esperada: su RTT suavizado (el del
+    latido) multiplicado por las solicitudes y túneles que ya tiene en curso.
+    Si un servidor cae, las solicitudes idempotentes que se quedaron sin
+    respuesta se repiten enseguida en otro en lugar de esperar a que ese
+    reconecte; él sigue reconectando por su cuenta y vuelve a recibir
+    tráfico en cuanto está listo.
+    
+    Ofrece la misma interfaz que VPNClient, así que el proxy local y el test
+    de velocidad funcionan igual con uno o con varios servidores.
+    """
+    
+    def __init__(self, servers, key, ciphers=None, compressions=None):
+        self.clients = [VPNClient(host, port, key, ciphers, compressions) for host, port in servers]
+        # Los stream_id son únicos en todo el pool para saber a qué servidor va cada túnel
+        stream_ids = itertools.count(1)
+        for client in self.clients:
+            client.stream_ids = stream_ids
+        self.lock = threading.Lock()
+        self.active = {client: 0 for client in self.clients}  # Solicitudes y túneles en curso
+        self.tunnels = {}  # stream_id -> VPNClient del túnel
+        self.proxy_port = 8888
+        self.proxy_workers = 32
+        self.max_replays = 3
+        self.reconnect_timeout = 60  # Tiempo máximo esperando a que haya algún servidor listo
+        self.closing = False
+    
+    # Las solicitudes, el proxy y el test de velocidad son los de VPNClient:
+    # solo cambia a qué servidor va cada solicitud
+    test_connection = VPNClient.test_connection
+    web_request = VPNClient.web_request
+    web_request_stream = VPNClient.web_request_stream
+    benchmark = VPNClient.benchmark
+    start_proxy_server = VPNClient.start_proxy_server
+    
+    def connect_to_server(self):
+        """Conectar con todos los servidores (True si al menos uno responde)
+        
+        Los que fallan siguen intentándolo en segundo plano.
+        """
+        self.closing = False
+        for client in self.clients:
+            if client.connect_to_server():
+                client.ping()  # Primera medida de RTT para poder elegir desde ya
+            else:
+                self.start_reconnect(client)
+        return any(client.ready.is_set() for client in self.clients)
+    
+    def start_reconnect(self, client):
+        with client.reconnect_lock:
+            if client.reconnecting:
+                return
+            client.reconnecting = True
+        reconnect_thread = threading.Thread(target=client.reconnect_loop)
+        reconnect_thread.daemon = True
+        reconnect_thread.start()
+    
+    def expected_latency(self, client):
+        rtt = client.srtt if client.srtt is not None else UNMEASURED_RTT
+        return rtt * (1 + self.active[client])
+    
+    def select(self, failed=()):
+        """Elegir el servidor listo con menor latencia esperada (espera si no hay ninguno)
+        
+        Los de failed, que ya fallaron con esta solicitud, solo se eligen si no
+        queda otro: tras reanudar con 0-RTT un servidor parece listo antes de
+        que haya respondido nada.
+        """
+        deadline = time.monotonic() + self.reconnect_timeout
+        while not self.closing:
+            ready = [client for client in self.clients if client.ready.is_set()]
+            ready = [client for client in ready if client not in failed] or ready
+            if ready:
+                with self.lock:
+                    return min(ready, key=self.expected_latency)
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+        raise ConnectionError('Ningún servidor VPN disponible')
+    
+    @contextlib.contextmanager
+    def track(self, client):
+        """Contar una solicitud en curso en client mientras dure el bloque"""
+        with self.lock:
+            self.active[client] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[client] -= 1
+    
+    def send_request(self, request):
+        """Enviar una solicitud al mejor servidor; si cae sin responder, repetirla en otro"""
+        failed = set()
+        for attempt in range(self.max_replays + 1):
+            try:
+                client = self.select(failed)
+            except ConnectionError as e:
+                return {'status': 'error', 'message': str(e)}
+            with self.track(client):
+                response = client.request_once(request)
+            if not (response.get('disconnected') and client.is_replayable(request)):
+                break
+            failed.add(client)
+        return response
+    
+    def stream_request(self, request):
+        """Como VPNClient.stream_request, pero cada reintento puede ir a otro servidor"""
+        failed = set()
+        for attempt in range(self.max_replays + 1):
+            try:
+                client = self.select(failed)
+            except ConnectionError as e:
+                yield {'status': 'error', 'message': str(e)}
+                return
+            failed.add(client)
+            
+            with self.track(client):
+                started = False
+                stream = client.stream_once(request)
+                for message in stream:
+                    if (message.get('disconnected') and not started
+                            and attempt < self.max_replays and client.is_replayable(request)):
+                        stream.close()
+                        break
+                    started = True
+                    yield message
+                else:
+                    return
+    
+    def open_tunnel(self, host, port):
+        """Abrir un túnel CONNECT en el mejor servidor y recordar dónde está"""
+        client = self.select()
+        stream_id, responses = client.open_tunnel(host, port)
+        with self.lock:
+            self.tunnels[stream_id] = client
+            self.active[client] += 1
+        return stream_id, responses
+    
+    def send_message(self, request, compressible=True):
+        """Enviar un mensaje de un túnel por la conexión del servidor que lo abrió"""
+        client = self.tunnels.get(request['stream_id'])
+        if client is None:
+            raise ConnectionError('Túnel cerrado')
+        client.send_message(request, compressible)
+    
+    def take_upload_credit(self, stream_id, size):
+        client = self.tunnels.get(stream_id)
+        return client is not None and client.take_upload_credit(stream_id, size)
+    
+    def send_plaintext(self, plaintext, stream_id=None):
+        """Como send_message, para mensajes de un túnel ya empaquetados"""
+        client = self.tunnels.get(stream_id)
+        if client is None:
+            raise ConnectionError('Túnel cerrado')
+        client.send_plaintext(plaintext)
+    
+    def close_tunnel(self, stream_id, finished=True):
+        with self.lock:
+            client = self.tunnels.pop(stream_id, None)
+            if client is not None:
+                self.active[client] -= 1
+        if client is not None:
+            client.close_tunnel(stream_id, finished)
+    
+    def server_stats(self):
+        """Estado de cada servidor: listo, solicitudes en curso y latencia"""
+        with self.lock:
+            active = dict(self.active)
+        return [{
+            'server': f"{client.server_host}:{client.server_port}",
+            'ready': client.ready.is_set(),
+            'active': active[client],
+            'latency': client.latency_stats(),
+        } for client in self.clients]
+    
+    def disconnect(self):
+        self.closing = True
+        for client in self.clients:
+            client.disconnect()
+
 def load_key_from_file(filename='vpn_key.txt'):
     """Cargar clave desde archivo"""
     try:
@@ -177,8 +1747,8 @@ def main():
     print()
     
     # Obtener configuración
-    server_host = input("IP del servidor VPN: ").strip()
-    if not server_host:
+    server_hosts = input("IP del servidor VPN (varios separados por comas, con :puerto opcional): ").strip()
+    if not server_hosts:
         print("Error: Debes especificar la IP del servidor")
         return
     
@@ -187,6 +1757,15 @@ def main():
     except ValueError:
         server_port = 8080
     
+    servers = []
+    for entry in server_hosts.split(','):
+        entry = entry.strip()
+        host, _, port = entry.rpartition(':')
+        # Sin puerto (o IPv6 sin corchetes): usar el puerto por defecto
+        if not host or not port.isdigit() or (':' in host and not host.endswith(']')):
+            host, port = entry, server_port
+        servers.append((host.strip('[]'), int(port)))
+    
     # Cargar clave
     print("\nCargando clave de cifrado...")
     key_input = input("Pega la clave aquí (o presiona Enter para cargar desde archivo): ").strip()
@@ -202,8 +1781,19 @@ def main():
         if not key:
             return
     
-    # Crear cliente VPN
-    client = VPNClient(server_host, server_port, key)
+    print("\nCifrado de la conexión:")
+    print("1. AES-256-GCM (rápido con AES-NI)")
+    print("2. ChaCha20-Poly1305 (rápido sin aceleración AES)")
+    print("3. Fernet (compatible con servidores antiguos)")
+    cipher_choice = input("Selecciona cifrado (1): ").strip() or "1"
+    preferred = {'1': 'aes-256-gcm', '2': 'chacha20-poly1305', '3': 'fernet'}.get(cipher_choice, 'aes-256-gcm')
+    ciphers = [preferred] + [cipher for cipher in available_ciphers() if cipher != preferred]
+    
+    # Crear cliente VPN (con varios servidores, un pool que elige el más rápido)
+    if len(servers) > 1:
+        client = ServerPool(servers, key, ciphers)
+    else:
+        client = VPNClient(servers[0][0], servers[0][1], key, ciphers)
     
     try:
         # Conectar al servidor
@@ -233,6 +1823,15 @@ def main():
             print("- Tipo: HTTP")
             print("\nPresiona Enter para detener...")
             input()
+            
+            if isinstance(client, ServerPool):
+                latencies = [(stats['server'], stats['latency']) for stats in client.server_stats()]
+            else:
+                latencies = [(f"{client.server_host}:{client.server_port}", client.latency_stats())]
+            for server, latency in latencies:
+                if latency['samples']:
+                    print(f"Latencia {server}: p50 {latency['p50_ms']:.1f} ms, p95 {latency['p95_ms']:.1f} ms, "
+                          f"jitter {latency['jitter_ms']:.1f} ms, {latency['lost']} pings perdidos")
         
         elif choice == "2":
             url = input("URL a solicitar: ").strip()
@@ -241,18 +1840,22 @@ def main():
                 print(f"\nRespuesta: {response}")
         
         elif choice == "3":
-            print("Ejecutando test de velocidad...")
-            start_time = time.time()
-            response = client.send_request({'type': 'speed_test'})
-            end_time = time.time()
+            try:
+                size = int(float(input("Tamaño de cada solicitud en KB (1024): ") or "1024") * 1024)
+                streams = int(input("Streams en paralelo (4): ") or "4")
+                duration = float(input("Duración en segundos (10): ") or "10")
+            except ValueError:
+                size, streams, duration = 1024 * 1024, 4, 10
+            direction = {'1': 'download', '2': 'upload', '3': 'both'}.get(
+                input("Dirección (1=bajada, 2=subida, 3=ambas) (1): ").strip() or "1", 'download')
             
-            if response['status'] == 'success':
-                data_size = len(response['data'])
-                duration = end_time - start_time
-                speed = (data_size / 1024 / 1024) / duration  # MB/s
-                print(f"Velocidad: {speed:.2f} MB/s")
-            else:
-                print(f"Error en test: {response}")
+            print(f"Ejecutando test de velocidad ({duration:.0f}s tras 2s de calentamiento)...")
+            result = client.benchmark(size, direction, streams, duration)
+            print(f"Velocidad: {result['mb_per_s']:.2f} MB/s "
+                  f"({result['requests']} solicitudes, {result['requests_per_s']:.1f}/s, "
+                  f"{result['errors']} errores)")
+            print(f"Latencia: p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms, "
+                  f"p99 {result['p99_ms']:.1f} ms")
     
     except KeyboardInterrupt:
         print("\nDeteniendo cliente...")
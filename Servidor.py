@@ -3,6 +3,8 @@
 Servidor VPN Simple
 Ejecutar en el ordenador conectado a la WiFi X
 Requiere: pip install cryptography
+Opcional: pip install zstandard lz4 (compresión más rápida)
+Opcional: pip install dnspython (TTL reales en la caché DNS)
 """
 
 import socket
@@ -10,26 +12,2001 @@ import threading
 import subprocess
 import sys
 import os
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import base64
 import json
 import time
+import struct
+import zlib
+import asyncio
+import ssl
+import select
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import urllib.parse
+import hashlib
+import contextlib
+import functools
+import itertools
+import multiprocessing
+import signal
+import email.utils
+import ipaddress
+import re
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict, deque
+
+# Compresión opcional más rápida si está instalada (pip install zstandard lz4)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# TTL reales de los registros DNS si está instalado (pip install dnspython)
+try:
+    import dns.resolver
+except ImportError:
+    dns = None
+
+# Protocolo: cada mensaje cifrado va precedido de su longitud (4 bytes, big-endian)
+FRAME_HEADER_SIZE = 4
+AEAD_TAG_SIZE = 16  # Lo que crece cada mensaje al cifrarlo con AEAD
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # 64MB
+COMPRESSION_THRESHOLD = 1024  # No comprimir cuerpos más pequeños
+# Tipos de contenido que ya vienen comprimidos
+INCOMPRESSIBLE_TYPES = ('image/', 'video/', 'audio/', 'font/woff', 'application/zip',
+                        'application/gzip', 'application/x-gzip', 'application/x-7z-compressed',
+                        'application/x-rar-compressed', 'application/x-bzip2', 'application/zstd')
+STREAM_CHUNK_SIZE = 64 * 1024  # Tamaño de cada fragmento en modo streaming
+# Buffers reutilizados por conexión (modo hilos) para recibir y enviar tramas:
+# caben los fragmentos con sus metadatos; las tramas mayores usan memoria
+# nueva solo para ellas
+FRAME_BUFFER_SIZE = STREAM_CHUNK_SIZE + 1024
+MAX_STREAMS_PER_CONNECTION = 64  # Solicitudes multiplexadas atendidas a la vez por cliente
+MAX_TUNNELS_PER_CONNECTION = 256  # Túneles CONNECT abiertos a la vez por cliente
+SESSION_RANDOM_SIZE = 16  # Bytes aleatorios que aporta cada extremo al derivar las claves de sesión
+TICKET_LIFETIME = 24 * 3600  # Validez de un ticket de reanudación de sesión
+TICKET_SWEEP_INTERVAL = 60  # Cada cuánto se olvidan los tickets usados que ya caducaron
+
+# Cabeceras de la conexión cliente-proxy que no se reenvían al origen
+HOP_BY_HOP_HEADERS = {'connection', 'proxy-connection', 'keep-alive', 'transfer-encoding',
+                      'te', 'upgrade', 'host', 'content-length'}
+# Métodos que se pueden repetir sin efectos secundarios si falla una conexión reutilizada
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'}
+# Códigos que una caché puede guardar sin indicación explícita del origen
+CACHEABLE_STATUS_CODES = {200, 203, 300, 301, 404, 410}
+CACHE_HEURISTIC_MAX = 24 * 3600  # Frescura máxima estimada a partir de Last-Modified
+MAX_BENCHMARK_SIZE = 16 * 1024 * 1024  # Respuesta más grande de la prueba de velocidad
+BENCHMARK_BLOCK = os.urandom(1024 * 1024)  # Datos aleatorios (incompresibles) para la prueba
+# Planificación de envíos: los primeros INTERACTIVE_BYTES de cada ráfaga de un
+# stream pasan por delante de los fragmentos de descargas grandes
+INTERACTIVE_BYTES = 64 * 1024
+INTERACTIVE_IDLE_RESET = 0.5  # Segundos de silencio tras los que un stream vuelve a ser interactivo
+RATE_LIMIT_BURST = 0.25  # Ráfaga permitida por los límites de ancho de banda, en segundos de tasa
+IDLE_CHECK_INTERVAL = 5  # Segundos entre revisiones de conexiones inactivas
+WORKER_CHECK_INTERVAL = 1  # Segundos entre revisiones de los workers en modo multiproceso
+WORKER_MIN_UPTIME = 10  # Un worker que cae antes de esto se reinicia con espera creciente
+MAX_WORKER_RESTART_DELAY = 30
+# Caché DNS: TTL (en segundos) cuando no se conoce el real, de los fallos y
+# límites para los TTL reales que da dnspython
+DNS_DEFAULT_TTL = 60
+DNS_NEGATIVE_TTL = 10
+DNS_MIN_TTL = 5
+DNS_MAX_TTL = 3600
+DNS_MAX_ENTRIES = 4096
+DNS_PREFETCH_SCAN_BYTES = 256 * 1024  # Parte de cada página HTML en la que se buscan nombres
+DNS_PREFETCH_MAX_HOSTS = 32  # Nombres resueltos por adelantado por página
+# Enlaces absolutos o sin esquema (//host/...) en atributos HTML
+HTML_HOST_PATTERN = re.compile(rb'''(?:href|src|action)\s*=\s*["']?(?:https?:)?//([a-z0-9][a-z0-9.-]*[a-z0-9])''', re.I)
+# Descargas compartidas entre solicitudes idénticas simultáneas: bytes que se
+# guardan para quien se una tarde o vaya más lento, y segundos que una
+# solicitud espera el siguiente mensaje antes de seguir con una descarga propia
+COALESCE_MAX_BUFFER = 2 * 1024 * 1024
+COALESCE_LAG_TIMEOUT = 30
+# Cuerpos de solicitudes subidos por partes: bytes que el cliente puede tener
+# enviados sin que se le devuelva crédito (lo que se acumula por solicitud)
+UPLOAD_WINDOW = 1024 * 1024
+# Límites (en segundos) de los intervalos de los histogramas de métricas
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CRYPTO_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+# Tipos de mensaje del cliente que se cuentan por separado; el resto como 'other'
+# (el tipo lo elige el cliente: sin esta lista podría crear series sin límite)
+REQUEST_TYPES = ('hello', 'resume', 'web_request', 'connect', 'data', 'close', 'window', 'cancel', 'ping', 'speed_test')
+
+def recv_exact(sock, size, buffer=None):
+    """Leer exactamente size bytes del socket (None si la conexión se cierra antes)
+    
+    Los datos se leen con recv_into directamente en buffer si cabe (si no, en
+    uno nuevo) y se devuelve una vista de ellos, sin copias intermedias.
+    """
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+    view = memoryview(buffer)[:size]
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return view
+
+def recv_frame(sock, buffer=None):
+    """Recibir un mensaje completo (None si el otro extremo cerró la conexión)
+    
+    Con buffer el resultado es una vista de él: solo vale hasta la siguiente llamada.
+    """
+    header = recv_exact(sock, FRAME_HEADER_SIZE, buffer)
+    if header is None:
+        return None
+    length = struct.unpack('!I', header)[0]
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Mensaje demasiado grande: {length} bytes")
+    payload = recv_exact(sock, length, buffer)
+    if payload is None:
+        raise ConnectionError("Conexión cerrada a mitad de mensaje")
+    return payload
+
+def send_frame(sock, payload):
+    """Enviar un mensaje precedido de su longitud
+    
+    Con sendmsg la cabecera y el mensaje salen juntos sin copiarlos a un
+    objeto nuevo para unirlos.
+    """
+    header = struct.pack('!I', len(payload))
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(header + payload)
+        return
+    sent = sock.sendmsg([header, payload])
+    if sent < FRAME_HEADER_SIZE:
+        sock.sendall(header[sent:])
+        sent = FRAME_HEADER_SIZE
+    if sent < FRAME_HEADER_SIZE + len(payload):
+        sock.sendall(memoryview(payload)[sent - FRAME_HEADER_SIZE:])
+
+async def recv_frame_async(reader):
+    """Versión asyncio de recv_frame (None si el otro extremo cerró la conexión)"""
+    try:
+        header = await reader.readexactly(FRAME_HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("Conexión cerrada a mitad de mensaje")
+        return None
+    length = struct.unpack('!I', header)[0]
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Mensaje demasiado grande: {length} bytes")
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Conexión cerrada a mitad de mensaje")
+
+def encode_message(metadata, body=b'', compression=None):
+    """Empaquetar metadatos (JSON compacto) y cuerpo binario en un solo mensaje
+    
+    Formato: longitud de los metadatos (4 bytes) + metadatos + cuerpo en bruto.
+    El cuerpo nunca pasa por JSON, así que viaja byte a byte sin recodificar.
+    Con compression el cuerpo se comprime si es grande y sale más pequeño;
+    los metadatos indican el algoritmo en 'compressed'.
+    """
+    if compression and len(body) >= COMPRESSION_THRESHOLD:
+        compressed = compress_body(compression, body)
+        if len(compressed) < len(body):
+            metadata = dict(metadata, compressed=compression)
+            body = compressed
+    return pack_metadata(metadata) + body
+
+def pack_metadata(metadata):
+    """Principio de un mensaje sin comprimir: todo menos el cuerpo
+    
+    Un flujo de mensajes con los mismos metadatos (los datos de un túnel)
+    puede calcularlo una vez y poner cada cuerpo detrás.
+    """
+    meta = json.dumps(metadata, separators=(',', ':')).encode()
+    return struct.pack('!I', len(meta)) + meta
+
+def decode_message(data):
+    """Separar un mensaje en (metadatos, cuerpo), descomprimiendo el cuerpo si hace falta
+    
+    Sin compresión el cuerpo es una vista de data, no una copia.
+    """
+    meta_length = struct.unpack_from('!I', data)[0]
+    metadata = json.loads(data[4:4 + meta_length])
+    body = memoryview(data)[4 + meta_length:]
+    if 'compressed' in metadata:
+        body = decompress_body(metadata.pop('compressed'), body)
+    return metadata, body
+
+def available_compressions():
+    """Algoritmos de compresión disponibles, del preferido al menos preferido"""
+    algorithms = []
+    if zstandard is not None:
+        algorithms.append('zstd')
+    if lz4_frame is not None:
+        algorithms.append('lz4')
+    algorithms.append('zlib')
+    return algorithms
+
+def compress_body(algorithm, data):
+    if algorithm == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if algorithm == 'lz4':
+        return lz4_frame.compress(data)
+    return zlib.compress(data, 6)
+
+def decompress_body(algorithm, data):
+    if algorithm == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if algorithm == 'lz4':
+        return lz4_frame.decompress(data)
+    if algorithm == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError(f"Compresión no soportada: {algorithm}")
+
+def is_compressible(headers):
+    """Saltar cuerpos que ya vienen comprimidos (Content-Encoding o tipos multimedia)"""
+    content_type = ''
+    content_encoding = 'identity'
+    for header, value in headers.items():
+        if header.lower() == 'content-type':
+            content_type = value.lower()
+        elif header.lower() == 'content-encoding':
+            content_encoding = value.lower()
+    return content_encoding == 'identity' and not content_type.startswith(INCOMPRESSIBLE_TYPES)
+
+class AEADCipher:
+    """Cifrado AEAD (AES-GCM o ChaCha20-Poly1305) con un contador como nonce en cada dirección
+    
+    Cada dirección tiene su propia clave, así que el contador puede empezar en
+    cero en los dos sentidos sin repetir nunca un par (clave, nonce). El nonce
+    no viaja: TCP entrega en orden y el receptor espera siempre el siguiente
+    contador, con lo que un mensaje repetido o reordenado no se autentica.
+    Frente a Fernet no hay base64 ni HMAC aparte: cada mensaje solo crece 16 bytes.
+    """
+    
+    ALGORITHMS = {'aes-256-gcm': AESGCM, 'chacha20-poly1305': ChaCha20Poly1305}
+    
+    def __init__(self, algorithm, send_key, recv_key):
+        self.algorithm = algorithm
+        self.send_aead = self.ALGORITHMS[algorithm](send_key)
+        self.recv_aead = self.ALGORITHMS[algorithm](recv_key)
+        self.send_counter = 0
+        self.recv_counter = 0
+    
+    def encrypt(self, data):
+        """Cifrar el siguiente mensaje saliente (llamar siempre en el orden de envío)"""
+        nonce = self.send_counter.to_bytes(12, 'big')
+        self.send_counter += 1
+        return self.send_aead.encrypt(nonce, data, None)
+    
+    def encrypt_into(self, data, buffer):
+        """Como encrypt, pero escribiendo en buffer (len(data) + AEAD_TAG_SIZE bytes)"""
+        nonce = self.send_counter.to_bytes(12, 'big')
+        self.send_counter += 1
+        if hasattr(self.send_aead, 'encrypt_into'):
+            self.send_aead.encrypt_into(nonce, data, None, buffer)
+        else:
+            # Versiones de cryptography sin encrypt_into
+            buffer[:] = self.send_aead.encrypt(nonce, data, None)
+    
+    def decrypt(self, data):
+        """Descifrar el siguiente mensaje entrante (InvalidTag si no es auténtico)"""
+        nonce = self.recv_counter.to_bytes(12, 'big')
+        self.recv_counter += 1
+        return self.recv_aead.decrypt(nonce, data, None)
+
+def resumption_secret(secret, salt):
+    """Secreto que guarda un ticket para reanudar la sesión sin repetir el saludo"""
+    return derive_key(secret, salt, b'vpn reanudacion')
+
+def available_ciphers():
+    """Cifrados de sesión disponibles, del preferido al menos preferido"""
+    return list(AEADCipher.ALGORITHMS) + ['fernet']
+
+def derive_key(secret, salt, label):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=label).derive(secret)
+
+def derive_server_key(secret, salt):
+    return derive_key(secret, salt, b'vpn servidor->cliente')
+
+def derive_session_cipher(key, algorithm, secret, salt, is_server, server_random=b''):
+    """Crear el cifrado de una conexión
+    
+    secret es la clave de vpn_key.txt en un saludo completo o el secreto de
+    reanudación de un ticket; salt lleva los valores aleatorios de la
+    conexión, así que cada conexión tiene claves distintas aunque el secreto
+    no cambie. Con 'fernet' se usa directamente la clave compartida.
+    Al reanudar, salt es solo el valor del cliente (sus solicitudes 0-RTT no
+    pueden esperar al servidor) y server_random entra únicamente en la clave
+    servidor->cliente: si alguien repite la reanudación, el servidor no
+    vuelve a cifrar con los mismos pares (clave, nonce).
+    """
+    if algorithm == 'fernet':
+        return Fernet(key)
+    client_key = derive_key(secret, salt, b'vpn cliente->servidor')
+    server_key = derive_server_key(secret, salt + server_random)
+    if is_server:
+        return AEADCipher(algorithm, server_key, client_key)
+    return AEADCipher(algorithm, client_key, server_key)
+
+def benchmark_payload(size, pattern='random'):
+    """Cuerpo de size bytes para la prueba de velocidad ('random' o 'text', comprimible)"""
+    if pattern == 'text':
+        block = b'Prueba de velocidad de la VPN: texto repetido y muy comprimible. ' * 16
+    else:
+        block = BENCHMARK_BLOCK
+    return (block * (size // len(block) + 1))[:size]
+
+def split_url(url):
+    """Separar una URL http(s) en (esquema, host, puerto, ruta con query)"""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise ValueError(f"Esquema no soportado: {parts.scheme}")
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+    return parts.scheme, parts.hostname, port, target
+
+class DNSCache:
+    """Caché de resoluciones DNS compartida por todos los clientes
+    
+    Un nombre se resuelve una sola vez aunque lo pidan varios clientes a la
+    vez (comparten el mismo Future), y como mucho max_concurrency
+    resoluciones van en paralelo en hilos propios: ni los hilos de los
+    clientes ni el bucle de eventos se quedan bloqueados por un DNS lento.
+    Las respuestas duran default_ttl segundos (el TTL real del registro si
+    está instalado dnspython) y los fallos negative_ttl, para no repetir una
+    consulta que acaba de fallar cada vez que el navegador insiste.
+    
+    Las direcciones las da siempre getaddrinfo, que respeta /etc/hosts;
+    dnspython solo se usa después, en segundo plano, para conocer el TTL.
+    """
+    
+    def __init__(self, metrics, max_concurrency=16, default_ttl=DNS_DEFAULT_TTL,
+                 negative_ttl=DNS_NEGATIVE_TTL, max_entries=DNS_MAX_ENTRIES, prefetch=True):
+        self.metrics = metrics
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.prefetch_enabled = prefetch  # Resolver por adelantado los nombres vistos en HTML
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='dns')
+        self.entries = OrderedDict()  # host -> [caduca, Future con [(familia, IP)]], de menos a más usado
+        self.lock = threading.Lock()
+    
+    def lookup(self, host, prefetch=False):
+        """Future con las direcciones de host: guardadas, en curso o de una resolución nueva"""
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            future = Future()
+            future.set_result([(socket.AF_INET6 if address.version == 6 else socket.AF_INET, host)])
+            return future
+        
+        host = host.lower()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(host)
+                if not prefetch:
+                    if not entry[1].done():
+                        result = 'shared'
+                    else:
+                        result = 'negative' if entry[1].exception() else 'hit'
+                    self.metrics.inc('vpn_dns_total', result=result)
+                return entry[1]
+            
+            entry = [float('inf'), None]  # Sin caducidad hasta que termine la resolución
+            entry[1] = self.executor.submit(self.resolve_now, host, entry)
+            self.entries[host] = entry
+            self.entries.move_to_end(host)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        self.metrics.inc('vpn_dns_total', result='prefetch' if prefetch else 'miss')
+        return entry[1]
+    
+    def resolve_now(self, host, entry):
+        """Resolver host en un hilo del pool y fijar cuánto vale la respuesta"""
+        start = time.perf_counter()
+        try:
+            infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except OSError:
+            entry[0] = time.monotonic() + self.negative_ttl
+            self.metrics.inc('vpn_dns_total', result='failure')
+            raise
+        finally:
+            self.metrics.observe('vpn_dns_seconds', time.perf_counter() - start)
+        
+        entry[0] = time.monotonic() + self.default_ttl
+        if dns is not None:
+            self.executor.submit(self.refresh_ttl, host, entry)
+        # Sin duplicados y en el orden de getaddrinfo (RFC 6724)
+        return list(dict.fromkeys((family, sockaddr[0]) for family, _, _, _, sockaddr in infos))
+    
+    def refresh_ttl(self, host, entry):
+        """Cambiar la caducidad por el TTL real del registro A (solo con dnspython)"""
+        try:
+            answer = dns.resolver.resolve(host, 'A', lifetime=5)
+        except Exception:
+            return  # Sin registro A, nombre solo en /etc/hosts...: queda default_ttl
+        entry[0] = time.monotonic() + min(max(answer.rrset.ttl, DNS_MIN_TTL), DNS_MAX_TTL)
+    
+    def resolve(self, host):
+        """Direcciones de host, esperando a la resolución si hace falta (modo hilos)"""
+        return self.lookup(host).result()
+    
+    def prefetch(self, host):
+        """Empezar a resolver host si no está en la caché, sin esperar"""
+        self.lookup(host, prefetch=True)
+    
+    def create_connection(self, address, timeout=None, source_address=None):
+        """Como socket.create_connection, pero resolviendo con la caché
+        
+        Se prueban las direcciones en orden hasta que una conecta.
+        """
+        host, port = address
+        error = None
+        for family, ip in self.resolve(host):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect((ip, port))
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error
+    
+    async def open_connection(self, host, port, ssl=None, timeout=10):
+        """Versión asyncio de create_connection: devuelve (reader, writer)
+        
+        Con TLS el certificado se comprueba contra host, no contra la IP.
+        """
+        addresses = await asyncio.wrap_future(self.lookup(host))
+        error = None
+        for family, ip in addresses:
+            try:
+                return await asyncio.wait_for(
+                    asyncio.open_connection(ip, port, ssl=ssl, server_hostname=host if ssl else None), timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+        raise error
+
+class HTMLPrefetcher:
+    """Busca nombres de host en una página HTML según pasa y los resuelve por adelantado
+    
+    Cuando el navegador pida las imágenes, scripts y hojas de estilo de otros
+    dominios el nombre ya estará en la caché DNS. Solo mira los primeros
+    DNS_PREFETCH_SCAN_BYTES de cada página y entiende gzip y deflate.
+    """
+    
+    def __init__(self, dns_cache, decompressor):
+        self.dns_cache = dns_cache
+        self.decompressor = decompressor
+        self.seen = set()
+        self.scanned = 0
+        self.tail = b''  # Final del fragmento anterior, por si un enlace quedó partido
+    
+    @classmethod
+    def for_response(cls, dns_cache, headers):
+        """Un HTMLPrefetcher si la respuesta es HTML que sabemos leer (None si no)"""
+        if dns_cache is None or not dns_cache.prefetch_enabled:
+            return None
+        if not header_value(headers, 'Content-Type', '').lower().startswith('text/html'):
+            return None
+        encoding = header_value(headers, 'Content-Encoding', 'identity').lower()
+        if encoding == 'identity':
+            return cls(dns_cache, None)
+        if encoding in ('gzip', 'x-gzip'):
+            return cls(dns_cache, zlib.decompressobj(16 + zlib.MAX_WBITS))
+        if encoding == 'deflate':
+            return cls(dns_cache, zlib.decompressobj())
+        return None
+    
+    def feed(self, chunk):
+        if self.scanned >= DNS_PREFETCH_SCAN_BYTES:
+            return
+        if self.decompressor is not None:
+            try:
+                chunk = self.decompressor.decompress(chunk, DNS_PREFETCH_SCAN_BYTES - self.scanned)
+            except zlib.error:
+                self.scanned = DNS_PREFETCH_SCAN_BYTES
+                return
+        self.scanned += len(chunk)
+        
+        text = self.tail + chunk
+        self.tail = text[-256:]
+        for match in HTML_HOST_PATTERN.finditer(text):
+            host = match.group(1).decode('ascii').lower()
+            if host not in self.seen and len(self.seen) < DNS_PREFETCH_MAX_HOSTS:
+                self.seen.add(host)
+                self.dns_cache.prefetch(host)
+
+class ResolvedHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection que abre su socket resolviendo el nombre con la caché DNS"""
+    
+    def __init__(self, host, port, dns_cache, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.dns_cache = dns_cache
+    
+    def connect(self):
+        self.sock = self.dns_cache.create_connection((self.host, self.port), self.timeout, self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class ResolvedHTTPSConnection(http.client.HTTPSConnection):
+    """Versión TLS de ResolvedHTTPConnection: el certificado se comprueba contra el nombre, no contra la IP"""
+    
+    def __init__(self, host, port, dns_cache, context, **kwargs):
+        super().__init__(host, port, context=context, **kwargs)
+        self.dns_cache = dns_cache
+        self.ssl_context = context
+    
+    def connect(self):
+        sock = self.dns_cache.create_connection((self.host, self.port), self.timeout, self.source_address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+class UpstreamPool:
+    """Conexiones keep-alive hacia los orígenes compartidas por todos los clientes
+    
+    Las conexiones libres se guardan por (esquema, host, puerto). Al pedir una
+    se descartan las que llevan más de idle_timeout sin usarse o que el origen
+    ya cerró; si no queda ninguna válida se cuenta un fallo y hay que abrir otra.
+    Sirve tanto para http.client (modo hilos) como para pares (reader, writer)
+    de asyncio.
+    """
+    
+    def __init__(self, max_idle_per_host=8, idle_timeout=30, timeout=10, dns_cache=None):
+        self.max_idle_per_host = max_idle_per_host
+        self.dns_cache = dns_cache  # DNSCache para abrir las conexiones nuevas (None = resolver cada vez)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.ssl_context = ssl.create_default_context()
+        self.idle = {}  # (esquema, host, puerto) -> [(conexión, instante en que quedó libre)]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def is_healthy(self, connection):
+        """Una conexión libre sana no tiene nada que leer (si lo tiene, el origen la cerró)"""
+        if isinstance(connection, tuple):
+            reader, writer = connection
+            return not writer.is_closing() and not reader.at_eof()
+        if connection.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+    
+    def close_connection(self, connection):
+        if isinstance(connection, tuple):
+            connection[1].close()
+        else:
+            connection.close()
+    
+    def get_idle(self, key):
+        """Sacar una conexión libre y sana hacia key (None si no hay)"""
+        now = time.monotonic()
+        discarded = []
+        found = None
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                connection, released_at = idle.pop()
+                if now - released_at <= self.idle_timeout and self.is_healthy(connection):
+                    found = connection
+                    break
+                discarded.append(connection)
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        
+        for connection in discarded:
+            self.close_connection(connection)
+        return found
+    
+    def put_idle(self, key, connection):
+        """Devolver una conexión al pool (se cierra si ya hay demasiadas libres)"""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((connection, time.monotonic()))
+                return
+        self.close_connection(connection)
+    
+    def acquire(self, scheme, host, port):
+        """Obtener una conexión http.client: (conexión, reutilizada)"""
+        connection = self.get_idle((scheme, host, port))
+        if connection is not None:
+            return connection, True
+        
+        if self.dns_cache is not None:
+            if scheme == 'https':
+                connection = ResolvedHTTPSConnection(host, port, self.dns_cache, self.ssl_context, timeout=self.timeout)
+            else:
+                connection = ResolvedHTTPConnection(host, port, self.dns_cache, timeout=self.timeout)
+        elif scheme == 'https':
+            connection = http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self.ssl_context)
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return connection, False
+    
+    def release(self, key, connection, response):
+        """Devolver una conexión http.client si su respuesta se leyó entera y sigue abierta"""
+        if response is not None and response.isclosed() and connection.sock is not None:
+            self.put_idle(key, connection)
+        else:
+            connection.close()
+    
+    def stats(self):
+        with self.lock:
+            idle = sum(len(connections) for connections in self.idle.values())
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'idle': idle
+            }
+
+def header_value(headers, name, default=None):
+    """Buscar una cabecera sin distinguir mayúsculas"""
+    name = name.lower()
+    for header, value in headers.items():
+        if header.lower() == name:
+            return value
+    return default
+
+def merge_headers(pairs):
+    """Cabeceras (nombre, valor) de una respuesta en un dict
+    
+    Las repetidas se unen con ', ' como permite HTTP, salvo Set-Cookie, que
+    no admite esa unión: si se repite queda como lista con un valor por cabecera.
+    """
+    headers = {}
+    names = {}  # Nombre en minúsculas -> como llegó la primera vez
+    for header, value in pairs:
+        name = names.setdefault(header.lower(), header)
+        if name not in headers:
+            headers[name] = value
+        elif name.lower() == 'set-cookie':
+            previous = headers[name]
+            headers[name] = (previous if isinstance(previous, list) else [previous]) + [value]
+        else:
+            headers[name] = f"{headers[name]}, {value}"
+    return headers
+
+def parse_cache_control(value):
+    """Convertir 'max-age=60, no-cache' en {'max-age': '60', 'no-cache': None}"""
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+def parse_http_date(value):
+    """Fecha HTTP a timestamp (None si falta o no se entiende)"""
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def parse_age(value):
+    """Cabecera Age en segundos (0 si falta, no se entiende o es negativa)"""
+    try:
+        return max(0, int(value or 0))
+    except (TypeError, ValueError):
+        return 0
+
+class CacheEntry:
+    """Respuesta guardada en la caché junto con lo necesario para revalidarla"""
+    
+    def __init__(self, status_code, headers, body, vary, stored_at):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.vary = vary  # Valores de las cabeceras de la solicitud listadas en Vary
+        self.update_freshness(stored_at)
+    
+    def update_freshness(self, now):
+        """Calcular durante cuánto tiempo se puede servir sin preguntar al origen"""
+        self.stored_at = now
+        self.initial_age = parse_age(header_value(self.headers, 'Age'))
+        self.etag = header_value(self.headers, 'ETag')
+        self.last_modified = header_value(self.headers, 'Last-Modified')
+        
+        directives = parse_cache_control(header_value(self.headers, 'Cache-Control'))
+        date = parse_http_date(header_value(self.headers, 'Date')) or now
+        expires = parse_http_date(header_value(self.headers, 'Expires'))
+        last_modified = parse_http_date(self.last_modified)
+        
+        if 'no-cache' in directives:
+            self.lifetime = 0
+        elif (directives.get('s-maxage') or '').isdigit():
+            self.lifetime = int(directives['s-maxage'])
+        elif (directives.get('max-age') or '').isdigit():
+            self.lifetime = int(directives['max-age'])
+        elif expires is not None:
+            self.lifetime = max(0, expires - date)
+        elif last_modified is not None:
+            # Heurística habitual: el 10% del tiempo desde la última modificación
+            self.lifetime = min(max(0, date - last_modified) / 10, CACHE_HEURISTIC_MAX)
+        else:
+            self.lifetime = 0
+    
+    def age(self, now):
+        return self.initial_age + max(0, now - self.stored_at)
+    
+    def is_fresh(self, now):
+        return self.age(now) < self.lifetime
+    
+    def has_validators(self):
+        return self.etag is not None or self.last_modified is not None
+    
+    def size(self):
+        return len(self.body) + sum(len(header) + len(str(value)) for header, value in self.headers.items())
+
+class ResponseCache:
+    """Caché HTTP compartida por todos los clientes del servidor
+    
+    Respeta Cache-Control/Expires, revalida con ETag/Last-Modified cuando la
+    copia ha caducado y expulsa las entradas menos usadas (LRU) al superar
+    max_memory. Con disk_dir las entradas expulsadas pasan a un segundo nivel
+    en disco limitado a max_disk bytes antes de descartarse del todo.
+    """
+    
+    def __init__(self, max_memory=64 * 1024 * 1024, max_entry_size=8 * 1024 * 1024,
+                 disk_dir=None, max_disk=512 * 1024 * 1024):
+        self.max_memory = max_memory
+        self.max_entry_size = max_entry_size
+        self.disk_dir = disk_dir
+        self.max_disk = max_disk
+        self.entries = OrderedDict()  # URL -> CacheEntry, de menos a más usada
+        self.memory_used = 0
+        self.disk_index = OrderedDict()  # URL -> tamaño del archivo en disco
+        self.disk_used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            # El índice solo vive en memoria: borrar entradas de ejecuciones anteriores
+            for name in os.listdir(disk_dir):
+                if len(name) == 64 and all(c in '0123456789abcdef' for c in name):
+                    os.remove(os.path.join(disk_dir, name))
+    
+    def is_cacheable_request(self, request):
+        """Solo GET/HEAD sin credenciales ni rangos pueden usar la caché compartida"""
+        headers = request.get('headers', {})
+        directives = parse_cache_control(header_value(headers, 'Cache-Control'))
+        return (request.get('method', 'GET') in ('GET', 'HEAD')
+                and not request.get('data')
+                and header_value(headers, 'Authorization') is None
+                and header_value(headers, 'Range') is None
+                and 'no-store' not in directives)
+    
+    def must_revalidate(self, request):
+        """El navegador pide explícitamente no usar copias sin revalidar (p. ej. al recargar)"""
+        headers = request.get('headers', {})
+        directives = parse_cache_control(header_value(headers, 'Cache-Control'))
+        return 'no-cache' in directives or 'no-cache' in (header_value(headers, 'Pragma') or '')
+    
+    def lookup(self, request):
+        """Buscar la entrada de la URL (None si no hay o no corresponde a esta variante)"""
+        url = request['url']
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+        
+        if entry is None and url in self.disk_index:
+            entry = self.load_from_disk(url)
+            if entry is not None:
+                self.add_to_memory(url, entry)
+        
+        if entry is not None:
+            headers = request.get('headers', {})
+            for header, value in entry.vary.items():
+                if header_value(headers, header) != value:
+                    return None
+        return entry
+    
+    def count(self, outcome):
+        with self.lock:
+            if outcome == 'hit':
+                self.hits += 1
+            elif outcome == 'revalidated':
+                self.revalidations += 1
+            else:
+                self.misses += 1
+    
+    def revalidation_headers(self, entry, request):
+        """Cabeceras de la solicitud con los validadores de la copia guardada"""
+        headers = dict(request.get('headers', {}))
+        if entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified is not None:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+    
+    def is_storable(self, request, response):
+        """Decidir si una respuesta del origen se puede guardar en una caché compartida"""
+        headers = response['headers']
+        directives = parse_cache_control(header_value(headers, 'Cache-Control'))
+        content_length = header_value(headers, 'Content-Length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_entry_size:
+            return False
+        if request.get('method', 'GET') != 'GET' or response['status_code'] not in CACHEABLE_STATUS_CODES:
+            return False
+        if 'no-store' in directives or 'private' in directives:
+            return False
+        if header_value(headers, 'Set-Cookie') is not None or header_value(headers, 'Vary') == '*':
+            return False
+        return True
+    
+    def store(self, request, response, body):
+        """Guardar una respuesta completa si merece la pena (fresca o revalidable)"""
+        headers = {header: value for header, value in response['headers'].items()
+                   if header.lower() not in ('transfer-encoding', 'connection', 'keep-alive', 'content-length')}
+        headers['Content-Length'] = str(len(body))
+        vary_headers = [header.strip() for header in (header_value(headers, 'Vary') or '').split(',') if header.strip()]
+        vary = {header: header_value(request.get('headers', {}), header) for header in vary_headers}
+        
+        entry = CacheEntry(response['status_code'], headers, body, vary, time.time())
+        if entry.lifetime > 0 or entry.has_validators():
+            self.add_to_memory(request['url'], entry)
+    
+    def refresh(self, url, entry, not_modified_headers):
+        """Actualizar una copia revalidada con las cabeceras del 304
+        
+        Las cabeceras se sustituyen por un diccionario nuevo en vez de editarse:
+        replay() puede estar copiándolas a la vez. Su tamaño cuenta en la
+        memoria usada, así que si la copia sigue en memoria se recalcula.
+        """
+        evicted = []
+        with self.lock:
+            headers = dict(entry.headers)
+            for header, value in not_modified_headers.items():
+                if header.lower() not in ('transfer-encoding', 'connection', 'keep-alive', 'content-length'):
+                    headers[header] = value
+            in_memory = self.entries.get(url) is entry
+            if in_memory:
+                self.memory_used -= entry.size()
+            entry.headers = headers
+            entry.update_freshness(time.time())
+            if in_memory:
+                self.memory_used += entry.size()
+                evicted = self.evict()
+        self.spill_to_disk(evicted)
+    
+    def add_to_memory(self, url, entry):
+        with self.lock:
+            previous = self.entries.pop(url, None)
+            if previous is not None:
+                self.memory_used -= previous.size()
+            self.entries[url] = entry
+            self.memory_used += entry.size()
+            evicted = self.evict()
+        self.spill_to_disk(evicted)
+    
+    def evict(self):
+        """Expulsar las entradas menos usadas hasta caber en max_memory (con el lock)"""
+        evicted = []
+        while self.memory_used > self.max_memory and self.entries:
+            evicted_url, evicted_entry = self.entries.popitem(last=False)
+            self.memory_used -= evicted_entry.size()
+            self.evictions += 1
+            evicted.append((evicted_url, evicted_entry))
+        return evicted
+    
+    def spill_to_disk(self, evicted):
+        """Pasar al disco las entradas expulsadas que aún sirvan"""
+        if self.disk_dir:
+            for evicted_url, evicted_entry in evicted:
+                if evicted_entry.has_validators() or evicted_entry.is_fresh(time.time()):
+                    self.save_to_disk(evicted_url, evicted_entry)
+    
+    def disk_path(self, url):
+        return os.path.join(self.disk_dir, hashlib.sha256(url.encode()).hexdigest())
+    
+    def save_to_disk(self, url, entry):
+        """Pasar una entrada expulsada de memoria al nivel en disco"""
+        metadata = {
+            'status_code': entry.status_code,
+            'headers': entry.headers,
+            'vary': entry.vary,
+            'stored_at': entry.stored_at
+        }
+        data = encode_message(metadata, entry.body)
+        try:
+            with open(self.disk_path(url), 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            print(f"Error guardando en la caché de disco: {e}")
+            return
+        
+        removed = []
+        with self.lock:
+            self.disk_used += len(data) - self.disk_index.pop(url, 0)
+            self.disk_index[url] = len(data)
+            while self.disk_used > self.max_disk and self.disk_index:
+                removed_url, removed_size = self.disk_index.popitem(last=False)
+                self.disk_used -= removed_size
+                removed.append(removed_url)
+        
+        for removed_url in removed:
+            self.remove_from_disk(removed_url)
+    
+    def load_from_disk(self, url):
+        """Recuperar una entrada del disco (se quita de allí porque vuelve a memoria)"""
+        with self.lock:
+            size = self.disk_index.pop(url, None)
+            if size is None:
+                return None
+            self.disk_used -= size
+        
+        try:
+            with open(self.disk_path(url), 'rb') as f:
+                metadata, body = decode_message(f.read())
+        except (OSError, ValueError) as e:
+            print(f"Error leyendo la caché de disco: {e}")
+            return None
+        finally:
+            self.remove_from_disk(url)
+        
+        return CacheEntry(metadata['status_code'], metadata['headers'], body, metadata['vary'], metadata['stored_at'])
+    
+    def remove_from_disk(self, url):
+        try:
+            os.remove(self.disk_path(url))
+        except OSError:
+            pass
+    
+    def client_has_copy(self, entry, request):
+        """Comprobar si los validadores del navegador coinciden con la copia guardada"""
+        headers = request.get('headers', {})
+        if_none_match = header_value(headers, 'If-None-Match')
+        if if_none_match is not None:
+            if entry.etag is None:
+                return False
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return '*' in tags or entry.etag.removeprefix('W/') in tags
+        
+        if_modified_since = parse_http_date(header_value(headers, 'If-Modified-Since'))
+        last_modified = parse_http_date(entry.last_modified)
+        return if_modified_since is not None and last_modified is not None and last_modified <= if_modified_since
+    
+    def replay(self, entry, request):
+        """Generar los mensajes de respuesta a partir de una copia guardada"""
+        not_modified = self.client_has_copy(entry, request)
+        headers = dict(entry.headers)
+        headers['Age'] = str(int(entry.age(time.time())))
+        yield {
+            'status': 'success',
+            'status_code': 304 if not_modified else entry.status_code,
+            'headers': headers,
+            'streaming': True
+        }
+        
+        if not not_modified and request.get('method', 'GET') != 'HEAD':
+            view = memoryview(entry.body)
+            for offset in range(0, len(view), STREAM_CHUNK_SIZE):
+                yield {'status': 'chunk', 'content': view[offset:offset + STREAM_CHUNK_SIZE]}
+        yield {'status': 'end'}
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.revalidations + self.misses
+            return {
+                'hits': self.hits,
+                'revalidations': self.revalidations,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.revalidations) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'memory_used': self.memory_used,
+                'disk_entries': len(self.disk_index),
+                'disk_used': self.disk_used
+            }
+
+class CacheFill:
+    """Pasa los mensajes del origen por la caché: guarda la respuesta o resuelve un 304
+    
+    process() recibe cada mensaje del origen y devuelve la lista de mensajes que
+    hay que enviar al cliente, así sirve igual para el modo hilos y el asyncio.
+    """
+    
+    def __init__(self, cache, request, entry):
+        self.cache = cache
+        self.request = request
+        self.entry = entry  # Copia caducada que se está revalidando (o None)
+        self.response = None
+        self.body = None
+        self.replaying = False
+    
+    def process(self, message):
+        if self.replaying:
+            # El origen respondió 304: ya se envió la copia guardada
+            return []
+        
+        if message['status'] == 'success':
+            if message['status_code'] == 304 and self.entry is not None:
+                self.cache.refresh(self.request['url'], self.entry, message['headers'])
+                self.cache.count('revalidated')
+                self.replaying = True
+                return list(self.cache.replay(self.entry, self.request))
+            
+            self.cache.count('miss')
+            if self.cache.is_storable(self.request, message):
+                self.response = message
+                self.body = bytearray()
+        
+        elif message['status'] == 'chunk' and self.body is not None:
+            self.body += message['content']
+            if len(self.body) > self.cache.max_entry_size:
+                self.body = None
+        
+        elif message['status'] == 'end' and self.body is not None:
+            self.cache.store(self.request, self.response, bytes(self.body))
+        
+        return [message]
+
+class UpstreamFlight:
+    """Una descarga del origen compartida por solicitudes idénticas simultáneas
+    
+    La descarga la hace un hilo (o una tarea en modo asyncio) propio que
+    publica cada mensaje, y todas las solicitudes, también la que la inició,
+    se unen como seguidoras y los leen desde el principio a su propio ritmo.
+    La descarga solo espera a la seguidora más rápida, así que un cliente que
+    deja de leer no frena a los demás. Se guardan como mucho
+    COALESCE_MAX_BUFFER bytes de lo que esa ya leyó y otros tantos por
+    delante: mientras no se ha descartado nada cualquiera puede unirse; la
+    seguidora que se queda más atrás que eso, o que no recibe nada en
+    COALESCE_LAG_TIMEOUT segundos, sigue con una descarga propia. Sirve para el modo hilos (read) y para el asyncio
+    (read_async), como CacheFill.
+    """
+    
+    def __init__(self, key):
+        self.key = key
+        self.messages = deque()  # Mensajes publicados que aún hacen falta
+        self.first = 0  # Número del primer mensaje guardado (0 = todavía se puede unir alguien)
+        self.buffered = 0  # Bytes de cuerpo en self.messages
+        self.done = False
+        self.abandoned = False  # La descarga terminó sin 'end' ni 'error'
+        self.positions = {}  # seguidora -> número del siguiente mensaje que leerá
+        self.cond = threading.Condition()
+        self.event = None  # asyncio.Event de los que esperan en el bucle de eventos
+        self.fetcher = None  # Tarea que descarga en modo asyncio (para no perder la referencia)
+    
+    def join(self):
+        """Unirse como seguidora; None si ya se descartó el principio de la respuesta"""
+        with self.cond:
+            if self.first > 0 or self.abandoned:
+                return None
+            token = object()
+            self.positions[token] = 0
+            return token
+    
+    def leave(self, token):
+        with self.cond:
+            self.positions.pop(token, None)
+            self.trim()
+    
+    def publish(self, message):
+        with self.cond:
+            self.messages.append(message)
+            self.buffered += len(message.get('content') or b'')
+            self.done = message['status'] in ('end', 'error')
+            self.trim()
+    
+    def abandon(self):
+        """La descarga no va a publicar nada más: las seguidoras siguen por su cuenta"""
+        with self.cond:
+            self.abandoned = not self.done
+            self.trim()
+    
+    def trim(self):
+        """Descartar lo más antiguo que ya leyó la seguidora más rápida y avisar a quien espera (con el lock)"""
+        if self.buffered > COALESCE_MAX_BUFFER:
+            fastest = max(self.positions.values(), default=self.first + len(self.messages)) - self.first
+            read = sum(len(message.get('content') or b'') for message in itertools.islice(self.messages, fastest))
+            while read > COALESCE_MAX_BUFFER:
+                size = len(self.messages.popleft().get('content') or b'')
+                read -= size
+                self.buffered -= size
+                self.first += 1
+        
+        self.cond.notify_all()
+        if self.event is not None:
+            self.event.set()
+            self.event = None
+    
+    def take(self, token):
+        """Siguiente mensaje de la seguidora (con el lock)
+        
+        None si aún no ha llegado y False si ya no puede seguir con esta
+        descarga: se descartó lo que le faltaba por leer o se abandonó.
+        """
+        index = self.positions[token] - self.first
+        if index < 0:
+            return False
+        if index >= len(self.messages):
+            return False if self.abandoned else None
+        message = self.messages[index]
+        self.positions[token] += 1
+        self.trim()
+        return message
+    
+    def read(self, token):
+        """Esperar al siguiente mensaje (modo hilos); None si hay que seguir con una descarga propia"""
+        deadline = time.monotonic() + COALESCE_LAG_TIMEOUT
+        with self.cond:
+            message = self.take(token)
+            while message is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+                message = self.take(token)
+            return message or None
+    
+    async def read_async(self, token):
+        """Esperar al siguiente mensaje sin bloquear el bucle de eventos"""
+        deadline = time.monotonic() + COALESCE_LAG_TIMEOUT
+        while True:
+            with self.cond:
+                message = self.take(token)
+                if message is None:
+                    event = self.waiter()
+            if message is not None:
+                return message or None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    
+    def waiter(self):
+        """asyncio.Event que se activará con el siguiente cambio (con el lock)"""
+        if self.event is None:
+            self.event = asyncio.Event()
+        return self.event
+    
+    def ahead(self):
+        """Bytes publicados que la seguidora más rápida aún no ha leído (con el lock)"""
+        start = max(0, max(self.positions.values()) - self.first)
+        return sum(len(message.get('content') or b'') for message in itertools.islice(self.messages, start, None))
+    
+    def keeping_up(self):
+        """La descarga puede seguir: la seguidora más rápida no va demasiado atrás o ya no queda ninguna (con el lock)"""
+        return not self.positions or self.ahead() <= COALESCE_MAX_BUFFER
+    
+    def wait_for_readers(self):
+        """El hilo que descarga espera a la seguidora más rápida; False si ya no queda ninguna"""
+        with self.cond:
+            self.cond.wait_for(self.keeping_up)
+            return bool(self.positions)
+    
+    async def wait_for_readers_async(self):
+        while True:
+            with self.cond:
+                if self.keeping_up():
+                    return bool(self.positions)
+                event = self.waiter()
+            await event.wait()
+
+class DownloadWindow:
+    """Crédito del cliente para enviarle una respuesta o un túnel por partes
+    
+    El cliente indica la ventana inicial en la solicitud ('window') y la va
+    devolviendo con mensajes 'window' a medida que quien hizo la solicitud lee
+    lo recibido. Antes de cada fragmento el hilo (o la tarea) que envía espera
+    en take() (take_async) a que quede crédito, así que lo que el cliente
+    acumula por stream está acotado aunque el navegador deje de leer. El
+    crédito puede quedar en negativo por un fragmento; close() despierta a
+    quien espera cuando la solicitud termina.
+    """
+    
+    def __init__(self, size):
+        self.available = size
+        self.closed = False
+        self.cond = threading.Condition()
+        self.event = None  # asyncio.Event de quien espera en el bucle de eventos
+    
+    def grant(self, size):
+        with self.cond:
+            self.available += size
+            self.notify()
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.notify()
+    
+    def notify(self):
+        """Despertar a quien espera crédito (con el lock)"""
+        self.cond.notify_all()
+        if self.event is not None:
+            self.event.set()
+            self.event = None
+    
+    def take(self, size):
+        """Esperar crédito para enviar size bytes (modo hilos); False si la solicitud ya terminó"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.available > 0)
+            self.available -= size
+            return not self.closed
+    
+    async def take_async(self, size):
+        while True:
+            with self.cond:
+                if self.closed or self.available > 0:
+                    self.available -= size
+                    return not self.closed
+                self.event = self.event or asyncio.Event()
+                event = self.event
+            await event.wait()
+
+class UploadBody:
+    """Cuerpo de una solicitud que el cliente sube por partes ('upload')
+    
+    El lector de la conexión añade cada mensaje 'data' con feed() según llega
+    y la solicitud al origen lo consume iterando: con for en modo hilos (se
+    pasa tal cual a http.client) o con async for en modo asyncio. El cliente
+    no envía más de UPLOAD_WINDOW bytes sin crédito y grant se lo devuelve
+    cada cuarto de ventana entregado al origen, así que lo acumulado aquí está
+    acotado aunque el origen lea más despacio de lo que sube el cliente.
+    """
+    
+    def __init__(self, grant):
+        self.grant = grant  # Función (corrutina en modo asyncio) que devuelve crédito al cliente
+        self.chunks = deque()
+        self.buffered = 0
+        self.consumed = 0  # Bytes entregados desde el último crédito devuelto
+        self.started = False  # Ya se entregó algo: la solicitud no se puede repetir
+        self.finished = False  # El cliente envió 'close'
+        self.error = None
+        self.cond = threading.Condition()
+        self.event = None  # asyncio.Event de quien espera en el bucle de eventos
+    
+    def feed(self, data):
+        with self.cond:
+            if self.finished or self.error is not None:
+                return
+            if self.buffered + len(data) > UPLOAD_WINDOW:
+                self.error = 'El cliente superó la ventana de subida'
+            else:
+                self.chunks.append(data)
+                self.buffered += len(data)
+            self.notify()
+    
+    def finish(self):
+        with self.cond:
+            self.finished = True
+            self.notify()
+    
+    def abort(self, reason):
+        with self.cond:
+            if self.error is None:
+                self.error = reason
+            self.notify()
+    
+    def notify(self):
+        """Despertar a quien espera el siguiente fragmento (con el lock)"""
+        self.cond.notify_all()
+        if self.event is not None:
+            self.event.set()
+            self.event = None
+    
+    def take(self):
+        """(fragmento, crédito a devolver); b'' al terminar y None si aún no llegó (con el lock)"""
+        if self.error is not None:
+            raise ConnectionError(self.error)
+        if not self.chunks:
+            return (b'' if self.finished else None), 0
+        chunk = self.chunks.popleft()
+        self.buffered -= len(chunk)
+        self.consumed += len(chunk)
+        self.started = True
+        credit = 0
+        if self.consumed >= UPLOAD_WINDOW // 4:
+            credit, self.consumed = self.consumed, 0
+        return chunk, credit
+    
+    def __iter__(self):
+        while True:
+            with self.cond:
+                chunk, credit = self.take()
+                while chunk is None:
+                    self.cond.wait()
+                    chunk, credit = self.take()
+            if credit:
+                self.grant(credit)
+            if not chunk:
+                return
+            yield chunk
+    
+    async def __aiter__(self):
+        while True:
+            with self.cond:
+                chunk, credit = self.take()
+                if chunk is None:
+                    self.event = self.event or asyncio.Event()
+                    event = self.event
+            if chunk is None:
+                await event.wait()
+                continue
+            if credit:
+                await self.grant(credit)
+            if not chunk:
+                return
+            yield chunk
+
+class AsyncHTTPResponse:
+    """Cliente HTTP/1.1 mínimo con E/S no bloqueante para el modo asyncio
+    
+    Se abre con AsyncHTTPResponse.open() y el cuerpo se lee con read() por
+    fragmentos (Content-Length, chunked o hasta el cierre de la conexión).
+    Con un UpstreamPool la conexión se reutiliza si la respuesta se leyó entera.
+    No sigue redirecciones: los 3xx se reenvían tal cual al cliente.
+    """
+    
+    def __init__(self, reader, writer, method, timeout, pool=None, pool_key=None):
+        self.reader = reader
+        self.writer = writer
+        self.method = method
+        self.timeout = timeout
+        self.pool = pool
+        self.pool_key = pool_key
+        self.status_code = None
+        self.headers = {}
+        self._remaining = None  # Bytes pendientes si hay Content-Length
+        self._chunked = False
+        self._chunk_left = 0
+        self._done = False
+        self._reusable = False
+    
+    @classmethod
+    async def open(cls, url, method='GET', headers=None, data=None, timeout=10, pool=None):
+        """Conectar con el origen, enviar la solicitud y leer la cabecera de la respuesta"""
+        scheme, hostname, port, target = split_url(url)
+        default_port = 443 if scheme == 'https' else 80
+        host = hostname if port == default_port else f"{hostname}:{port}"
+        key = ('asyncio', scheme, hostname, port)
+        
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host}",
+                 "Connection: keep-alive" if pool else "Connection: close"]
+        for header, value in (headers or {}).items():
+            if header.lower() not in HOP_BY_HOP_HEADERS:
+                lines.append(f"{header}: {value}")
+        upload = data if isinstance(data, UploadBody) else None
+        chunked = False
+        if upload is not None:
+            # Se conserva la longitud que dio el navegador; si no la dio, chunked
+            length = header_value(headers or {}, 'Content-Length')
+            chunked = length is None
+            lines.append("Transfer-Encoding: chunked" if chunked else f"Content-Length: {length}")
+            data = None
+        elif data or method in ('POST', 'PUT', 'PATCH'):
+            lines.append(f"Content-Length: {len(data or b'')}")
+        request_bytes = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (data or b'')
+        
+        reused = False
+        while True:
+            connection = pool.get_idle(key) if pool and not reused else None
+            reused = connection is not None
+            if connection is None:
+                ssl_context = None
+                if scheme == 'https':
+                    ssl_context = pool.ssl_context if pool else ssl.create_default_context()
+                if pool and pool.dns_cache is not None:
+                    connection = await pool.dns_cache.open_connection(hostname, port, ssl_context, timeout)
+                else:
+                    connection = await asyncio.wait_for(
+                        asyncio.open_connection(hostname, port, ssl=ssl_context), timeout)
+            
+            reader, writer = connection
+            response = cls(reader, writer, method, timeout, pool, key)
+            try:
+                writer.write(request_bytes)
+                if upload is not None:
+                    await cls.write_upload(writer, upload, chunked, timeout)
+                await asyncio.wait_for(writer.drain(), timeout)
+                await response._read_head()
+                return response
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # El origen pudo cerrar la conexión libre justo antes de usarla;
+                # un cuerpo subido por partes ya no se puede repetir si se empezó
+                if not (reused and method in IDEMPOTENT_METHODS) or (upload is not None and upload.started):
+                    raise
+            except BaseException:
+                writer.close()
+                raise
+    
+    @staticmethod
+    async def write_upload(writer, upload, chunked, timeout):
+        """Enviar al origen un cuerpo según llega del cliente (UploadBody)"""
+        async for chunk in upload:
+            if chunked:
+                writer.write(f"{len(chunk):X}\r\n".encode())
+                writer.write(chunk)
+                writer.write(b"\r\n")
+            else:
+                writer.write(chunk)
+            await asyncio.wait_for(writer.drain(), timeout)
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+    
+    async def _readline(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise ConnectionError("El origen cerró la conexión")
+        return line
+    
+    async def _read_head(self):
+        """Leer línea de estado y headers (saltando respuestas 1xx intermedias)"""
+        while True:
+            status_line = (await self._readline()).decode('latin-1').split(None, 2)
+            self.status_code = int(status_line[1])
+            pairs = []
+            while True:
+                line = (await self._readline()).decode('latin-1').rstrip('\r\n')
+                if not line:
+                    break
+                header, _, value = line.partition(':')
+                pairs.append((header.strip(), value.strip()))
+            self.headers = merge_headers(pairs)
+            if not 100 <= self.status_code < 200:
+                break
+        
+        lower_headers = {header.lower(): value for header, value in self.headers.items()}
+        # Solo se puede reutilizar la conexión si se sabe dónde acaba el cuerpo
+        self._reusable = self.pool is not None and 'close' not in lower_headers.get('connection', '').lower()
+        if self.method == 'HEAD' or self.status_code in (204, 304):
+            self._done = True
+        elif 'chunked' in lower_headers.get('transfer-encoding', '').lower():
+            self._chunked = True
+        elif 'content-length' in lower_headers:
+            self._remaining = int(lower_headers['content-length'])
+            self._done = self._remaining == 0
+        else:
+            self._reusable = False
+    
+    async def read(self, size=STREAM_CHUNK_SIZE):
+        """Leer el siguiente fragmento del cuerpo (b'' al terminar)"""
+        if self._done:
+            return b''
+        
+        if self._chunked:
+            if self._chunk_left == 0:
+                self._chunk_left = int((await self._readline()).split(b';')[0].strip(), 16)
+                if self._chunk_left == 0:
+                    # Saltar trailers hasta la línea vacía final
+                    while (await self._readline()).strip():
+                        pass
+                    self._done = True
+                    return b''
+            size = min(size, self._chunk_left)
+        elif self._remaining is not None:
+            if self._remaining == 0:
+                self._done = True
+                return b''
+            size = min(size, self._remaining)
+        
+        data = await asyncio.wait_for(self.reader.read(size), self.timeout)
+        if not data:
+            if self._chunked or self._remaining is not None:
+                raise ConnectionError("El origen cerró la conexión a mitad de respuesta")
+            self._done = True
+            return b''
+        
+        if self._chunked:
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await asyncio.wait_for(self.reader.readexactly(2), self.timeout)  # CRLF
+        elif self._remaining is not None:
+            self._remaining -= len(data)
+            self._done = self._remaining == 0
+        return data
+    
+    def close(self):
+        """Devolver la conexión al pool si la respuesta terminó limpiamente, o cerrarla"""
+        if self._done and self._reusable:
+            self.pool.put_idle(self.pool_key, (self.reader, self.writer))
+        else:
+            self.writer.close()
+
+class TokenBucket:
+    """Cubo de tokens para limitar el ancho de banda (rate bytes/s)
+    
+    consume() descuenta los bytes aunque el saldo quede en negativo y devuelve
+    cuánto hay que esperar para saldar la deuda; así sirve igual para hilos
+    (time.sleep) que para asyncio (asyncio.sleep). La deuda que nadie espera
+    (la de los envíos adelantados con overdraw) no pasa de una ráfaga: si no,
+    una ráfaga adelantada frenaría todo lo que viniera después.
+    """
+    
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate * RATE_LIMIT_BURST, STREAM_CHUNK_SIZE)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def consume(self, amount, overdraw=False):
+        """Descontar amount bytes y devolver los segundos de espera necesarios
+        
+        Con overdraw el mensaje sale sin esperar si el saldo no estaba ya en
+        negativo: se adelanta a cuenta, pero solo uno hasta saldar la deuda.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if overdraw and self.tokens >= 0:
+                self.tokens = max(-self.burst, self.tokens - amount)
+                return 0
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class FairSendLock:
+    """Cerrojo de envío con dos colas FIFO: interactiva y masiva
+    
+    Mientras haya mensajes interactivos esperando, los masivos no entran.
+    Dentro de cada cola se respeta el orden de llegada, así que varias
+    descargas grandes se turnan fragmento a fragmento.
+    """
+    
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.interactive = deque()
+        self.bulk = deque()
+        self.busy = False
+    
+    def next_turn(self):
+        if self.interactive:
+            return self.interactive[0]
+        return self.bulk[0] if self.bulk else None
+    
+    @contextlib.contextmanager
+    def hold(self, interactive=True):
+        waiting = self.interactive if interactive else self.bulk
+        turn = object()
+        with self.condition:
+            waiting.append(turn)
+            while self.busy or self.next_turn() is not turn:
+                self.condition.wait()
+            waiting.popleft()
+            self.busy = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+class AsyncFairSendLock(FairSendLock):
+    """Versión asyncio de FairSendLock (solo se usa desde el bucle de eventos)"""
+    
+    def __init__(self):
+        super().__init__()
+        self.condition = asyncio.Condition()
+    
+    @contextlib.asynccontextmanager
+    async def hold(self, interactive=True):
+        waiting = self.interactive if interactive else self.bulk
+        turn = object()
+        async with self.condition:
+            waiting.append(turn)
+            try:
+                await self.condition.wait_for(lambda: not self.busy and self.next_turn() is turn)
+            except BaseException:
+                # Tarea cancelada mientras esperaba: dejar pasar al siguiente
+                waiting.remove(turn)
+                self.condition.notify_all()
+                raise
+            waiting.popleft()
+            self.busy = True
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+def escape_label(value):
+    """Escapar el valor de una etiqueta según el formato de texto de Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """Contadores, medidores e histogramas del servidor en formato Prometheus
+    
+    Cada serie se identifica por su nombre y sus etiquetas. Todo se actualiza
+    bajo un único cerrojo: cada operación es una suma, así que la contención
+    es mínima incluso en el camino crítico (cifrado y envío de cada mensaje).
+    """
+    
+    HELP = {
+        'vpn_active_clients': ('gauge', 'Clientes conectados'),
+        'vpn_rejected_clients_total': ('counter', 'Conexiones rechazadas por el límite de conexiones'),
+        'vpn_idle_timeouts_total': ('counter', 'Conexiones cerradas por inactividad'),
+        'vpn_worker_restarts_total': ('counter', 'Workers reiniciados por el supervisor'),
+        'vpn_requests_total': ('counter', 'Solicitudes recibidas por tipo'),
+        'vpn_errors_total': ('counter', 'Errores por tipo'),
+        'vpn_bytes_received_total': ('counter', 'Bytes recibidos de cada cliente'),
+        'vpn_bytes_sent_total': ('counter', 'Bytes enviados a cada cliente'),
+        'vpn_throttled_seconds_total': ('counter', 'Tiempo de espera por los límites de ancho de banda'),
+        'vpn_dns_total': ('counter', 'Consultas a la caché DNS por resultado'),
+        'vpn_coalesced_total': ('counter', 'Solicitudes servidas con la descarga de otra idéntica simultánea'),
+        'vpn_coalesce_fallbacks_total': ('counter', 'Solicitudes compartidas que siguieron con una descarga propia'),
+        'vpn_upload_bytes_total': ('counter', 'Bytes de cuerpos de solicitudes subidos por partes'),
+        'vpn_upstream_seconds': ('histogram', 'Tiempo hasta la cabecera de la respuesta del origen'),
+        'vpn_dns_seconds': ('histogram', 'Tiempo de cada resolución DNS real'),
+        'vpn_encrypt_seconds': ('histogram', 'Tiempo de cifrado de cada mensaje'),
+        'vpn_decrypt_seconds': ('histogram', 'Tiempo de descifrado de cada mensaje'),
+    }
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (nombre, etiquetas) -> valor de contadores y medidores
+        self.histograms = {}  # nombre -> [cuentas por intervalo, suma, total]
+        self.buckets = {
+            'vpn_upstream_seconds': LATENCY_BUCKETS,
+            'vpn_dns_seconds': LATENCY_BUCKETS,
+            'vpn_encrypt_seconds': CRYPTO_BUCKETS,
+            'vpn_decrypt_seconds': CRYPTO_BUCKETS,
+        }
+    
+    def inc(self, name, value=1, **labels):
+        """Sumar value a un contador (o restar, para medidores como los clientes activos)"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+    
+    def observe(self, name, value):
+        """Añadir una medida a un histograma"""
+        buckets = self.buckets[name]
+        index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+        with self.lock:
+            histogram = self.histograms.setdefault(name, [[0] * (len(buckets) + 1), 0.0, 0])
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    
+    def total(self, name):
+        """Suma de una métrica en todas sus etiquetas"""
+        with self.lock:
+            return sum(value for (metric, _), value in self.values.items() if metric == name)
+    
+    def quantile(self, name, fraction):
+        """Cuantil aproximado de un histograma (límite superior de su intervalo)"""
+        with self.lock:
+            counts, _, count = self.histograms.get(name, ([], 0.0, 0))
+            counts = list(counts)
+        target = fraction * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets[name] + (float('inf'),), counts):
+            seen += bucket_count
+            if count and seen >= target:
+                return bound
+        return None
+    
+    def mean(self, name):
+        with self.lock:
+            _, total, count = self.histograms.get(name, ([], 0.0, 0))
+        return total / count if count else None
+    
+    def snapshot(self):
+        """Copia de todos los valores (se puede enviar a otro proceso y sumar con merge)"""
+        with self.lock:
+            values = dict(self.values)
+            histograms = {name: (list(counts), total, count)
+                          for name, (counts, total, count) in self.histograms.items()}
+        return values, histograms
+    
+    def merge(self, snapshot):
+        """Sumar los valores de un snapshot() de otro proceso"""
+        values, histograms = snapshot
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+            for name, (counts, total, count) in histograms.items():
+                histogram = self.histograms.setdefault(name, [[0] * len(counts), 0.0, 0])
+                histogram[0] = [mine + theirs for mine, theirs in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+    
+    def render(self):
+        """Texto para /metrics en el formato de exposición de Prometheus"""
+        values, histograms = self.snapshot()
+        
+        lines = []
+        for name, (kind, description) in self.HELP.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                counts, total, count = histograms.get(name, ([0] * (len(self.buckets[name]) + 1), 0.0, 0))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets[name] + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum {total}")
+                lines.append(f"{name}_count {count}")
+                continue
+            series = [(labels, value) for (metric, labels), value in values.items() if metric == name]
+            for labels, value in sorted(series) or [((), 0)]:
+                label_text = ','.join(f'{label}="{escape_label(value_)}"' for label, value_ in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+class ClientConnection:
+    """Estado de una conexión de cliente compartido por todos sus streams
+    
+    Con multiplexación se atienden varias solicitudes del mismo cliente a la
+    vez, así que los envíos se serializan con send_lock para no mezclar frames.
+    Los mensajes se cifran dentro del mismo cerrojo porque los cifrados AEAD
+    numeran los mensajes y deben salir en el orden en que se cifraron.
+    El cerrojo da preferencia a los mensajes interactivos (ver is_interactive)
+    y buckets son los límites de ancho de banda que se aplican a la conexión.
+    """
+    
+    def __init__(self, address, cipher, metrics, sock=None, writer=None, buckets=()):
+        self.address = address
+        self.cipher = cipher  # Fernet hasta que el saludo acuerda el cifrado de sesión
+        self.metrics = metrics
+        self.socket = sock
+        self.writer = writer
+        # Se reservan sin esperar (acquire(blocking=False)) también en modo
+        # asyncio: si no queda ninguno la solicitud o el túnel se rechaza. El
+        # de un túnel se reserva antes de conectar con el destino
+        self.stream_slots = threading.Semaphore(MAX_STREAMS_PER_CONNECTION)
+        self.tunnel_slots = threading.Semaphore(MAX_TUNNELS_PER_CONNECTION)
+        if writer is None:
+            self.send_lock = FairSendLock()
+            self.recv_buffer = bytearray(FRAME_BUFFER_SIZE)  # Solo lo usa el hilo lector
+            self.send_buffer = memoryview(bytearray(FRAME_BUFFER_SIZE))  # Protegido por send_lock
+        else:
+            self.send_lock = AsyncFairSendLock()
+        self.buckets = buckets
+        self.stream_bytes = {}  # stream_id -> (bytes de la ráfaga actual, último envío)
+        self.active_streams = set()
+        self.cancelled = set()
+        self.tasks = {}  # stream_id -> tarea (modo asyncio)
+        self.tunnels = {}  # stream_id -> socket (o StreamWriter) del destino CONNECT
+        self.uploads = {}  # stream_id -> UploadBody de las solicitudes que suben su cuerpo por partes
+        self.downloads = {}  # stream_id -> DownloadWindow de las respuestas y túneles con crédito del cliente
+        self.compression = None  # Algoritmo acordado en el saludo ('hello')
+        self.greeted = False
+        self.id = None  # Asignado por ConnectionRegistry
+        self.handler = None  # Hilo o tarea que lee de la conexión
+        self.connected_at = time.monotonic()
+        self.last_active = self.connected_at  # Último mensaje recibido del cliente
+    
+    def encrypt(self, plaintext, buffer=None):
+        """Cifrar un mensaje; con buffer el resultado se escribe en él en vez de devolverse"""
+        start = time.perf_counter()
+        if not isinstance(self.cipher, AEADCipher):
+            payload = self.cipher.encrypt(bytes(plaintext))  # Fernet solo acepta bytes
+        elif buffer is None:
+            payload = self.cipher.encrypt(plaintext)
+        else:
+            self.cipher.encrypt_into(plaintext, buffer)
+            payload = buffer
+        self.metrics.observe('vpn_encrypt_seconds', time.perf_counter() - start)
+        self.metrics.inc('vpn_bytes_sent_total', FRAME_HEADER_SIZE + len(payload), client=self.address[0])
+        return payload
+    
+    def decrypt(self, payload):
+        start = time.perf_counter()
+        if not isinstance(self.cipher, AEADCipher):
+            payload = bytes(payload)  # Fernet solo acepta bytes
+        plaintext = self.cipher.decrypt(payload)
+        self.metrics.observe('vpn_decrypt_seconds', time.perf_counter() - start)
+        self.metrics.inc('vpn_bytes_received_total', FRAME_HEADER_SIZE + len(payload), client=self.address[0])
+        return plaintext
+    
+    def is_interactive(self, stream_id, size):
+        """Decidir si un mensaje va por la cola interactiva
+        
+        Lo son los primeros INTERACTIVE_BYTES de cada ráfaga de un stream:
+        respuestas pequeñas, cabeceras y el principio de cada descarga. Un
+        túnel que vuelve a enviar tras un silencio cuenta como ráfaga nueva,
+        así que una conexión HTTPS interactiva no queda relegada para siempre.
+        """
+        now = time.monotonic()
+        sent, last = self.stream_bytes.get(stream_id, (0, now))
+        if now - last > INTERACTIVE_IDLE_RESET:
+            sent = 0
+        sent += size
+        if stream_id is not None:
+            self.stream_bytes[stream_id] = (sent, now)
+        return sent <= INTERACTIVE_BYTES
+    
+    def is_idle(self, now, timeout):
+        """Sin streams ni túneles abiertos y sin recibir nada en timeout segundos"""
+        return (not self.active_streams and not self.tunnels and not self.tasks
+                and now - self.last_active > timeout)
+    
+    def wait_streams(self, deadline):
+        """Esperar (modo hilos) a que terminen las respuestas en curso o llegue deadline"""
+        while self.active_streams and time.monotonic() < deadline:
+            time.sleep(0.05)
+    
+    def close(self, how=socket.SHUT_RDWR):
+        """Cortar la conexión desde fuera de su lector, que verá el fin de la conexión
+        
+        En modo asyncio hay que llamarlo desde el bucle de eventos.
+        """
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(how)
+            except OSError:
+                pass
+        elif how == socket.SHUT_RD:
+            self.writer.transport.pause_reading()
+        else:
+            self.writer.close()
+    
+    def throttle(self, size, interactive=False):
+        """Descontar size bytes de los límites y devolver los segundos de espera"""
+        return max((bucket.consume(size, interactive) for bucket in self.buckets), default=0)
+    
+    def send_encrypted(self, plaintext, next_cipher=None, interactive=True):
+        """Cifrar y enviar un mensaje; con next_cipher, cambiar de cifrado justo después
+        
+        Con AEAD la trama completa (longitud y mensaje cifrado) se escribe en
+        send_buffer y sale con un solo sendall, sin crear objetos por mensaje.
+        """
+        with self.send_lock.hold(interactive):
+            size = len(plaintext) + AEAD_TAG_SIZE
+            if isinstance(self.cipher, AEADCipher) and FRAME_HEADER_SIZE + size <= len(self.send_buffer):
+                frame = self.send_buffer[:FRAME_HEADER_SIZE + size]
+                struct.pack_into('!I', frame, 0, size)
+                self.encrypt(plaintext, frame[FRAME_HEADER_SIZE:])
+                self.socket.sendall(frame)
+            else:
+                send_frame(self.socket, self.encrypt(plaintext))
+            if next_cipher is not None:
+                self.cipher = next_cipher
+    
+    async def send_encrypted_async(self, plaintext, next_cipher=None, interactive=True):
+        async with self.send_lock.hold(interactive):
+            payload = self.encrypt(plaintext)
+            if next_cipher is not None:
+                self.cipher = next_cipher
+            # El transporte puede quedarse con lo escrito: aquí no se reutilizan buffers
+            self.writer.writelines((struct.pack('!I', len(payload)), payload))
+            await self.writer.drain()
+
+class ConnectionRegistry:
+    """Conexiones de clientes abiertas, indexadas por su identificador
+    
+    Altas y bajas en O(1) bajo un cerrojo, con un límite opcional de
+    conexiones simultáneas. Cada operación retiene el cerrojo un instante, así
+    que sirve igual desde los hilos de los clientes que desde el bucle de eventos.
+    """
+    
+    def __init__(self, max_connections=None):
+        self.max_connections = max_connections
+        self.connections = {}  # id -> ClientConnection
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+    
+    def __len__(self):
+        return len(self.connections)
+    
+    def add(self, connection):
+        """Registrar una conexión y darle un id (False si ya se alcanzó el límite)"""
+        with self.lock:
+            if self.max_connections and len(self.connections) >= self.max_connections:
+                return False
+            connection.id = next(self.ids)
+            self.connections[connection.id] = connection
+            return True
+    
+    def remove(self, connection):
+        with self.lock:
+            self.connections.pop(connection.id, None)
+    
+    def snapshot(self):
+        """Copia de las conexiones abiertas para recorrerlas sin retener el cerrojo"""
+        with self.lock:
+            return list(self.connections.values())
+    
+    def idle(self, timeout):
+        now = time.monotonic()
+        return [connection for connection in self.snapshot() if connection.is_idle(now, timeout)]
 
 class VPNServer:
-    def __init__(self, port=8080):
+    def __init__(self, port=8080, backlog=128, max_concurrency=100, response_cache=None,
+                 key_file='vpn_key.txt', metrics_port=None, metrics_interval=60,
+                 client_rate=None, connection_rate=None, max_connections=1000,
+                 idle_timeout=300, drain_timeout=10, dns_prefetch=True):
         self.port = port
-        self.clients = []
+        self.backlog = backlog  # Conexiones pendientes de aceptar
+        self.max_concurrency = max_concurrency  # Solicitudes simultáneas al origen (modo asyncio)
+        self.connections = ConnectionRegistry(max_connections)
+        self.idle_timeout = idle_timeout  # Segundos sin recibir nada antes de cerrar una conexión ociosa (None = nunca)
+        self.drain_timeout = drain_timeout  # Segundos que se espera a las respuestas en curso al detenerse
+        self.drain_deadline = 0
         self.running = False
+        self.stopped = threading.Event()  # Activo cuando el servidor no está atendiendo
+        self.stopped.set()
+        self.server_socket = None
+        self.loop = None
+        self.reuse_port = False  # SO_REUSEPORT: varios procesos escuchan en el mismo puerto
+        self.worker_index = None  # Número de worker en modo multiproceso (None = proceso único)
+        self.workers = []  # Supervisor: [(proceso, tubería, instante de arranque)]
+        self.workers_lock = threading.Lock()
+        self.response_cache = response_cache  # ResponseCache opcional compartida por todos los clientes
+        self.metrics = Metrics()
+        self.dns_prefetch = dns_prefetch
+        self.dns_cache = DNSCache(self.metrics, prefetch=dns_prefetch)
+        self.upstream_pool = UpstreamPool(dns_cache=self.dns_cache)
+        self.flights = {}  # Solicitud al origen -> UpstreamFlight en curso
+        self.flights_lock = threading.Lock()
+        self.metrics_port = metrics_port  # Puerto local de /metrics (None = sin endpoint)
+        self.metrics_interval = metrics_interval  # Segundos entre resúmenes en el log (0 = ninguno)
+        # Límites de bajada en bytes/s (None = sin límite): por cliente (todas
+        # las conexiones desde la misma IP) y por conexión
+        self.client_rate = client_rate
+        self.connection_rate = connection_rate
+        self.client_buckets = {}  # IP -> TokenBucket
+        self.buckets_lock = threading.Lock()
         
-        # Generar clave de cifrado
-        self.key = Fernet.generate_key()
+        # Reutilizar la clave de vpn_key.txt para que los clientes no tengan
+        # que volver a copiarla; solo se genera la primera vez
+        if os.path.exists(key_file):
+            with open(key_file, 'rb') as f:
+                self.key = f.read().strip()
+            print(f"Clave VPN cargada de {key_file}")
+        else:
+            self.key = Fernet.generate_key()
+            fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.key)
+            print(f"Clave VPN guardada en {key_file}")
+            print(f"Clave: {self.key.decode()}")
         self.cipher = Fernet(self.key)
+        self.secret = base64.urlsafe_b64decode(self.key)
         
-        # Guardar la clave en archivo para el cliente
-        with open('vpn_key.txt', 'wb') as f:
-            f.write(self.key)
+        # Tickets de reanudación: el servidor no guarda sesiones, solo los
+        # tickets ya usados (ver rotate_ticket_key)
+        self.rotate_ticket_key()
+    
+    def rotate_ticket_key(self):
+        """Empezar con una clave de tickets nueva, invalidando los emitidos antes
         
-        print(f"Clave VPN guardada en vpn_key.txt")
-        print(f"Clave: {self.key.decode()}")
+        Cada ticket se acepta una sola vez, pero la lista de los usados solo
+        vive en memoria: si los tickets sobrevivieran a un reinicio se podría
+        repetir una reanudación capturada junto con sus solicitudes 0-RTT. Con
+        una clave por arranque los clientes con un ticket anterior vuelven a
+        hacer el saludo completo. Los workers heredan la clave del supervisor
+        y comparten con él la lista (ver start_workers).
+        """
+        self.ticket_cipher = Fernet(Fernet.generate_key())
+        self.used_tickets = {}  # huella del ticket -> momento en que caduca
+        self.tickets_lock = threading.Lock()
+        self.tickets_swept_at = time.time()
     
     def get_local_ip(self):
         """Obtener IP local del servidor"""
@@ -42,74 +2019,638 @@ class VPNServer:
         except:
             return "127.0.0.1"
     
-    def handle_client(self, client_socket, address):
+    def print_stats(self):
+        """Mostrar el aprovechamiento del pool de conexiones y de la caché"""
+        pool = self.upstream_pool.stats()
+        print(f"Pool de conexiones: {pool['hits']} reutilizadas, {pool['misses']} nuevas "
+              f"({pool['hit_ratio']:.0%} de aciertos)")
+        if self.response_cache is not None:
+            cache = self.response_cache.stats()
+            print(f"Caché: {cache['hits']} aciertos, {cache['revalidations']} revalidadas, "
+                  f"{cache['misses']} fallos ({cache['hit_ratio']:.0%} de aciertos), "
+                  f"{cache['entries']} entradas en memoria, {cache['disk_entries']} en disco")
+    
+    def rate_limits(self, address):
+        """Cubos de tokens que se aplican a una conexión nueva desde address"""
+        buckets = []
+        if self.client_rate:
+            with self.buckets_lock:
+                if address[0] not in self.client_buckets:
+                    self.client_buckets[address[0]] = TokenBucket(self.client_rate)
+                buckets.append(self.client_buckets[address[0]])
+        if self.connection_rate:
+            buckets.append(TokenBucket(self.connection_rate))
+        return buckets
+    
+    def count_request(self, request):
+        """Contar una solicitud recibida según su tipo"""
+        request_type = request.get('type')
+        self.metrics.inc('vpn_requests_total', type=request_type if request_type in REQUEST_TYPES else 'other')
+    
+    def metrics_snapshot(self):
+        """Métricas y estadísticas del pool y la caché de este proceso"""
+        cache = self.response_cache.stats() if self.response_cache is not None else None
+        return self.metrics.snapshot(), self.upstream_pool.stats(), cache
+    
+    def collect_metrics(self):
+        """(Metrics, estadísticas del pool, de la caché o None) de todo el servidor
+        
+        En el supervisor de start_workers se piden a cada worker por su
+        tubería y se suman; un worker reiniciado empieza sus contadores de cero.
+        """
+        if not self.workers:
+            return (self.metrics,) + self.metrics_snapshot()[1:]
+        
+        metrics = Metrics()
+        metrics.merge(self.metrics.snapshot())
+        pool = {'hits': 0, 'misses': 0, 'idle': 0}
+        cache = None
+        with self.workers_lock:
+            for process, pipe, _ in self.workers:
+                try:
+                    while pipe.poll():
+                        pipe.recv()  # Respuesta que llegó tarde a una petición anterior
+                    pipe.send('metrics')
+                    if not pipe.poll(1):
+                        continue
+                    worker_metrics, worker_pool, worker_cache = pipe.recv()
+                except (EOFError, OSError):
+                    continue  # Worker caído: el supervisor lo reiniciará
+                metrics.merge(worker_metrics)
+                for key in pool:
+                    pool[key] += worker_pool[key]
+                if worker_cache is not None:
+                    cache = cache or dict.fromkeys(worker_cache, 0)
+                    for key, value in worker_cache.items():
+                        cache[key] += value
+        
+        lookups = pool['hits'] + pool['misses']
+        pool['hit_ratio'] = pool['hits'] / lookups if lookups else 0.0
+        if cache is not None:
+            lookups = cache['hits'] + cache['revalidations'] + cache['misses']
+            cache['hit_ratio'] = (cache['hits'] + cache['revalidations']) / lookups if lookups else 0.0
+        return metrics, pool, cache
+    
+    def render_metrics(self):
+        """Métricas propias más las del pool de conexiones y la caché"""
+        metrics, pool, cache = self.collect_metrics()
+        lines = [metrics.render()]
+        lines.append("# TYPE vpn_upstream_pool_total counter")
+        lines.append(f'vpn_upstream_pool_total{{result="hit"}} {pool["hits"]}')
+        lines.append(f'vpn_upstream_pool_total{{result="miss"}} {pool["misses"]}')
+        if cache is not None:
+            lines.append("# TYPE vpn_cache_total counter")
+            for result in ('hits', 'revalidations', 'misses'):
+                lines.append(f'vpn_cache_total{{result="{result}"}} {cache[result]}')
+        return '\n'.join(lines) + '\n'
+    
+    def start_metrics(self):
+        """Arrancar el endpoint /metrics y el resumen periódico si están configurados"""
+        if self.metrics_port:
+            server = self
+            
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = server.render_metrics().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                
+                def log_message(self, format, *args):
+                    pass
+            
+            # Solo en local: las métricas revelan las IPs de los clientes
+            metrics_server = ThreadingHTTPServer(('127.0.0.1', self.metrics_port), MetricsHandler)
+            metrics_server.daemon_threads = True
+            metrics_thread = threading.Thread(target=metrics_server.serve_forever)
+            metrics_thread.daemon = True
+            metrics_thread.start()
+            print(f"Métricas en http://127.0.0.1:{self.metrics_port}/metrics")
+        
+        if self.metrics_interval:
+            log_thread = threading.Thread(target=self.log_metrics_loop)
+            log_thread.daemon = True
+            log_thread.start()
+    
+    def log_metrics_loop(self):
+        """Mostrar cada metrics_interval segundos un resumen de la actividad"""
+        metrics = self.collect_metrics()[0]
+        last_requests = metrics.total('vpn_requests_total')
+        last_received = metrics.total('vpn_bytes_received_total')
+        last_sent = metrics.total('vpn_bytes_sent_total')
+        while self.running:
+            time.sleep(self.metrics_interval)
+            metrics = self.collect_metrics()[0]
+            requests = metrics.total('vpn_requests_total')
+            received = metrics.total('vpn_bytes_received_total')
+            sent = metrics.total('vpn_bytes_sent_total')
+            upstream = metrics.quantile('vpn_upstream_seconds', 0.95)
+            encrypt = metrics.mean('vpn_encrypt_seconds')
+            print(f"[métricas] {metrics.total('vpn_active_clients')} clientes, "
+                  f"{(requests - last_requests) / self.metrics_interval:.1f} solicitudes/s, "
+                  f"{(received - last_received) / self.metrics_interval / 1024:.1f} KB/s entrada, "
+                  f"{(sent - last_sent) / self.metrics_interval / 1024:.1f} KB/s salida, "
+                  f"{metrics.total('vpn_errors_total')} errores, "
+                  f"origen p95 {'-' if upstream is None else f'<= {upstream * 1000:.0f} ms'}, "
+                  f"cifrado medio {'-' if encrypt is None else f'{encrypt * 1e6:.0f} µs'}")
+            last_requests, last_received, last_sent = requests, received, sent
+    
+    def print_worker_info(self):
+        """Cómo conectarse o, en un worker, solo que está escuchando (lo primero lo dice el supervisor)"""
+        if self.worker_index is None:
+            self.print_server_info()
+        else:
+            print(f"Worker {self.worker_index} (pid {os.getpid()}) atendiendo el puerto {self.port}")
+    
+    def print_server_info(self):
+        """Mostrar cómo conectarse al servidor"""
+        local_ip = self.get_local_ip()
+        print(f"Servidor VPN iniciado en {local_ip}:{self.port}")
+        print(f"Esperando conexiones...")
+        print(f"Para conectarse usar: {local_ip}:{self.port}")
+        print("Presiona Ctrl+C para detener")
+    
+    def pack_message(self, message, compression=None):
+        """Empaquetar un mensaje para el cliente (el campo 'content' va como cuerpo binario)"""
+        metadata = {key: value for key, value in message.items() if key != 'content'}
+        return encode_message(metadata, message.get('content', b''), compression)
+    
+    def decrypt_request(self, connection, encrypted_data):
+        """Descifrar una solicitud del cliente (el cuerpo binario queda en 'data')"""
+        request, body = decode_message(connection.decrypt(encrypted_data))
+        request['data'] = body or None
+        return request
+    
+    def send_message(self, connection, message, stream_id=None, compressible=True, next_cipher=None):
+        """Cifrar y enviar un mensaje al cliente, etiquetado con su stream_id
+        
+        El cuerpo se comprime con el algoritmo acordado salvo que compressible
+        indique que ya viene comprimido (imágenes, gzip, túneles TLS...).
+        """
+        if stream_id is not None:
+            message = dict(message, stream_id=stream_id)
+        if message['status'] == 'error':
+            self.metrics.inc('vpn_errors_total', type='response')
+        compression = connection.compression if compressible else None
+        self.send_plaintext(connection, self.pack_message(message, compression), stream_id, next_cipher)
+    
+    def send_plaintext(self, connection, plaintext, stream_id=None, next_cipher=None):
+        """Enviar un mensaje ya empaquetado respetando los límites de ancho de banda"""
+        # Un mensaje interactivo no espera si el límite no está ya en deuda: la
+        # paga lo que venga detrás; con deuda espera como los demás, así que
+        # muchas respuestas pequeñas seguidas tampoco superan el límite
+        interactive = connection.is_interactive(stream_id, len(plaintext))
+        wait = connection.throttle(len(plaintext), interactive)
+        if wait:
+            self.metrics.inc('vpn_throttled_seconds_total', wait)
+            time.sleep(wait)
+        connection.send_encrypted(plaintext, next_cipher, interactive)
+    
+    def handle_hello(self, connection, request):
+        """Acordar las opciones de la conexión: el primer algoritmo del cliente que conozcamos
+        
+        Devuelve (respuesta, cifrado de sesión). La respuesta todavía va con
+        Fernet; a partir del siguiente mensaje ambos extremos usan el cifrado
+        acordado, con claves derivadas de la clave compartida y de los valores
+        aleatorios de los dos extremos. La respuesta incluye un ticket para
+        reanudar la sesión más tarde sin este intercambio.
+        """
+        if connection.greeted:
+            return {'status': 'error', 'message': 'Saludo repetido'}, None
+        connection.greeted = True
+        
+        supported = available_compressions()
+        connection.compression = next(
+            (algorithm for algorithm in request.get('compression', []) if algorithm in supported), None)
+        
+        cipher = next(
+            (algorithm for algorithm in request.get('ciphers', []) if algorithm in available_ciphers()), 'fernet')
+        response = {'status': 'success', 'type': 'hello', 'compression': connection.compression, 'cipher': cipher}
+        if 'random' not in request:
+            # Cliente antiguo: sin cifrado de sesión ni tickets
+            return response, None
+        
+        server_random = os.urandom(SESSION_RANDOM_SIZE)
+        salt = base64.b64decode(request['random']) + server_random
+        response['random'] = base64.b64encode(server_random).decode()
+        response['ticket'] = self.issue_ticket(resumption_secret(self.secret, salt), cipher, connection.compression)
+        response['ticket_lifetime'] = TICKET_LIFETIME
+        if cipher == 'fernet':
+            return response, None
+        return response, derive_session_cipher(self.key, cipher, self.secret, salt, is_server=True)
+    
+    def issue_ticket(self, secret, cipher, compression):
+        """Crear un ticket opaco con lo necesario para reanudar la sesión"""
+        ticket = {'secret': base64.b64encode(secret).decode(), 'cipher': cipher, 'compression': compression}
+        return self.ticket_cipher.encrypt(json.dumps(ticket).encode()).decode()
+    
+    def handle_resume(self, connection, request):
+        """Reanudar una sesión a partir de un ticket (0-RTT)
+        
+        El cliente no espera respuesta: justo después de este mensaje ya envía
+        solicitudes cifradas con las claves derivadas del ticket y de su valor
+        aleatorio. Devuelve (respuesta, cifrado de sesión), o (None, None) si
+        el ticket no vale, en cuyo caso hay que cerrar la conexión porque no
+        podremos descifrar lo que venga detrás. La respuesta va todavía con
+        Fernet y lleva un valor aleatorio nuevo del servidor que entra en la
+        clave de todo lo que este envíe después (ver derive_session_cipher).
+        """
+        if connection.greeted:
+            return None, None
+        connection.greeted = True
+        
+        token = request.get('ticket', '').encode()
+        try:
+            ticket = json.loads(self.ticket_cipher.decrypt(token, ttl=TICKET_LIFETIME))
+        except (InvalidToken, ValueError):
+            return None, None
+        
+        # Un ticket solo vale una vez: así no se pueden repetir las solicitudes
+        # que un atacante capture junto a él
+        fingerprint = hashlib.sha256(token).digest()
+        now = time.time()
+        try:
+            with self.tickets_lock:
+                if fingerprint in self.used_tickets:
+                    return None, None
+                self.used_tickets[fingerprint] = now + TICKET_LIFETIME
+            self.sweep_used_tickets(now)
+        except (OSError, EOFError):
+            # Sin el Manager de los workers (p. ej. al apagarse) no se puede
+            # comprobar el ticket: el cliente hará el saludo completo
+            return None, None
+        
+        secret = base64.b64decode(ticket['secret'])
+        salt = base64.b64decode(request['random'])
+        server_random = os.urandom(SESSION_RANDOM_SIZE)
+        connection.compression = ticket['compression']
+        response = {
+            'status': 'success',
+            'type': 'resume',
+            'random': base64.b64encode(server_random).decode(),
+            'ticket': self.issue_ticket(resumption_secret(secret, salt + server_random),
+                                        ticket['cipher'], ticket['compression']),
+            'ticket_lifetime': TICKET_LIFETIME,
+        }
+        return response, derive_session_cipher(self.key, ticket['cipher'], secret, salt, is_server=True,
+                                                server_random=server_random)
+    
+    def sweep_used_tickets(self, now):
+        """Olvidar los tickets usados que ya caducaron, como mucho una vez cada TICKET_SWEEP_INTERVAL"""
+        if now - self.tickets_swept_at < TICKET_SWEEP_INTERVAL:
+            return
+        self.tickets_swept_at = now
+        with self.tickets_lock:
+            expired = [used for used, expires in self.used_tickets.items() if expires < now]
+            for used in expired:
+                del self.used_tickets[used]
+    
+    def handle_stream(self, connection, request):
+        """Atender una solicitud y enviar todas sus respuestas
+        
+        Las solicitudes con stream_id se atienden en su propio hilo; el cliente
+        reparte las respuestas por stream_id aunque lleguen desordenadas.
+        """
+        stream_id = request.get('stream_id')
+        window = connection.downloads.get(stream_id)
+        sending = False  # Para distinguir un fallo de la conexión de uno de la solicitud
+        try:
+            if request.get('type') == 'web_request' and request.get('stream'):
+                # Reenviar la respuesta por partes según llega
+                compressible = True
+                for message in self.stream_web_request(request):
+                    if stream_id in connection.cancelled:
+                        break
+                    if message['status'] == 'success':
+                        compressible = is_compressible(message['headers'])
+                    elif message['status'] == 'chunk' and window is not None:
+                        if not window.take(len(message['content'])):
+                            break
+                    sending = True
+                    self.send_message(connection, message, stream_id, compressible)
+                    sending = False
+            else:
+                # Procesar solicitud y enviar respuesta cifrada
+                response = self.process_request(request)
+                compressible = is_compressible(response.get('headers', {}))
+                sending = True
+                self.send_message(connection, response, stream_id, compressible)
+        
+        except Exception as e:
+            if sending:
+                self.metrics.inc('vpn_errors_total', type='send')
+                print(f"Error enviando respuesta a {connection.address}: {e}")
+            else:
+                # La conexión sigue bien: que el cliente no se quede esperando el final
+                self.metrics.inc('vpn_errors_total', type='request')
+                print(f"Error atendiendo solicitud de {connection.address}: {e}")
+                try:
+                    self.send_message(connection, {'status': 'error', 'message': str(e)}, stream_id)
+                except Exception:
+                    pass
+        
+        finally:
+            if stream_id is not None:
+                self.close_upload(connection, stream_id)
+                self.close_download(connection, stream_id)
+                connection.active_streams.discard(stream_id)
+                connection.cancelled.discard(stream_id)
+                connection.stream_bytes.pop(stream_id, None)
+                connection.stream_slots.release()
+    
+    def handle_client(self, connection):
         """Manejar conexión de cliente"""
+        client_socket = connection.socket
+        address = connection.address
         print(f"Cliente conectado desde {address}")
+        self.metrics.inc('vpn_active_clients')
         
         try:
             while self.running:
-                # Recibir datos del cliente
-                encrypted_data = client_socket.recv(4096)
-                if not encrypted_data:
+                # Recibir mensaje completo del cliente
+                encrypted_data = recv_frame(client_socket, connection.recv_buffer)
+                if encrypted_data is None:
                     break
+                connection.last_active = time.monotonic()
                 
                 try:
                     # Descifrar datos
-                    decrypted_data = self.cipher.decrypt(encrypted_data)
-                    request = json.loads(decrypted_data.decode())
-                    
-                    # Procesar solicitud
-                    response = self.process_request(request)
+                    request = self.decrypt_request(connection, encrypted_data)
+                    stream_id = request.get('stream_id')
+                    self.count_request(request)
                     
-                    # Enviar respuesta cifrada
-                    encrypted_response = self.cipher.encrypt(json.dumps(response).encode())
-                    client_socket.send(encrypted_response)
+                    if request.get('type') == 'hello':
+                        response, session_cipher = self.handle_hello(connection, request)
+                        self.send_message(connection, response, stream_id, next_cipher=session_cipher)
+                    elif request.get('type') == 'resume':
+                        response, session_cipher = self.handle_resume(connection, request)
+                        if session_cipher is None:
+                            print(f"Ticket de sesión rechazado de {address}")
+                            break
+                        self.send_message(connection, response, next_cipher=session_cipher)
+                    elif request.get('type') == 'cancel':
+                        # El cliente abandonó la respuesta: dejar de enviarla
+                        if stream_id in connection.active_streams:
+                            connection.cancelled.add(stream_id)
+                        self.close_upload(connection, stream_id)
+                        self.close_download(connection, stream_id)
+                        self.close_tunnel(connection, stream_id)
+                    elif request.get('type') in ('data', 'close'):
+                        if not self.feed_upload(connection, request):
+                            self.forward_to_tunnel(connection, request)
+                    elif request.get('type') == 'window':
+                        self.grant_download(connection, request)
+                    elif request.get('type') == 'connect':
+                        if not connection.tunnel_slots.acquire(blocking=False):
+                            self.send_message(connection, {'status': 'error', 'message': 'Demasiados túneles abiertos'}, stream_id)
+                        else:
+                            if request.get('upload'):
+                                self.open_upload(connection, request)
+                            self.open_download(connection, request)
+                            tunnel_thread = threading.Thread(
+                                target=self.handle_tunnel,
+                                args=(connection, request)
+                            )
+                            tunnel_thread.daemon = True
+                            tunnel_thread.start()
+                    elif stream_id is None:
+                        # Cliente sin multiplexación: atender en orden
+                        self.handle_stream(connection, request)
+                    elif not connection.stream_slots.acquire(blocking=False):
+                        self.send_message(connection, {'status': 'error', 'message': 'Demasiadas solicitudes simultáneas'}, stream_id)
+                    else:
+                        connection.active_streams.add(stream_id)
+                        if request.get('upload'):
+                            self.open_upload(connection, request)
+                        self.open_download(connection, request)
+                        stream_thread = threading.Thread(
+                            target=self.handle_stream,
+                            args=(connection, request)
+                        )
+                        stream_thread.daemon = True
+                        stream_thread.start()
                     
                 except Exception as e:
+                    self.metrics.inc('vpn_errors_total', type='request')
                     print(f"Error procesando solicitud: {e}")
                     break
         
         except Exception as e:
+            self.metrics.inc('vpn_errors_total', type='connection')
             print(f"Error con cliente {address}: {e}")
         
         finally:
+            if not self.running:
+                # Apagado ordenado: dejar terminar las respuestas en curso
+                connection.wait_streams(self.drain_deadline)
+            for tunnel_id in list(connection.tunnels):
+                self.close_tunnel(connection, tunnel_id)
+            for upload_id in list(connection.uploads):
+                self.close_upload(connection, upload_id)
+            for download_id in list(connection.downloads):
+                self.close_download(connection, download_id)
             client_socket.close()
-            if client_socket in self.clients:
-                self.clients.remove(client_socket)
+            self.connections.remove(connection)
+            self.metrics.inc('vpn_active_clients', -1)
             print(f"Cliente {address} desconectado")
     
+    def handle_tunnel(self, connection, request):
+        """Abrir un túnel TCP (CONNECT) y reenviar al cliente todo lo que envíe el destino
+        
+        Lo que envía el cliente llega como mensajes 'data': si lo sube con
+        crédito ('upload') lo escribe write_tunnel en su propio hilo y si no
+        forward_to_tunnel desde el hilo de la conexión.
+        """
+        stream_id = request['stream_id']
+        window = connection.downloads.get(stream_id)
+        try:
+            target = self.dns_cache.create_connection((request['host'], int(request['port'])), timeout=10)
+            target.settimeout(None)
+        except Exception as e:
+            self.close_upload(connection, stream_id)
+            self.close_download(connection, stream_id)
+            connection.tunnel_slots.release()
+            self.send_message(connection, {'status': 'error', 'message': str(e)}, stream_id)
+            return
+        
+        connection.tunnels[stream_id] = target
+        upload = connection.uploads.get(stream_id)
+        if upload is not None:
+            writer_thread = threading.Thread(
+                target=self.write_tunnel,
+                args=(connection, stream_id, target, upload)
+            )
+            writer_thread.daemon = True
+            writer_thread.start()
+        try:
+            self.send_message(connection, {'status': 'success'}, stream_id)
+            
+            # Un único buffer reutilizado para todo el túnel: los metadatos de
+            # los mensajes 'data' van delante y recv_into escribe cada cuerpo
+            # justo detrás, así que el mensaje se cifra sin copiarlo ni recodificarlo
+            prefix = pack_metadata({'status': 'data', 'stream_id': stream_id})
+            buffer = bytearray(len(prefix) + STREAM_CHUNK_SIZE)
+            buffer[:len(prefix)] = prefix
+            view = memoryview(buffer)
+            body = view[len(prefix):]
+            while True:
+                received = target.recv_into(body)
+                if not received or (window is not None and not window.take(received)):
+                    break
+                self.send_plaintext(connection, view[:len(prefix) + received], stream_id)
+            
+            self.send_message(connection, {'status': 'end'}, stream_id)
+        
+        except Exception as e:
+            # Si el túnel ya no está registrado lo cerró el propio cliente
+            if stream_id in connection.tunnels:
+                print(f"Error en túnel hacia {request['host']}:{request['port']}: {e}")
+                try:
+                    self.send_message(connection, {'status': 'error', 'message': str(e)}, stream_id)
+                except Exception:
+                    pass
+        
+        finally:
+            connection.tunnels.pop(stream_id, None)
+            connection.stream_bytes.pop(stream_id, None)
+            self.close_upload(connection, stream_id)
+            self.close_download(connection, stream_id)
+            connection.tunnel_slots.release()
+            target.close()
+    
+    def write_tunnel(self, connection, stream_id, target, upload):
+        """Escribir en el destino lo que el cliente sube por el túnel con crédito
+        
+        Se hace en su propio hilo para que el lector de la conexión no se
+        bloquee nunca en el destino: si este deja de leer, el cliente se queda
+        sin crédito para ese túnel y el resto de la conexión sigue funcionando.
+        """
+        try:
+            for chunk in upload:
+                target.sendall(chunk)
+            target.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.close_tunnel(connection, stream_id)
+    
+    def forward_to_tunnel(self, connection, request):
+        """Escribir en el destino los datos del cliente ('close' = el cliente terminó de enviar)"""
+        target = connection.tunnels.get(request['stream_id'])
+        if target is None:
+            return
+        
+        try:
+            if request['type'] == 'data':
+                target.sendall(request['data'] or b'')
+            else:
+                target.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.close_tunnel(connection, request['stream_id'])
+    
+    def close_tunnel(self, connection, stream_id):
+        """Cerrar un túnel despertando al hilo que lee del destino"""
+        target = connection.tunnels.pop(stream_id, None)
+        if target is None:
+            return
+        
+        try:
+            target.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def open_upload(self, connection, request):
+        """Preparar una solicitud cuyo cuerpo llegará por partes en mensajes 'data'
+        
+        Se registra antes de atenderla para que el lector de la conexión le
+        entregue los mensajes que lleguen detrás. El crédito vuelve al cliente
+        en mensajes 'window' con los bytes ya entregados al origen.
+        """
+        stream_id = request['stream_id']
+        if connection.writer is None:
+            def grant(size):
+                self.send_message(connection, {'status': 'window', 'size': size}, stream_id)
+        else:
+            def grant(size):
+                return self.send_message_async(connection, {'status': 'window', 'size': size}, stream_id)
+        
+        upload = UploadBody(grant)
+        connection.uploads[stream_id] = upload
+        request['data'] = upload
+    
+    def feed_upload(self, connection, request):
+        """Entregar a su solicitud una parte del cuerpo ('close' = el cliente terminó de enviarlo)
+        
+        Devuelve False si el stream no sube un cuerpo (p. ej. es un túnel). La
+        solicitud puede haber terminado ya en su hilo: lo que llegue después se descarta.
+        """
+        upload = connection.uploads.get(request['stream_id'])
+        if upload is None:
+            return False
+        if request['type'] == 'data':
+            data = request['data'] or b''
+            self.metrics.inc('vpn_upload_bytes_total', len(data))
+            upload.feed(data)
+        else:
+            upload.finish()
+        return True
+    
+    def close_upload(self, connection, stream_id):
+        """Olvidar el cuerpo de una solicitud terminada, despertando a quien aún lo espere"""
+        upload = connection.uploads.pop(stream_id, None)
+        if upload is not None:
+            upload.abort('Solicitud cancelada')
+    
+    def open_download(self, connection, request):
+        """Registrar el crédito de bajada si el cliente lo usa (lleva 'window' en la solicitud)"""
+        if request.get('window'):
+            connection.downloads[request['stream_id']] = DownloadWindow(int(request['window']))
+    
+    def grant_download(self, connection, request):
+        """Sumar el crédito que devuelve el cliente; puede llegar cuando el stream ya terminó"""
+        window = connection.downloads.get(request['stream_id'])
+        if window is not None:
+            window.grant(int(request['size']))
+    
+    def close_download(self, connection, stream_id):
+        """Olvidar el crédito de un stream terminado, despertando a quien aún lo espere"""
+        window = connection.downloads.pop(stream_id, None)
+        if window is not None:
+            window.close()
+    
     def process_request(self, request):
         """Procesar solicitudes del cliente"""
         try:
             if request['type'] == 'web_request':
-                # Hacer solicitud web por el cliente
-                import urllib.request
-                import urllib.parse
-                
-                url = request['url']
-                method = request.get('method', 'GET')
-                headers = request.get('headers', {})
-                data = request.get('data', None)
+                # Hacer solicitud web por el cliente y juntar todos los fragmentos
+                response = None
+                content = []
+                for message in self.stream_web_request(request):
+                    if message['status'] == 'chunk':
+                        content.append(message['content'])
+                    elif message['status'] == 'error':
+                        return message
+                    elif message['status'] == 'success':
+                        response = message
                 
-                req = urllib.request.Request(url, data=data, headers=headers)
-                req.get_method = lambda: method
-                
-                with urllib.request.urlopen(req, timeout=10) as response:
-                    content = response.read()
-                    return {
-                        'status': 'success',
-                        'status_code': response.getcode(),
-                        'headers': dict(response.headers),
-                        'content': content.decode('utf-8', errors='ignore')
-                    }
+                del response['streaming']
+                response['content'] = b''.join(content)
+                return response
             
             elif request['type'] == 'ping':
                 return {'status': 'pong', 'server_time': time.time()}
             
             elif request['type'] == 'speed_test':
-                # Test de velocidad simple
-                test_data = 'x' * 1024 * 100  # 100KB
-                return {'status': 'success', 'data': test_data}
+                # Prueba de velocidad: contar lo subido y devolver size bytes
+                size = min(int(request.get('size', 100 * 1024)), MAX_BENCHMARK_SIZE)
+                return {
+                    'status': 'success',
+                    'received': len(request.get('data') or b''),
+                    'content': benchmark_payload(size, request.get('pattern', 'random')),
+                }
             
             else:
                 return {'status': 'error', 'message': 'Tipo de solicitud no reconocido'}
@@ -117,39 +2658,257 @@ class VPNServer:
         except Exception as e:
             return {'status': 'error', 'message': str(e)}
     
+    def stream_web_request(self, request):
+        """Hacer solicitud web y generar la respuesta en fragmentos
+        
+        Primero se genera la cabecera (código y headers), después un mensaje
+        'chunk' por cada fragmento del cuerpo y por último un mensaje 'end'.
+        Así la memoria usada no depende del tamaño de la respuesta.
+        Si hay caché se sirve desde ella cuando la copia sigue fresca.
+        """
+        cache_fill, upstream_request = self.check_cache(request)
+        if cache_fill is None:
+            yield from self.stream_coalesced(upstream_request)
+            return
+        if upstream_request is None:
+            yield from self.response_cache.replay(cache_fill.entry, request)
+            return
+        
+        for message in self.stream_coalesced(upstream_request):
+            yield from cache_fill.process(message)
+    
+    def check_cache(self, request):
+        """Consultar la caché antes de ir al origen
+        
+        Devuelve (CacheFill, solicitud para el origen). Sin caché aplicable el
+        CacheFill es None; si la copia está fresca la solicitud es None y basta
+        con repetir cache_fill.entry; si caducó, la solicitud lleva sus validadores.
+        """
+        cache = self.response_cache
+        if cache is None or not cache.is_cacheable_request(request):
+            return None, request
+        
+        entry = cache.lookup(request)
+        if entry is None:
+            return CacheFill(cache, request, None), request
+        
+        if entry.is_fresh(time.time()) and not cache.must_revalidate(request):
+            cache.count('hit')
+            return CacheFill(cache, request, entry), None
+        
+        if not entry.has_validators():
+            return CacheFill(cache, request, None), request
+        
+        upstream_request = dict(request, headers=cache.revalidation_headers(entry, request))
+        return CacheFill(cache, request, entry), upstream_request
+    
+    def join_flight(self, request):
+        """(UpstreamFlight, seguidora, nueva) para una solicitud al origen
+        
+        Solo se comparten GET y HEAD sin cuerpo con exactamente las mismas
+        cabeceras (también cookies y credenciales), así que todas obtendrían la
+        misma respuesta. Si no hay una descarga idéntica en curso a la que unirse
+        se registra una nueva (nueva=True) y quien llama debe ponerla en marcha.
+        Devuelve (None, None, False) si la solicitud no se puede compartir.
+        """
+        if request.get('method', 'GET') not in ('GET', 'HEAD') or request.get('data'):
+            return None, None, False
+        key = (request.get('method', 'GET'), request['url'],
+               tuple(sorted((header.lower(), str(value)) for header, value in request.get('headers', {}).items())))
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            token = flight.join() if flight is not None else None
+            created = token is None
+            if created:
+                flight = self.flights[key] = UpstreamFlight(key)
+                token = flight.join()
+        if not created:
+            self.metrics.inc('vpn_coalesced_total')
+        return flight, token, created
+    
+    def retire_flight(self, flight):
+        """Que nadie más se una a la descarga"""
+        with self.flights_lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+    
+    def fetch_flight(self, flight, request):
+        """Hilo que descarga del origen para una descarga compartida"""
+        upstream = self.stream_upstream(request)
+        try:
+            for message in upstream:
+                flight.publish(message)
+                if flight.done or not flight.wait_for_readers():
+                    break
+        finally:
+            self.retire_flight(flight)
+            upstream.close()
+            flight.abandon()
+    
+    def resume_private(self, message, delivered):
+        """Adaptar un mensaje de una descarga propia a lo ya entregado de la compartida
+        
+        delivered es [cabecera enviada, bytes de cuerpo enviados] y se va
+        actualizando; devuelve None si el mensaje ya se entregó entero.
+        """
+        if message['status'] == 'success' and delivered[0]:
+            return None
+        if message['status'] == 'chunk' and delivered[1]:
+            content = message['content']
+            skip = min(delivered[1], len(content))
+            delivered[1] -= skip
+            if skip == len(content):
+                return None
+            message = dict(message, content=content[skip:])
+        return message
+    
+    def stream_coalesced(self, request):
+        """stream_upstream compartiendo la descarga con solicitudes idénticas simultáneas"""
+        flight, token, created = self.join_flight(request)
+        if flight is None:
+            yield from self.stream_upstream(request)
+            return
+        if created:
+            threading.Thread(target=self.fetch_flight, args=(flight, request), daemon=True).start()
+        
+        delivered = [False, 0]
+        try:
+            while True:
+                message = flight.read(token)
+                if message is None:
+                    break
+                if message['status'] == 'success':
+                    delivered[0] = True
+                elif message['status'] == 'chunk':
+                    delivered[1] += len(message['content'])
+                yield dict(message)  # Quien lo recibe puede modificarlo
+                if message['status'] in ('end', 'error'):
+                    return
+        finally:
+            flight.leave(token)
+        
+        # Se quedó atrás o la descarga compartida no avanza: seguir con una propia
+        self.metrics.inc('vpn_coalesce_fallbacks_total')
+        for message in self.stream_upstream(request):
+            message = self.resume_private(message, delivered)
+            if message is not None:
+                yield message
+    
+    def stream_upstream(self, request):
+        """Pedir la respuesta al origen y generarla en fragmentos (sin caché)"""
+        key = connection = response = None
+        try:
+            start = time.perf_counter()
+            key, connection, response = self.open_upstream(request)
+            self.metrics.observe('vpn_upstream_seconds', time.perf_counter() - start)
+            headers = merge_headers(response.getheaders())
+            yield {
+                'status': 'success',
+                'status_code': response.status,
+                'headers': headers,
+                'streaming': True
+            }
+            
+            prefetcher = HTMLPrefetcher.for_response(self.dns_cache, headers)
+            while True:
+                chunk = response.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if prefetcher is not None:
+                    prefetcher.feed(chunk)
+                yield {'status': 'chunk', 'content': chunk}
+            
+            yield {'status': 'end'}
+        
+        except Exception as e:
+            yield {'status': 'error', 'message': str(e)}
+        
+        finally:
+            if connection is not None:
+                self.upstream_pool.release(key, connection, response)
+    
+    def open_upstream(self, request):
+        """Enviar la solicitud al origen por una conexión del pool
+        
+        Devuelve (clave del pool, conexión, respuesta). Si una conexión reutilizada
+        resulta estar cerrada por el origen se reintenta con otra, solo para
+        métodos idempotentes y si no se empezó a subir un cuerpo por partes.
+        Las redirecciones no se siguen.
+        """
+        scheme, host, port, target = split_url(request['url'])
+        method = request.get('method', 'GET')
+        headers = {header: value for header, value in request.get('headers', {}).items()
+                   if header.lower() not in HOP_BY_HOP_HEADERS}
+        body = request.get('data')
+        upload = body if isinstance(body, UploadBody) else None
+        if upload is not None:
+            # http.client envía el iterable tal cual con esta longitud o, sin ella, en chunked
+            length = header_value(request.get('headers', {}), 'Content-Length')
+            if length is not None:
+                headers['Content-Length'] = length
+        
+        while True:
+            connection, reused = self.upstream_pool.acquire(scheme, host, port)
+            try:
+                connection.request(method, target, body=body, headers=headers)
+                return (scheme, host, port), connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if not (reused and method in IDEMPOTENT_METHODS) or (upload is not None and upload.started):
+                    raise
+            except Exception:
+                connection.close()
+                raise
+    
     def start_server(self):
         """Iniciar servidor VPN"""
         self.running = True
+        self.start_metrics()
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket = server_socket
+        self.stopped.clear()
         
         try:
             server_socket.bind(('0.0.0.0', self.port))
-            server_socket.listen(5)
+            server_socket.listen(self.backlog)
+            self.print_worker_info()
             
-            local_ip = self.get_local_ip()
-            print(f"Servidor VPN iniciado en {local_ip}:{self.port}")
-            print(f"Esperando conexiones...")
-            print(f"Para conectarse usar: {local_ip}:{self.port}")
-            print("Presiona Ctrl+C para detener")
+            if self.idle_timeout:
+                reaper_thread = threading.Thread(target=self.reap_idle_loop)
+                reaper_thread.daemon = True
+                reaper_thread.start()
             
             while self.running:
                 try:
                     client_socket, address = server_socket.accept()
-                    self.clients.append(client_socket)
+                    # Cada frame sale entero en un solo envío: Nagle solo retrasaría
+                    # el siguiente hasta el ACK retardado del cliente (~40 ms)
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    connection = ClientConnection(address, self.cipher, self.metrics, sock=client_socket,
+                                                  buckets=self.rate_limits(address))
+                    if not self.connections.add(connection):
+                        self.metrics.inc('vpn_rejected_clients_total')
+                        print(f"Conexión de {address} rechazada: límite de "
+                              f"{self.connections.max_connections} conexiones")
+                        client_socket.close()
+                        continue
                     
                     # Crear hilo para manejar cliente
-                    client_thread = threading.Thread(
+                    connection.handler = threading.Thread(
                         target=self.handle_client,
-                        args=(client_socket, address)
+                        args=(connection,)
                     )
-                    client_thread.daemon = True
-                    client_thread.start()
+                    connection.handler.daemon = True
+                    connection.handler.start()
                 
                 except KeyboardInterrupt:
                     break
                 except Exception as e:
-                    print(f"Error aceptando conexión: {e}")
+                    if self.running:
+                        print(f"Error aceptando conexión: {e}")
         
         except Exception as e:
             print(f"Error iniciando servidor: {e}")
@@ -157,13 +2916,626 @@ class VPNServer:
         finally:
             self.running = False
             server_socket.close()
+            self.drain()
+            print("Servidor VPN detenido")
+            self.print_stats()
+            self.stopped.set()
+    
+    def reap_idle_loop(self):
+        """Cerrar periódicamente las conexiones ociosas (modo hilos)"""
+        while self.running:
+            time.sleep(min(self.idle_timeout / 2, IDLE_CHECK_INTERVAL))
+            for connection in self.connections.idle(self.idle_timeout):
+                self.metrics.inc('vpn_idle_timeouts_total')
+                print(f"Cerrando conexión inactiva de {connection.address}")
+                connection.close()
+    
+    def drain(self):
+        """Apagado ordenado en modo hilos
+        
+        Deja de leer solicitudes nuevas, espera hasta drain_timeout a que
+        terminen las respuestas en curso y a que acaben los hilos de los
+        clientes, y corta lo que quede.
+        """
+        self.drain_deadline = time.monotonic() + self.drain_timeout
+        connections = self.connections.snapshot()
+        if connections:
+            print(f"Esperando a {len(connections)} conexiones...")
+        for connection in connections:
+            connection.close(socket.SHUT_RD)
+        for connection in connections:
+            connection.handler.join(max(0, self.drain_deadline - time.monotonic()))
+        for connection in self.connections.snapshot():
+            connection.close()
+    
+    async def send_message_async(self, connection, message, stream_id=None, compressible=True, next_cipher=None):
+        """Cifrar y enviar un mensaje al cliente (modo asyncio)"""
+        if stream_id is not None:
+            message = dict(message, stream_id=stream_id)
+        if message['status'] == 'error':
+            self.metrics.inc('vpn_errors_total', type='response')
+        compression = connection.compression if compressible else None
+        await self.send_plaintext_async(connection, self.pack_message(message, compression), stream_id, next_cipher)
+    
+    async def send_plaintext_async(self, connection, plaintext, stream_id=None, next_cipher=None):
+        """Versión asyncio de send_plaintext"""
+        interactive = connection.is_interactive(stream_id, len(plaintext))
+        wait = connection.throttle(len(plaintext), interactive)
+        if wait:
+            self.metrics.inc('vpn_throttled_seconds_total', wait)
+            await asyncio.sleep(wait)
+        await connection.send_encrypted_async(plaintext, next_cipher, interactive)
+    
+    async def handle_stream_async(self, connection, request):
+        """Versión asyncio de handle_stream (cada stream es una tarea)"""
+        stream_id = request.get('stream_id')
+        window = connection.downloads.get(stream_id)
+        sending = False
+        try:
+            if request.get('type') == 'web_request' and request.get('stream'):
+                compressible = True
+                async for message in self.stream_web_request_async(request):
+                    if message['status'] == 'success':
+                        compressible = is_compressible(message['headers'])
+                    elif message['status'] == 'chunk' and window is not None:
+                        if not await window.take_async(len(message['content'])):
+                            break
+                    sending = True
+                    await self.send_message_async(connection, message, stream_id, compressible)
+                    sending = False
+            else:
+                response = await self.process_request_async(request)
+                compressible = is_compressible(response.get('headers', {}))
+                sending = True
+                await self.send_message_async(connection, response, stream_id, compressible)
+        
+        except Exception as e:
+            if sending:
+                self.metrics.inc('vpn_errors_total', type='send')
+                print(f"Error enviando respuesta a {connection.address}: {e}")
+            else:
+                self.metrics.inc('vpn_errors_total', type='request')
+                print(f"Error atendiendo solicitud de {connection.address}: {e}")
+                try:
+                    await self.send_message_async(connection, {'status': 'error', 'message': str(e)}, stream_id)
+                except Exception:
+                    pass
+    
+    def end_task(self, connection, stream_id, slots, task):
+        """Liberar lo que ocupaba la tarea de un stream o un túnel (modo asyncio)
+        
+        slots es el semáforo en el que reservó su hueco. Se llama al terminar
+        la tarea y no desde un finally porque una tarea cancelada antes de
+        empezar no llega a ejecutar nada de su código.
+        """
+        self.close_upload(connection, stream_id)
+        self.close_download(connection, stream_id)
+        connection.stream_bytes.pop(stream_id, None)
+        if connection.tasks.get(stream_id) is task:
+            del connection.tasks[stream_id]
+        slots.release()
+    
+    async def handle_client_async(self, reader, writer):
+        """Manejar conexión de cliente dentro del bucle de eventos"""
+        address = writer.get_extra_info('peername')
+        connection = ClientConnection(address, self.cipher, self.metrics, writer=writer,
+                                      buckets=self.rate_limits(address))
+        if not self.connections.add(connection):
+            self.metrics.inc('vpn_rejected_clients_total')
+            print(f"Conexión de {address} rechazada: límite de "
+                  f"{self.connections.max_connections} conexiones")
+            writer.close()
+            return
+        connection.handler = asyncio.current_task()
+        print(f"Cliente conectado desde {address}")
+        self.metrics.inc('vpn_active_clients')
+        
+        try:
+            while self.running:
+                encrypted_data = await recv_frame_async(reader)
+                if encrypted_data is None:
+                    break
+                connection.last_active = time.monotonic()
+                
+                try:
+                    request = self.decrypt_request(connection, encrypted_data)
+                    stream_id = request.get('stream_id')
+                    self.count_request(request)
+                    
+                    if request.get('type') == 'hello':
+                        response, session_cipher = self.handle_hello(connection, request)
+                        await self.send_message_async(connection, response, stream_id, next_cipher=session_cipher)
+                    elif request.get('type') == 'resume':
+                        response, session_cipher = self.handle_resume(connection, request)
+                        if session_cipher is None:
+                            print(f"Ticket de sesión rechazado de {address}")
+                            break
+                        await self.send_message_async(connection, response, next_cipher=session_cipher)
+                    elif request.get('type') == 'cancel':
+                        connection.tunnels.pop(stream_id, None)  # Lo cierra el cliente: sin aviso
+                        task = connection.tasks.get(stream_id)
+                        if task is not None:
+                            task.cancel()
+                    elif request.get('type') in ('data', 'close'):
+                        if not self.feed_upload(connection, request):
+                            await self.forward_to_tunnel_async(connection, request)
+                    elif request.get('type') == 'window':
+                        self.grant_download(connection, request)
+                    elif request.get('type') == 'connect':
+                        if not connection.tunnel_slots.acquire(blocking=False):
+                            await self.send_message_async(connection, {'status': 'error', 'message': 'Demasiados túneles abiertos'}, stream_id)
+                        else:
+                            if request.get('upload'):
+                                self.open_upload(connection, request)
+                            self.open_download(connection, request)
+                            task = connection.tasks[stream_id] = asyncio.create_task(
+                                self.handle_tunnel_async(connection, request))
+                            task.add_done_callback(functools.partial(self.end_task, connection, stream_id, connection.tunnel_slots))
+                    elif stream_id is None:
+                        await self.handle_stream_async(connection, request)
+                    elif not connection.stream_slots.acquire(blocking=False):
+                        await self.send_message_async(connection, {'status': 'error', 'message': 'Demasiadas solicitudes simultáneas'}, stream_id)
+                    else:
+                        if request.get('upload'):
+                            self.open_upload(connection, request)
+                        self.open_download(connection, request)
+                        task = connection.tasks[stream_id] = asyncio.create_task(
+                            self.handle_stream_async(connection, request))
+                        task.add_done_callback(functools.partial(self.end_task, connection, stream_id, connection.stream_slots))
+                
+                except Exception as e:
+                    self.metrics.inc('vpn_errors_total', type='request')
+                    print(f"Error procesando solicitud: {e}")
+                    break
+        
+        except Exception as e:
+            self.metrics.inc('vpn_errors_total', type='connection')
+            print(f"Error con cliente {address}: {e}")
+        
+        finally:
+            connection.tunnels.clear()  # Nadie a quien avisar del cierre de los túneles
+            for task in list(connection.tasks.values()):
+                task.cancel()
+            writer.close()
+            self.connections.remove(connection)
+            self.metrics.inc('vpn_active_clients', -1)
+            print(f"Cliente {address} desconectado")
+    
+    async def handle_tunnel_async(self, connection, request):
+        """Versión asyncio de handle_tunnel"""
+        stream_id = request['stream_id']
+        window = connection.downloads.get(stream_id)
+        try:
+            reader, writer = await self.dns_cache.open_connection(request['host'], int(request['port']), timeout=10)
+        except Exception as e:
+            await self.send_message_async(connection, {'status': 'error', 'message': str(e)}, stream_id)
+            return
+        
+        connection.tunnels[stream_id] = writer
+        upload = connection.uploads.get(stream_id)
+        uploader = None
+        if upload is not None:
+            uploader = asyncio.create_task(self.write_tunnel_async(connection, stream_id, writer, upload))
+        try:
+            await self.send_message_async(connection, {'status': 'success'}, stream_id)
+            prefix = pack_metadata({'status': 'data', 'stream_id': stream_id})
+            while True:
+                data = await reader.read(STREAM_CHUNK_SIZE)
+                if not data or (window is not None and not await window.take_async(len(data))):
+                    break
+                await self.send_plaintext_async(connection, prefix + data, stream_id)
+            
+            await self.send_message_async(connection, {'status': 'end'}, stream_id)
+        
+        except asyncio.CancelledError:
+            # Si el túnel sigue registrado no lo canceló el cliente sino un
+            # fallo al escribir en el destino: avisarle como en handle_tunnel
+            if stream_id in connection.tunnels:
+                await self.tunnel_error_async(connection, request, 'Error escribiendo en el destino')
+            raise
+        
+        except Exception as e:
+            if stream_id in connection.tunnels:
+                await self.tunnel_error_async(connection, request, str(e))
+        
+        finally:
+            connection.tunnels.pop(stream_id, None)
+            if uploader is not None:
+                uploader.cancel()
+            writer.close()
+    
+    async def tunnel_error_async(self, connection, request, message):
+        """Avisar al cliente de que el túnel terminó por un error"""
+        print(f"Error en túnel hacia {request['host']}:{request['port']}: {message}")
+        try:
+            await self.send_message_async(connection, {'status': 'error', 'message': message}, request['stream_id'])
+        except Exception:
+            pass
+    
+    async def write_tunnel_async(self, connection, stream_id, writer, upload):
+        """Versión asyncio de write_tunnel (es una tarea aparte de la del túnel)"""
+        try:
+            async for chunk in upload:
+                writer.write(chunk)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except OSError:
+            task = connection.tasks.get(stream_id)
+            if task is not None:
+                task.cancel()
+    
+    async def forward_to_tunnel_async(self, connection, request):
+        """Versión asyncio de forward_to_tunnel"""
+        writer = connection.tunnels.get(request['stream_id'])
+        if writer is None:
+            return
+        
+        try:
+            if request['type'] == 'data':
+                writer.write(request['data'] or b'')
+                await writer.drain()
+            elif writer.can_write_eof():
+                writer.write_eof()
+        except OSError:
+            task = connection.tasks.get(request['stream_id'])
+            if task is not None:
+                task.cancel()
+    
+    async def process_request_async(self, request):
+        """Procesar solicitudes del cliente sin bloquear el bucle de eventos"""
+        if request.get('type') != 'web_request':
+            # El resto de tipos no hacen E/S
+            return self.process_request(request)
+        
+        response = None
+        content = []
+        async for message in self.stream_web_request_async(request):
+            if message['status'] == 'chunk':
+                content.append(message['content'])
+            elif message['status'] == 'error':
+                return message
+            elif message['status'] == 'success':
+                response = message
+        
+        del response['streaming']
+        response['content'] = b''.join(content)
+        return response
+    
+    async def stream_web_request_async(self, request):
+        """Versión asyncio de stream_web_request"""
+        cache_fill, upstream_request = self.check_cache(request)
+        if cache_fill is None:
+            async for message in self.stream_coalesced_async(upstream_request):
+                yield message
+            return
+        if upstream_request is None:
+            for message in self.response_cache.replay(cache_fill.entry, request):
+                yield message
+            return
+        
+        async for message in self.stream_coalesced_async(upstream_request):
+            for forwarded in cache_fill.process(message):
+                yield forwarded
+    
+    async def fetch_flight_async(self, flight, request):
+        """Versión asyncio de fetch_flight (se ejecuta como tarea)"""
+        upstream = self.stream_upstream_async(request)
+        try:
+            async for message in upstream:
+                flight.publish(message)
+                if flight.done or not await flight.wait_for_readers_async():
+                    break
+        finally:
+            self.retire_flight(flight)
+            await upstream.aclose()
+            flight.abandon()
+    
+    async def stream_coalesced_async(self, request):
+        """Versión asyncio de stream_coalesced"""
+        flight, token, created = self.join_flight(request)
+        if flight is None:
+            async for message in self.stream_upstream_async(request):
+                yield message
+            return
+        if created:
+            flight.fetcher = asyncio.create_task(self.fetch_flight_async(flight, request))
+        
+        delivered = [False, 0]
+        try:
+            while True:
+                message = await flight.read_async(token)
+                if message is None:
+                    break
+                if message['status'] == 'success':
+                    delivered[0] = True
+                elif message['status'] == 'chunk':
+                    delivered[1] += len(message['content'])
+                yield dict(message)
+                if message['status'] in ('end', 'error'):
+                    return
+        finally:
+            flight.leave(token)
+        
+        self.metrics.inc('vpn_coalesce_fallbacks_total')
+        async for message in self.stream_upstream_async(request):
+            message = self.resume_private(message, delivered)
+            if message is not None:
+                yield message
+    
+    async def stream_upstream_async(self, request):
+        """Versión asyncio de stream_upstream
+        
+        Las solicitudes simultáneas al origen se limitan con max_concurrency.
+        """
+        async with self.upstream_limit:
+            response = None
+            try:
+                start = time.perf_counter()
+                response = await AsyncHTTPResponse.open(
+                    request['url'],
+                    method=request.get('method', 'GET'),
+                    headers=request.get('headers', {}),
+                    data=request.get('data', None),
+                    pool=self.upstream_pool
+                )
+                self.metrics.observe('vpn_upstream_seconds', time.perf_counter() - start)
+                yield {
+                    'status': 'success',
+                    'status_code': response.status_code,
+                    'headers': response.headers,
+                    'streaming': True
+                }
+                
+                prefetcher = HTMLPrefetcher.for_response(self.dns_cache, response.headers)
+                while True:
+                    chunk = await response.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if prefetcher is not None:
+                        prefetcher.feed(chunk)
+                    yield {'status': 'chunk', 'content': chunk}
+                
+                yield {'status': 'end'}
+            
+            except Exception as e:
+                yield {'status': 'error', 'message': str(e)}
+            
+            finally:
+                if response is not None:
+                    response.close()
+    
+    async def serve_async(self):
+        """Aceptar clientes en el bucle de eventos actual"""
+        self.upstream_limit = asyncio.Semaphore(self.max_concurrency)
+        self.loop = asyncio.get_running_loop()
+        self.shutdown_event = asyncio.Event()
+        server = await asyncio.start_server(
+            self.handle_client_async, '0.0.0.0', self.port,
+            backlog=self.backlog, reuse_address=True, reuse_port=self.reuse_port
+        )
+        self.print_worker_info()
+        reaper = asyncio.create_task(self.reap_idle_async()) if self.idle_timeout else None
+        
+        async with server:
+            try:
+                await self.shutdown_event.wait()
+            finally:
+                # También al cancelarse con Ctrl+C: asyncio.run espera a que acabe
+                server.close()
+                if reaper is not None:
+                    reaper.cancel()
+                await self.drain_async()
+    
+    async def reap_idle_async(self):
+        """Versión asyncio de reap_idle_loop"""
+        while True:
+            await asyncio.sleep(min(self.idle_timeout / 2, IDLE_CHECK_INTERVAL))
+            for connection in self.connections.idle(self.idle_timeout):
+                self.metrics.inc('vpn_idle_timeouts_total')
+                print(f"Cerrando conexión inactiva de {connection.address}")
+                connection.close()
+    
+    async def drain_async(self):
+        """Versión asyncio de drain: espera a las tareas de los streams y cierra las conexiones"""
+        self.running = False
+        self.drain_deadline = time.monotonic() + self.drain_timeout
+        connections = self.connections.snapshot()
+        if not connections:
+            return
+        print(f"Esperando a {len(connections)} conexiones...")
+        for connection in connections:
+            connection.close(socket.SHUT_RD)
+        
+        streams = [task for connection in connections
+                   for stream_id, task in list(connection.tasks.items())
+                   if stream_id not in connection.tunnels]
+        if streams:
+            await asyncio.wait(streams, timeout=self.drain_timeout)
+        
+        # Al cerrar, cada lector ve el fin de la conexión y cancela sus túneles
+        for connection in connections:
+            connection.close()
+        await asyncio.wait([connection.handler for connection in connections], timeout=1)
+    
+    def start_async_server(self):
+        """Iniciar servidor VPN en modo asyncio (todos los clientes en un solo hilo)"""
+        self.running = True
+        self.stopped.clear()
+        self.start_metrics()
+        
+        try:
+            asyncio.run(self.serve_async())
+        except Exception as e:
+            print(f"Error iniciando servidor: {e}")
+        finally:
+            self.running = False
+            self.loop = None
+            print("Servidor VPN detenido")
+            self.print_stats()
+            self.stopped.set()
+    
+    def start_workers(self, workers, use_async=False):
+        """Repartir los clientes entre varios procesos que comparten el puerto
+        
+        Cada worker es un proceso con su propio servidor (de hilos o asyncio)
+        y su propio GIL, así que el cifrado de todos los clientes aprovecha
+        todos los núcleos; el kernel reparte las conexiones entre ellos gracias
+        a SO_REUSEPORT. Este proceso hace de supervisor: no atiende clientes,
+        reinicia los workers que terminan, suma sus métricas para /metrics y
+        el resumen periódico, y al detenerse los apaga de forma ordenada.
+        
+        Los límites (max_connections, client_rate) y la caché son de cada worker.
+        Los tickets de reanudación no: los workers heredan la clave con la que
+        se cifran y comparten la lista de los usados a través de un proceso
+        Manager, así que un ticket vale en cualquier worker y una sola vez.
+        """
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+            print("SO_REUSEPORT no disponible en este sistema: se usa un solo proceso")
+            return self.start_async_server() if use_async else self.start_server()
+        
+        context = multiprocessing.get_context('fork')
+        manager = context.Manager()
+        # Los workers que se reinicien heredan también la clave y estos proxies
+        self.used_tickets = manager.dict()
+        self.tickets_lock = manager.Lock()
+        self.running = True
+        self.stopped.clear()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.handle_sigterm)
+        
+        self.workers = [None] * workers
+        restart_at = [0] * workers
+        failures = [0] * workers
+        for index in range(workers):
+            self.spawn_worker(context, index, use_async)
+        self.print_server_info()
+        print(f"Supervisor (pid {os.getpid()}) con {workers} workers")
+        self.start_metrics()
+        
+        try:
+            while self.running:
+                time.sleep(WORKER_CHECK_INTERVAL)
+                now = time.monotonic()
+                for index, (process, _, started_at) in enumerate(self.workers):
+                    if process.is_alive() or not self.running:
+                        continue
+                    # Si cae nada más arrancar (p. ej. puerto ocupado) esperar
+                    # cada vez más para no entrar en un bucle de reinicios
+                    if not restart_at[index]:
+                        failures[index] = failures[index] + 1 if now - started_at < WORKER_MIN_UPTIME else 0
+                        delay = min(2 ** failures[index] - 1, MAX_WORKER_RESTART_DELAY)
+                        restart_at[index] = now + delay
+                        print(f"Worker {index} terminó (código {process.exitcode}); "
+                              f"reiniciando en {delay:.0f}s")
+                    if now >= restart_at[index]:
+                        restart_at[index] = 0
+                        self.metrics.inc('vpn_worker_restarts_total')
+                        self.spawn_worker(context, index, use_async)
+        
+        except KeyboardInterrupt:
+            print("\nDeteniendo workers...")
+        
+        finally:
+            self.running = False
+            self.stop_workers()
+            manager.shutdown()
             print("Servidor VPN detenido")
+            self.stopped.set()
+    
+    def handle_sigterm(self, signum, frame):
+        """SIGTERM en el supervisor: apagar los workers en lugar de dejarlos huérfanos"""
+        self.running = False
+    
+    def spawn_worker(self, context, index, use_async):
+        parent_pipe, child_pipe = context.Pipe()
+        process = context.Process(target=self.run_worker, args=(index, child_pipe, use_async))
+        process.start()
+        child_pipe.close()
+        with self.workers_lock:
+            self.workers[index] = (process, parent_pipe, time.monotonic())
+    
+    def run_worker(self, index, pipe, use_async):
+        """Cuerpo de un proceso worker (heredado del supervisor con fork)"""
+        # Ctrl+C llega a todo el grupo de procesos: el apagado lo ordena el supervisor
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.worker_index = index
+        self.reuse_port = True
+        self.workers = []
+        # Los hilos del resolver no sobreviven al fork
+        self.metrics = Metrics()
+        self.dns_cache = DNSCache(self.metrics, prefetch=self.dns_prefetch)
+        self.upstream_pool = UpstreamPool(dns_cache=self.dns_cache)
+        self.metrics_port = None  # El supervisor publica la suma de todos
+        self.metrics_interval = 0
+        cache = self.response_cache
+        if cache is not None and cache.disk_dir:
+            # Al arrancar, la caché vacía su directorio: cada worker usa el suyo
+            self.response_cache = ResponseCache(cache.max_memory, cache.max_entry_size,
+                                                os.path.join(cache.disk_dir, f'worker{index}'), cache.max_disk)
+        
+        control_thread = threading.Thread(target=self.worker_control_loop, args=(pipe, os.getppid()))
+        control_thread.daemon = True
+        control_thread.start()
+        
+        if use_async:
+            self.start_async_server()
+        else:
+            self.start_server()
+    
+    def worker_control_loop(self, pipe, supervisor_pid):
+        """Atender las peticiones del supervisor: 'metrics' o 'stop'"""
+        while True:
+            try:
+                if not pipe.poll(WORKER_CHECK_INTERVAL):
+                    if os.getppid() != supervisor_pid:
+                        break  # El supervisor murió sin avisar
+                    continue
+                command = pipe.recv()
+                if command == 'stop':
+                    break
+                pipe.send(self.metrics_snapshot())
+            except (EOFError, OSError):
+                break
+        self.stop_server()
+    
+    def stop_workers(self):
+        """Pedir a todos los workers un apagado ordenado y esperar a que terminen"""
+        with self.workers_lock:
+            for process, pipe, _ in self.workers:
+                try:
+                    pipe.send('stop')
+                except OSError:
+                    pass
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for process, pipe, _ in self.workers:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            pipe.close()
     
     def stop_server(self):
-        """Detener servidor"""
+        """Detener servidor de forma ordenada y esperar a que termine
+        
+        Se puede llamar desde cualquier hilo; el apagado lo hace el hilo que
+        atiende (drain o drain_async).
+        """
         self.running = False
-        for client in self.clients:
-            client.close()
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.shutdown_event.set)
+            except RuntimeError:
+                pass  # El bucle ya terminó
+        elif self.server_socket is not None:
+            # Despierta el accept() bloqueado
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.stopped.wait(self.drain_timeout + 5)
 
 def main():
     print("=== Servidor VPN Simple ===")
@@ -175,10 +3547,60 @@ def main():
     except ValueError:
         port = 8080
     
-    server = VPNServer(port)
+    print("\n=== Modo del servidor ===")
+    print("1. Hilos (un hilo por cliente)")
+    print("2. Asyncio (miles de clientes en un solo bucle de eventos)")
+    mode = input("\nSelecciona un modo (1): ").strip() or "1"
+    
+    try:
+        workers = int(input(f"Número de procesos (1; este equipo tiene {os.cpu_count()} núcleos): ") or "1")
+    except ValueError:
+        workers = 1
+    
+    max_concurrency = 100
+    if mode == "2":
+        try:
+            max_concurrency = int(input("Máximo de solicitudes simultáneas al origen (100): ") or "100")
+        except ValueError:
+            max_concurrency = 100
+    
+    try:
+        cache_mb = int(input("Tamaño de la caché compartida en MB (0 = sin caché) (0): ") or "0")
+    except ValueError:
+        cache_mb = 0
+    
+    response_cache = None
+    if cache_mb > 0:
+        disk_dir = input("Directorio para la caché en disco (Enter = solo memoria): ").strip() or None
+        response_cache = ResponseCache(max_memory=cache_mb * 1024 * 1024, disk_dir=disk_dir)
+    
+    try:
+        metrics_port = int(input("Puerto local de métricas /metrics (0 = desactivado) (0): ") or "0")
+    except ValueError:
+        metrics_port = 0
+    
+    try:
+        client_mbit = float(input("Límite de bajada por cliente en Mbit/s (0 = sin límite) (0): ") or "0")
+    except ValueError:
+        client_mbit = 0
+    
+    try:
+        max_connections = int(input("Máximo de conexiones simultáneas (1000): ") or "1000")
+    except ValueError:
+        max_connections = 1000
+    
+    server = VPNServer(port, max_concurrency=max_concurrency, response_cache=response_cache,
+                       metrics_port=metrics_port or None,
+                       client_rate=client_mbit * 1000 * 1000 / 8 or None,
+                       max_connections=max_connections)
     
     try:
-        server.start_server()
+        if workers > 1:
+            server.start_workers(workers, use_async=mode == "2")
+        elif mode == "2":
+            server.start_async_server()
+        else:
+            server.start_server()
     except KeyboardInterrupt:
         print("\nDeteniendo servidor...")
         server.stop_server()
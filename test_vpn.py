@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la VPN
+Servidor y cliente VPN en loopback contra destinos de prueba locales, con
+los dos motores del servidor (hilos y asyncio).
+Requiere: pip install cryptography
+Uso: python -m unittest test_vpn
+"""
+
+import os
+import queue
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import http.client
+import unittest
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import Servidor
+import Cliente
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=5):
+    """Esperar a que un servidor recién arrancado acepte conexiones"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"El puerto {port} no responde")
+
+def serve_once(handler):
+    """Destino TCP de prueba: atiende una sola conexión con handler(socket) y devuelve su puerto"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    
+    def accept():
+        with listener:
+            conn, _ = listener.accept()
+            with conn:
+                handler(conn)
+    
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+def serve_http(handler_class):
+    """Origen HTTP de prueba en un puerto libre; devuelve su URL"""
+    origin = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    origin.daemon_threads = True
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+    return origin, f"http://127.0.0.1:{origin.server_port}"
+
+def reset(conn):
+    """Cerrar con RST en lugar de FIN"""
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+
+class ServerTestCase(unittest.TestCase):
+    """Arranca un servidor VPN (motor ENGINE) y un cliente conectado a él"""
+    
+    ENGINE = 'start_server'
+    
+    def setUp(self):
+        key_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(key_dir.cleanup)
+        port = free_port()
+        self.server = Servidor.VPNServer(port, key_file=os.path.join(key_dir.name, 'vpn_key.txt'),
+                                         drain_timeout=1, **self.server_options())
+        threading.Thread(target=getattr(self.server, self.ENGINE), daemon=True).start()
+        wait_for_port(port)
+        self.addCleanup(self.server.stop_server)
+        
+        self.client = Cliente.VPNClient('127.0.0.1', port, self.server.key)
+        self.client.auto_reconnect = False
+        self.assertTrue(self.client.connect_to_server())
+        self.addCleanup(self.client.disconnect)
+    
+    def server_options(self):
+        """Argumentos adicionales para VPNServer"""
+        return {}
+    
+    def stream(self, url, timeout=5):
+        """Mensajes de web_request_stream; falla si el stream no termina a tiempo"""
+        messages = []
+        
+        def read():
+            messages.extend(self.client.web_request_stream(url))
+        
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        reader.join(timeout)
+        if reader.is_alive():
+            self.fail(f"El stream no terminó: {[message['status'] for message in messages]}")
+        return messages
+    
+    def collect(self, responses, timeout=5):
+        """Estados de los mensajes de un stream hasta 'end' o 'error'"""
+        statuses = []
+        while not statuses or statuses[-1] not in ('end', 'error'):
+            try:
+                statuses.append(responses.get(timeout=timeout)['status'])
+            except queue.Empty:
+                self.fail(f"El stream no terminó: {statuses}")
+        return statuses
+
+class TunnelTests(ServerTestCase):
+    """Túneles CONNECT: el cliente siempre recibe el final del túnel"""
+    
+    def test_target_reset_is_reported(self):
+        def send_and_reset(conn):
+            conn.sendall(b'hola')
+            time.sleep(0.2)
+            reset(conn)
+        
+        stream_id, responses = self.client.open_tunnel('127.0.0.1', serve_once(send_and_reset))
+        statuses = self.collect(responses)
+        self.client.close_tunnel(stream_id)
+        self.assertEqual(statuses[-1], 'error')
+    
+    def test_target_close_ends_tunnel(self):
+        def send_and_close(conn):
+            conn.sendall(b'hola')
+        
+        stream_id, responses = self.client.open_tunnel('127.0.0.1', serve_once(send_and_close))
+        statuses = self.collect(responses)
+        self.client.close_tunnel(stream_id)
+        self.assertEqual(statuses, ['data', 'end'])
+
+class AsyncTunnelTests(TunnelTests):
+    ENGINE = 'start_async_server'
+
+
+class BadAgeHandler(BaseHTTPRequestHandler):
+    """Respuesta cacheable con Age mal formado y sin Content-Length (termina al cerrar)"""
+    
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Cache-Control', 'max-age=60')
+        self.send_header('Age', 'abc')
+        self.end_headers()
+        self.wfile.write(b'hola')
+    
+    def log_message(self, format, *args):
+        pass
+
+class CacheEntryTests(unittest.TestCase):
+    
+    def test_bad_age_counts_as_zero(self):
+        for age in ('abc', '-5', '', '1.5'):
+            entry = Servidor.CacheEntry(200, {'Cache-Control': 'max-age=60', 'Age': age}, b'', {}, time.time())
+            self.assertEqual(entry.initial_age, 0, age)
+            self.assertTrue(entry.is_fresh(time.time()), age)
+    
+    def test_age_is_used(self):
+        entry = Servidor.CacheEntry(200, {'Cache-Control': 'max-age=60', 'Age': '100'}, b'', {}, time.time())
+        self.assertEqual(entry.initial_age, 100)
+        self.assertFalse(entry.is_fresh(time.time()))
+
+class CookiesHandler(BaseHTTPRequestHandler):
+    """Respuesta con cabeceras repetidas"""
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'a=1; Expires=Wed, 21 Oct 2026 07:28:00 GMT')
+        self.send_header('Set-Cookie', 'b=2')
+        self.send_header('Cache-Control', 'private')
+        self.send_header('Cache-Control', 'max-age=0')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+    
+    def log_message(self, format, *args):
+        pass
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+    
+    def log_message(self, format, *args):
+        pass
+
+class UpstreamPoolTests(unittest.TestCase):
+    """Conexiones al origen abiertas con la caché DNS"""
+    
+    def setUp(self):
+        self.dns_cache = Servidor.DNSCache(Servidor.Metrics(), prefetch=False)
+        self.pool = Servidor.UpstreamPool(dns_cache=self.dns_cache)
+    
+    def test_http_uses_dns_cache(self):
+        origin, url = serve_http(OkHandler)
+        self.addCleanup(origin.server_close)
+        self.addCleanup(origin.shutdown)
+        connection, reused = self.pool.acquire('http', 'localhost', origin.server_port)
+        self.assertFalse(reused)
+        with mock.patch.object(self.dns_cache, 'resolve', wraps=self.dns_cache.resolve) as resolve:
+            connection.request('GET', '/')
+            response = connection.getresponse()
+            self.assertEqual(response.read(), b'ok')
+        resolve.assert_called_once_with('localhost')
+        self.pool.release(('http', 'localhost', origin.server_port), connection, response)
+        self.assertTrue(self.pool.acquire('http', 'localhost', origin.server_port)[1])
+    
+    def test_https_checks_certificate_name(self):
+        origin, url = serve_http(OkHandler)
+        self.addCleanup(origin.server_close)
+        self.addCleanup(origin.shutdown)
+        connection, _ = self.pool.acquire('https', 'localhost', origin.server_port)
+        self.assertIsInstance(connection, Servidor.http.client.HTTPSConnection)
+        connection.ssl_context = mock.Mock()
+        connection.connect()
+        sock = connection.ssl_context.wrap_socket.call_args.args[0]
+        self.addCleanup(sock.close)
+        self.assertEqual(connection.ssl_context.wrap_socket.call_args.kwargs, {'server_hostname': 'localhost'})
+        self.assertEqual(sock.getpeername()[1], origin.server_port)
+
+class CacheTests(ServerTestCase):
+    """Respuestas a través de la caché del servidor"""
+    
+    def server_options(self):
+        return {'response_cache': Servidor.ResponseCache()}
+    
+    def test_bad_age_header(self):
+        origin, url = serve_http(BadAgeHandler)
+        self.addCleanup(origin.server_close)
+        self.addCleanup(origin.shutdown)
+        for attempt in range(2):
+            messages = self.stream(url)
+            self.assertEqual([message['status'] for message in messages], ['success', 'chunk', 'end'])
+            self.assertEqual(messages[1]['content'], b'hola')
+        response = self.client.web_request(url)
+        self.assertEqual(response['status'], 'success')
+    
+    def test_failure_while_streaming_sends_error(self):
+        origin, url = serve_http(BadAgeHandler)
+        self.addCleanup(origin.server_close)
+        self.addCleanup(origin.shutdown)
+        with mock.patch.object(Servidor.CacheEntry, 'update_freshness', side_effect=ValueError('fallo')):
+            messages = self.stream(url)
+        self.assertEqual(messages[-1]['status'], 'error')
+
+class MergeHeadersTests(unittest.TestCase):
+    
+    def test_merge_headers(self):
+        headers = Servidor.merge_headers([('Set-Cookie', 'a=1'), ('Vary', 'Accept'), ('set-cookie', 'b=2'),
+                                          ('vary', 'Cookie'), ('Content-Type', 'text/plain')])
+        self.assertEqual(headers, {'Set-Cookie': ['a=1', 'b=2'], 'Vary': 'Accept, Cookie',
+                                   'Content-Type': 'text/plain'})
+    
+    def test_single_set_cookie_stays_a_string(self):
+        self.assertEqual(Servidor.merge_headers([('Set-Cookie', 'a=1')]), {'Set-Cookie': 'a=1'})
+
+class HeaderTests(ServerTestCase):
+    """Cabeceras de la respuesta del origen hasta el navegador"""
+    
+    def test_repeated_headers_reach_browser(self):
+        origin, url = serve_http(CookiesHandler)
+        self.addCleanup(origin.server_close)
+        self.addCleanup(origin.shutdown)
+        self.client.proxy_port = free_port()
+        threading.Thread(target=self.client.start_proxy_server, daemon=True).start()
+        wait_for_port(self.client.proxy_port)
+        
+        browser = http.client.HTTPConnection('127.0.0.1', self.client.proxy_port, timeout=5)
+        self.addCleanup(browser.close)
+        browser.request('GET', url)
+        response = browser.getresponse()
+        self.assertEqual(response.read(), b'ok')
+        self.assertEqual(response.msg.get_all('Set-Cookie'),
+                         ['a=1; Expires=Wed, 21 Oct 2026 07:28:00 GMT', 'b=2'])
+        self.assertEqual(response.msg.get_all('Cache-Control'), ['private, max-age=0'])
+
+class AsyncHeaderTests(HeaderTests):
+    ENGINE = 'start_async_server'
+
+class AsyncCacheTests(CacheTests):
+    ENGINE = 'start_async_server'
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork'), "Sin SO_REUSEPORT no hay workers")
+class WorkerResumeTests(unittest.TestCase):
+    """Reanudar sesiones con varios workers: el kernel reparte cada conexión a uno cualquiera"""
+    
+    WORKERS = 4
+    
+    def start_supervisor(self, port, key_file):
+        script = (f"import Servidor; Servidor.VPNServer({port}, key_file={key_file!r}, drain_timeout=1)"
+                  f".start_workers({self.WORKERS})")
+        supervisor = subprocess.Popen([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        
+        def stop():
+            supervisor.send_signal(signal.SIGTERM)
+            try:
+                supervisor.wait(10)
+            except subprocess.TimeoutExpired:
+                supervisor.kill()
+                supervisor.wait()
+        
+        self.addCleanup(stop)
+        wait_for_port(port, timeout=10)
+        time.sleep(0.5)  # Que arranquen todos los workers
+        return supervisor, stop
+    
+    def setUp(self):
+        key_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(key_dir.cleanup)
+        key_file = os.path.join(key_dir.name, 'vpn_key.txt')
+        key = Servidor.Fernet.generate_key()
+        with open(key_file, 'wb') as f:
+            f.write(key)
+        port = free_port()
+        self.supervisor, self.stop = self.start_supervisor(port, key_file)
+        self.client = Cliente.VPNClient('127.0.0.1', port, key)
+        self.client.auto_reconnect = False
+        self.client.heartbeat_interval = 0
+    
+    def test_resume_on_any_worker(self):
+        client = self.client
+        for attempt in range(4 * self.WORKERS):
+            # Salvo la primera vez, se conecta con el ticket de la conexión anterior
+            self.assertEqual(client.session_ticket is not None, attempt > 0)
+            self.assertTrue(client.connect_to_server())
+            response = client.send_request({'type': 'ping'})
+            client.disconnect()
+            self.assertEqual(response['status'], 'pong', f"intento {attempt}")
+        
+        self.stop()
+        self.assertNotIn("Ticket de sesión rechazado", self.supervisor.stdout.read())
+    
+    def test_ticket_is_single_use_across_workers(self):
+        client = self.client
+        self.assertTrue(client.connect_to_server())
+        client.disconnect()
+        ticket = client.session_ticket
+        for attempt in range(2 * self.WORKERS):
+            self.assertTrue(client.connect_to_server())
+            client.send_request({'type': 'ping'})
+            client.disconnect()
+        
+        # Repetir un ticket ya usado falla en cualquier worker
+        for attempt in range(self.WORKERS):
+            client.session_ticket = ticket
+            client.connect_to_server()
+            response = client.send_request({'type': 'ping'})
+            client.disconnect()
+            self.assertEqual(response['status'], 'error', f"intento {attempt}")
+
+if __name__ == '__main__':
+    unittest.main()